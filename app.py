@@ -1,156 +1,2778 @@
 import os
 import io
 import base64
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file, stream_with_context, url_for, has_request_context, g
 from dotenv import load_dotenv
-from google import genai 
-from google.genai import types
-from PIL import Image
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from gtts import gTTS
-from contextlib import closing
+from contextlib import contextmanager
 import asyncio
-import edge_tts
+import concurrent.futures
+import contextvars
+import queue
 import csv
 import json
 import re
+import time
+import threading
+import atexit
+from collections import OrderedDict, deque
+import hashlib
+import functools
+import math
+import random
+import bisect
+import gc
+import importlib
+import sys
+from tenacity import AsyncRetrying, Retrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
 
 
+# --- IMPORT MODUL BERAT SECARA LAZY ---
+# google-genai, edge-tts, gTTS, Pillow & psycopg2 makan ~1,5 detik kalau di-import semua pas start.
+# Modulnya baru di-import pas atributnya pertama kali dipakai, jadi worker bisa langsung nerima request.
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+genai = LazyModule("google.genai")
+types = LazyModule("google.genai.types")
+Image = LazyModule("PIL.Image")
+psycopg2 = LazyModule("psycopg2")
+psycopg2_extensions = LazyModule("psycopg2.extensions")
+pg_pool = LazyModule("psycopg2.pool")
+pg_extras = LazyModule("psycopg2.extras")
+gtts = LazyModule("gtts")
+edge_tts = LazyModule("edge_tts")
+HEAVY_MODULES = (genai, types, Image, psycopg2, psycopg2_extensions, pg_pool, pg_extras, gtts, edge_tts)
+
+
+def is_pil_image(value):
+    # Kalau Pillow belum ke-import, jelas belum ada objek gambar: gak perlu import cuma buat isinstance.
+    return "PIL.Image" in sys.modules and isinstance(value, Image.Image)
+
+
 # Muat variabel dari file .env
 load_dotenv()
 
-app = Flask(__name__)
+app = Flask(__name__)
+
+GEMINI_MODEL = "gemini-3.1-flash-lite"
+
+# APP_PRELOAD=1 (diset gunicorn.conf.py): proses master import semua modul berat & data sekali,
+# worker hasil fork tinggal pakai memorinya bareng. Thread background & koneksi (DB, Gemini)
+# baru dibuka di worker lewat after_fork(), karena socket & thread gak ikut ke-fork dengan aman.
+APP_PRELOAD = os.getenv("APP_PRELOAD", "0") == "1"
+
+# --- INISIALISASI GEMINI ---
+# Client baru dibuat pas pertama kali dipakai (import google-genai + bikin client itu mahal).
+client = None
+_client_initialized = False
+_client_lock = threading.Lock()
+
+
+def get_gemini_client():
+    global client, _client_initialized
+    if client is None and not _client_initialized:
+        with _client_lock:
+            if client is None and not _client_initialized:
+                try:
+                    client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+                    print("✅ Koneksi Gemini API berhasil.")
+                except Exception as e:
+                    print(f"❌ Error Gemini API: {e}")
+                _client_initialized = True
+    return client
+
+
+# --- CACHE IN-MEMORY (TTL + LRU) ---
+_MISSING = object()
+
+
+class TtlLruCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "negative_hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+
+    def get(self, key):
+        # Balikin (ketemu, nilai). Nilai None = entry negatif (udah dicek, datanya memang gak ada).
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self._stats["misses"] += 1
+                return False, None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return False, None
+            self._data.move_to_end(key)
+            self._stats["negative_hits" if value is None else "hits"] += 1
+            return True, value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def update(self, key, fn):
+        # Ubah nilai yang udah ada di cache (write-through). Gak ngapa-ngapain kalau key-nya gak ada.
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING and entry[0] > time.monotonic():
+                self._data[key] = (entry[0], fn(entry[1]))
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            hits = self._stats["hits"] + self._stats["negative_hits"]
+            total = hits + self._stats["misses"]
+            return {
+                **self._stats,
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "hit_ratio": round(hits / total, 4) if total else 0.0,
+            }
+
+
+# --- METRIK (PROMETHEUS /metrics + HEADER Server-Timing) ---
+# Tiap tahap yang makan waktu (gemini, tts, db, decode gambar, cek relevansi) dicatat ke histogram
+# per endpoint + tahap, dan dikirim balik per request lewat header Server-Timing buat dilog Unity.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, seconds):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist["counts"][i] += 1
+                    break
+            hist["sum"] += seconds
+            hist["count"] += 1
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @staticmethod
+    def _labels(pairs, extra=()):
+        pairs = list(pairs) + list(extra)
+        if not pairs:
+            return ""
+        escaped = [f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in pairs]
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self, gauges=()):
+        with self._lock:
+            histograms = {k: {"counts": list(v["counts"]), "sum": v["sum"], "count": v["count"]} for k, v in self._histograms.items()}
+            counters = dict(self._counters)
+        lines = []
+        declared = set()
+        for (name, labels), hist in sorted(histograms.items()):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets, hist["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {hist['count']}")
+            lines.append(f"{name}_sum{self._labels(labels)} {round(hist['sum'], 6)}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist['count']}")
+        for (name, labels), value in sorted(counters.items()):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for name, labels, value in gauges:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(METRICS_BUCKETS)
+
+
+# Request yang lagi jalan: {"endpoint", "start", "stage_timings"}. Diset hook before_request Flask (di bawah)
+# dan Quart (asgi.py), jadi record_stage() gak peduli request-nya dilayani yang mana. asyncio.to_thread()
+# ikut bawa nilainya; thread pool biasa dibawain manual lewat submit_with_stage_timings().
+_request_timing = contextvars.ContextVar("request_timing", default=None)
+_stage_timings_lock = threading.Lock()
+
+
+def _add_stage_timing(timings, stage, seconds):
+    # Bisa ditulis barengan dari beberapa thread (mis. putaran quiz paralel).
+    with _stage_timings_lock:
+        total, count = timings.get(stage, (0.0, 0))
+        timings[stage] = (total + seconds, count + 1)
+
+
+def start_request_timing(endpoint):
+    # Balikin token buat end_request_timing() di teardown request.
+    return _request_timing.set({"endpoint": endpoint or "unknown", "start": time.perf_counter(), "stage_timings": {}})
+
+
+def finish_request_timing(status_code):
+    # Dipanggil after_request: catat total & ar_requests_total, balikin nilai header Server-Timing
+    # (None kalau timing request ini gak pernah dimulai / udah diselesaikan).
+    timing = _request_timing.get()
+    if timing is None or timing.get("start") is None:
+        return None
+    elapsed = time.perf_counter() - timing.pop("start")
+    endpoint = timing["endpoint"]
+    metrics.observe("ar_stage_duration_seconds", {"endpoint": endpoint, "stage": "total"}, elapsed)
+    metrics.inc("ar_requests_total", {"endpoint": endpoint, "status": status_code})
+    with _stage_timings_lock:
+        stage_timings = list(timing["stage_timings"].items())
+    parts = [
+        f"{stage};dur={round(total * 1000, 1)}" + (f';desc="x{count}"' if count > 1 else "")
+        for stage, (total, count) in stage_timings
+    ]
+    parts.append(f"total;dur={round(elapsed * 1000, 1)}")
+    return ", ".join(parts)
+
+
+def end_request_timing(token):
+    _request_timing.reset(token)
+
+
+def record_stage(stage, seconds):
+    # Di dalam request (atau thread yang bawa timing request-nya): masuk histogram endpoint itu +
+    # Server-Timing. Sisanya: endpoint "background".
+    endpoint = "background"
+    timing = _request_timing.get()
+    if timing is not None:
+        endpoint = timing["endpoint"]
+        _add_stage_timing(timing["stage_timings"], stage, seconds)
+    metrics.observe("ar_stage_duration_seconds", {"endpoint": endpoint, "stage": stage}, seconds)
+
+
+def submit_with_stage_timings(executor, fn, *args):
+    # Thread pool gak ikut bawa contextvars, jadi timing request asalnya dibawa manual.
+    timing = _request_timing.get()
+    if timing is None:
+        return executor.submit(fn, *args)
+
+    def run():
+        token = _request_timing.set(timing)
+        try:
+            return fn(*args)
+        finally:
+            _request_timing.reset(token)
+
+    return executor.submit(run)
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def record_gemini_usage(task, model, response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, attr in (
+        ("prompt", "prompt_token_count"),
+        ("output", "candidates_token_count"),
+        ("thinking", "thoughts_token_count"),
+        ("cached", "cached_content_token_count"),
+    ):
+        value = getattr(usage, attr, None)
+        if value:
+            metrics.inc("ar_gemini_tokens_total", {"task": task, "model": model, "kind": kind}, value)
+
+
+def decode_image(source):
+    # Image.open itu lazy, jadi dipaksa load di sini biar waktu decode-nya kehitung.
+    with timed("image_decode"):
+        image = Image.open(source)
+        image.load()
+    return image
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_timing_token = start_request_timing(request.endpoint)
+
+
+@app.after_request
+def _add_server_timing(response):
+    server_timing = finish_request_timing(response.status_code)
+    if server_timing:
+        response.headers["Server-Timing"] = server_timing
+    return response
+
+
+@app.teardown_request
+def _end_request_timer(error=None):
+    token = g.pop("request_timing_token", None)
+    if token is not None:
+        end_request_timing(token)
+
+
+# --- MODEL ROUTER ---
+# Tiap jenis tugas punya daftar rute "provider:model@THINKING_LEVEL" (dipisah koma), dicoba berurutan.
+# Kalau satu rute balas 429/5xx, lanjut ke rute berikutnya dan rute itu diistirahatkan sebentar.
+# Bisa diganti lewat env tanpa ubah kode, contoh:
+#   MODEL_ROUTE_QUIZ="gemini:gemini-3.1-flash-lite@HIGH,free_tier:gemma-4-31b-it@HIGH"
+FREE_TIER_MODEL = os.getenv("FREE_TIER_MODEL", "gemma-4-31b-it")
+MODEL_ROUTE_COOLDOWN = float(os.getenv("MODEL_ROUTE_COOLDOWN", "30"))
+MODEL_LATENCY_WINDOW = int(os.getenv("MODEL_LATENCY_WINDOW", "500"))
+_FREE_TIER_ROUTE = f"free_tier:{FREE_TIER_MODEL}@HIGH"
+DEFAULT_MODEL_ROUTES = {
+    # Vonis RELATED/UNRELATED satu kata, gak perlu mikir panjang.
+    "classify": f"gemini:{GEMINI_MODEL}@LOW,{_FREE_TIER_ROUTE}",
+    "spelling": f"gemini:{GEMINI_MODEL}@LOW,{_FREE_TIER_ROUTE}",
+    # Jawaban template (definisi/fungsi/kalimat) cuma ~10 kata.
+    "answer": f"gemini:{GEMINI_MODEL}@LOW,{_FREE_TIER_ROUTE}",
+    "custom_answer": f"gemini:{GEMINI_MODEL}@MEDIUM,{_FREE_TIER_ROUTE}",
+    "identify": f"gemini:{GEMINI_MODEL}@HIGH,{_FREE_TIER_ROUTE}",
+    "image_qa": f"gemini:{GEMINI_MODEL}@HIGH,{_FREE_TIER_ROUTE}",
+    "quiz": f"gemini:{GEMINI_MODEL}@HIGH,{_FREE_TIER_ROUTE}",
+}
+# API key per provider. free_tier pakai key sendiri kalau ada (sama kayak free_tier_model_test/backend.py).
+MODEL_PROVIDER_KEYS = {
+    "gemini": os.getenv("GEMINI_API_KEY"),
+    "free_tier": os.getenv("FREE_TIER_GEMINI_API_KEY") or os.getenv("GEMINI_API_KEY"),
+}
+
+
+def parse_model_routes(spec):
+    routes = []
+    for part in str(spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        target, _, level = part.partition("@")
+        provider, _, model = target.partition(":")
+        if not model:
+            provider, model = "gemini", provider
+        routes.append((provider.strip(), model.strip(), (level or "HIGH").strip().upper()))
+    return routes
+
+
+def is_retryable_model_error(error):
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    try:
+        code = int(code)
+    except (TypeError, ValueError):
+        return False
+    return code == 429 or code >= 500
+
+
+def is_rate_limit_error(error):
+    # 429 dari Gemini atau token bucket lokal (UpstreamRateLimited juga code 429).
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    try:
+        return int(code) == 429
+    except (TypeError, ValueError):
+        return False
+
+
+# --- RATE LIMIT KE UPSTREAM (TOKEN BUCKET PER PROVIDER) ---
+# Samain sama kuota API key masing-masing (request per menit). 0 = gak dibatasi.
+MODEL_RATE_LIMIT_RPM = {
+    "gemini": float(os.getenv("MODEL_RATE_LIMIT_GEMINI", "60")),
+    "free_tier": float(os.getenv("MODEL_RATE_LIMIT_FREE_TIER", "30")),
+}
+MODEL_RATE_BURST = int(os.getenv("MODEL_RATE_BURST", "5"))
+# Maks nunggu token sebelum dianggap kena limit (lalu pindah rute / backoff). Yang async boleh nunggu
+# (gak nahan thread); yang sync jalan di thread request, jadi default-nya langsung gagal dan router
+# pindah ke rute cadangan / endpoint pakai jawaban darurat.
+MODEL_RATE_WAIT = float(os.getenv("MODEL_RATE_WAIT", "10"))
+MODEL_RATE_WAIT_SYNC = float(os.getenv("MODEL_RATE_WAIT_SYNC", "0"))
+
+
+class UpstreamRateLimited(Exception):
+    # Dianggap kayak 429 dari Gemini biar router & retry memperlakukannya sama.
+    code = 429
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        # Balikin 0 kalau dapet token, kalau belum balikin berapa detik harus nunggu.
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def available(self):
+        with self._lock:
+            return min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+
+    def acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self._take()
+            if not wait:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self._take()
+            if not wait:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+
+class UpstreamRateLimiter:
+    def __init__(self, limits_rpm, burst, max_wait, sync_max_wait):
+        self.buckets = {p: TokenBucket(rpm, burst) for p, rpm in limits_rpm.items() if rpm > 0}
+        self.max_wait = max_wait
+        self.sync_max_wait = sync_max_wait
+        self._stats = {"acquired": 0, "rejected": 0, "wait_seconds": 0.0}
+        self._lock = threading.Lock()
+
+    def acquire(self, provider):
+        bucket = self.buckets.get(provider)
+        if bucket is not None:
+            start = time.monotonic()
+            self._finish(provider, bucket.acquire(self.sync_max_wait), start)
+
+    async def acquire_async(self, provider):
+        bucket = self.buckets.get(provider)
+        if bucket is not None:
+            start = time.monotonic()
+            self._finish(provider, await bucket.acquire_async(self.max_wait), start)
+
+    def _finish(self, provider, ok, start):
+        with self._lock:
+            self._stats["acquired" if ok else "rejected"] += 1
+            self._stats["wait_seconds"] += time.monotonic() - start
+        if not ok:
+            raise UpstreamRateLimited(f"Kuota {provider} habis (token bucket)")
+
+    def available(self, provider):
+        # Perkiraan token yang bisa langsung dipakai; None kalau provider gak dibatasi.
+        bucket = self.buckets.get(provider)
+        if bucket is None:
+            return None
+        return bucket.available()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["wait_seconds"] = round(stats["wait_seconds"], 3)
+        stats["tokens"] = {p: round(b.tokens, 2) for p, b in self.buckets.items()}
+        return stats
+
+
+gemini_rate_limiter = UpstreamRateLimiter(MODEL_RATE_LIMIT_RPM, MODEL_RATE_BURST, MODEL_RATE_WAIT, MODEL_RATE_WAIT_SYNC)
+
+
+class ModelRouter:
+    def __init__(self, routes, cooldown, latency_window):
+        self.routes = routes
+        self.cooldown = cooldown
+        self.latency_window = latency_window
+        self._clients = {}
+        self._cooldown_until = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        # Lock terpisah buat bikin client: request pertama yang barengan gak boleh bikin client dobel,
+        # tapi stats/cooldown jangan ikut ketahan selama client dibuat.
+        self._client_lock = threading.Lock()
+
+    def _client(self, provider):
+        if provider in self._clients:
+            return self._clients[provider]
+        with self._client_lock:
+            if provider in self._clients:
+                return self._clients[provider]
+            api_key = MODEL_PROVIDER_KEYS.get(provider)
+            provider_client = None
+            if api_key:
+                if api_key == MODEL_PROVIDER_KEYS.get("gemini"):
+                    provider_client = get_gemini_client()
+                else:
+                    try:
+                        provider_client = genai.Client(api_key=api_key)
+                    except Exception as e:
+                        print(f"❌ Provider {provider} gagal dibuat: {e}")
+            self._clients[provider] = provider_client
+        return provider_client
+
+    def _candidates(self, task):
+        routes = self.routes.get(task) or self.routes["answer"]
+        now = time.monotonic()
+        with self._lock:
+            ready = [r for r in routes if self._cooldown_until.get(r[:2], 0) <= now]
+        # Semua lagi istirahat: tetap coba semua daripada langsung gagal.
+        return ready or list(routes)
+
+    def _record(self, task, route, seconds, ok, failover=False, cooldown=True):
+        key = f"{task}|{route[0]}:{route[1]}@{route[2]}"
+        with self._lock:
+            entry = self._stats.setdefault(key, {
+                "calls": 0, "errors": 0, "failovers": 0, "latencies": deque(maxlen=self.latency_window),
+            })
+            entry["calls"] += 1
+            if ok:
+                entry["latencies"].append(seconds)
+            else:
+                entry["errors"] += 1
+            if failover:
+                entry["failovers"] += 1
+                if cooldown:
+                    self._cooldown_until[route[:2]] = time.monotonic() + self.cooldown
+
+    def _attempts(self, task, thinking_level):
+        usable = []
+        for route in self._candidates(task):
+            provider_client = self._client(route[0])
+            if provider_client is not None:
+                usable.append((route, provider_client))
+        if not usable:
+            raise RuntimeError(f"Belum ada provider model yang siap buat '{task}'")
+        for index, (route, provider_client) in enumerate(usable):
+            level = (thinking_level or route[2]).upper()
+            config = types.GenerateContentConfig(
+                thinking_config=types.ThinkingConfig(thinking_level=level)
+            )
+            yield route, provider_client, route[1], config, index == len(usable) - 1
+
+    def _failed(self, task, route, start, error, failover, is_last):
+        # Catat error; balikin True kalau boleh lanjut ke rute berikutnya.
+        # Ditolak token bucket kita sendiri bukan berarti modelnya bermasalah, jadi gak perlu istirahat.
+        cooldown = not isinstance(error, UpstreamRateLimited)
+        self._record(task, route, time.monotonic() - start, False, failover, cooldown)
+        if not failover or is_last:
+            return False
+        print(f"⚠️ {route[0]}:{route[1]} error ({error}), pindah ke rute berikutnya buat '{task}'.")
+        return True
+
+    def generate(self, contents, task, thinking_level=None):
+        for route, provider_client, model, config, is_last in self._attempts(task, thinking_level):
+            start = time.monotonic()
+            try:
+                gemini_rate_limiter.acquire(route[0])
+                response = provider_client.models.generate_content(model=model, contents=contents, config=config)
+            except Exception as e:
+                if not self._failed(task, route, start, e, is_retryable_model_error(e), is_last):
+                    raise
+                continue
+            self._record(task, route, time.monotonic() - start, True)
+            record_gemini_usage(task, model, response)
+            return response
+
+    async def generate_async(self, contents, task, thinking_level=None):
+        # Sama kayak generate(), tapi lewat client.aio biar gak nahan thread selama nunggu Gemini.
+        for route, provider_client, model, config, is_last in self._attempts(task, thinking_level):
+            start = time.monotonic()
+            try:
+                await gemini_rate_limiter.acquire_async(route[0])
+                response = await provider_client.aio.models.generate_content(model=model, contents=contents, config=config)
+            except Exception as e:
+                if not self._failed(task, route, start, e, is_retryable_model_error(e), is_last):
+                    raise
+                continue
+            self._record(task, route, time.monotonic() - start, True)
+            record_gemini_usage(task, model, response)
+            return response
+
+    def stream(self, contents, task, thinking_level=None):
+        for route, provider_client, model, config, is_last in self._attempts(task, thinking_level):
+            start = time.monotonic()
+            started = False
+            last_chunk = None
+            try:
+                gemini_rate_limiter.acquire(route[0])
+                for chunk in provider_client.models.generate_content_stream(model=model, contents=contents, config=config):
+                    last_chunk = chunk
+                    text = getattr(chunk, "text", None)
+                    if text:
+                        started = True
+                        yield text
+            except Exception as e:
+                # Kalau teks udah terlanjur dikirim, gak bisa pindah rute lagi.
+                if not self._failed(task, route, start, e, is_retryable_model_error(e) and not started, is_last):
+                    raise
+                continue
+            self._record(task, route, time.monotonic() - start, True)
+            # usage_metadata lengkapnya ada di potongan terakhir.
+            if last_chunk is not None:
+                record_gemini_usage(task, model, last_chunk)
+            record_stage("gemini_stream", time.monotonic() - start)
+            return
+
+    def stats(self):
+        with self._lock:
+            snapshot = {key: dict(entry, latencies=sorted(entry["latencies"])) for key, entry in self._stats.items()}
+            now = time.monotonic()
+            cooling = [f"{p}:{m}" for (p, m), until in self._cooldown_until.items() if until > now]
+        routes = {}
+        for key, entry in snapshot.items():
+            latencies = entry.pop("latencies")
+            if latencies:
+                entry["avg_ms"] = round(sum(latencies) / len(latencies) * 1000, 1)
+                entry["p50_ms"] = round(latencies[len(latencies) // 2] * 1000, 1)
+                entry["p95_ms"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+            routes[key] = entry
+        return {
+            "routes": routes,
+            "cooling_down": cooling,
+            "config": {task: [f"{p}:{m}@{l}" for p, m, l in r] for task, r in self.routes.items()},
+        }
+
+
+model_router = ModelRouter(
+    {
+        task: parse_model_routes(os.getenv(f"MODEL_ROUTE_{task.upper()}", spec)) or parse_model_routes(spec)
+        for task, spec in DEFAULT_MODEL_ROUTES.items()
+    },
+    MODEL_ROUTE_COOLDOWN,
+    MODEL_LATENCY_WINDOW,
+)
+
+
+def model_router_stats():
+    return model_router.stats()
+
+
+# --- GEMINI GATEWAY ---
+# Di depan router: panggilan identik (hash prompt sama) yang lagi jalan barengan digabung jadi satu,
+# retry dengan backoff eksponensial kalau semua rute kena 429/5xx, dan hasil disimpan per
+# header Idempotency-Key biar retry dari client gak manggil Gemini lagi.
+GEMINI_RETRY_ATTEMPTS = int(os.getenv("GEMINI_RETRY_ATTEMPTS", "3"))
+GEMINI_RETRY_INITIAL_WAIT = float(os.getenv("GEMINI_RETRY_INITIAL_WAIT", "1"))
+GEMINI_RETRY_MAX_WAIT = float(os.getenv("GEMINI_RETRY_MAX_WAIT", "8"))
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "600"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "2048"))
+
+
+def _hash_contents(digest, contents):
+    if isinstance(contents, (list, tuple)):
+        for part in contents:
+            _hash_contents(digest, part)
+    elif is_pil_image(contents):
+        digest.update(f"img:{contents.mode}:{contents.size}".encode())
+        digest.update(contents.tobytes())
+    else:
+        digest.update(b"txt:" + str(contents).encode("utf-8"))
+    digest.update(b"\0")
+
+
+def prompt_hash(task, thinking_level, contents):
+    digest = hashlib.sha256(f"{task}|{thinking_level or ''}|".encode())
+    _hash_contents(digest, contents)
+    return digest.hexdigest()
+
+
+def current_idempotency_key():
+    if not has_request_context():
+        return None
+    key = (request.headers.get("Idempotency-Key") or "").strip()
+    return key[:200] or None
+
+
+class GeminiGateway:
+    def __init__(self, router, retry_attempts, retry_initial_wait, retry_max_wait, idempotency_cache):
+        self.router = router
+        self.retry_attempts = max(1, retry_attempts)
+        self.retry_initial_wait = retry_initial_wait
+        self.retry_max_wait = retry_max_wait
+        self.idempotency_cache = idempotency_cache
+        self._inflight = {}
+        self._inflight_async = {}
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "upstream_calls": 0, "coalesced": 0, "idempotent_hits": 0, "retries": 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _before_sleep(self, retry_state):
+        self._count("retries")
+        print(f"⏳ Gemini kena limit/error, coba lagi ({retry_state.attempt_number}/{self.retry_attempts})...")
+
+    def _retrying(self):
+        # Ditolak token bucket sendiri gak di-retry di jalur sync: backoff-nya bakal tidur di thread request.
+        return Retrying(
+            retry=retry_if_exception(lambda e: is_retryable_model_error(e) and not isinstance(e, UpstreamRateLimited)),
+            stop=stop_after_attempt(self.retry_attempts),
+            wait=wait_exponential_jitter(initial=self.retry_initial_wait, max=self.retry_max_wait),
+            before_sleep=self._before_sleep,
+            reraise=True,
+        )
+
+    def _call_upstream(self, contents, task, thinking_level):
+        self._count("upstream_calls")
+        for attempt in self._retrying():
+            with attempt:
+                return self.router.generate(contents, task, thinking_level)
+
+    def generate(self, contents, task, thinking_level=None, idempotency_key=None):
+        self._count("calls")
+        key = prompt_hash(task, thinking_level, contents)
+        if idempotency_key:
+            found, response = self.idempotency_cache.get((idempotency_key, key))
+            if found:
+                self._count("idempotent_hits")
+                return response
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._inflight[key] = future
+
+        if leader:
+            try:
+                response = self._call_upstream(contents, task, thinking_level)
+                future.set_result(response)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+        else:
+            self._count("coalesced")
+            response = future.result()
+
+        if idempotency_key:
+            self.idempotency_cache.set((idempotency_key, key), response)
+        return response
+
+    async def _call_upstream_async(self, contents, task, thinking_level):
+        self._count("upstream_calls")
+        retrying = AsyncRetrying(
+            retry=retry_if_exception(is_retryable_model_error),
+            stop=stop_after_attempt(self.retry_attempts),
+            wait=wait_exponential_jitter(initial=self.retry_initial_wait, max=self.retry_max_wait),
+            before_sleep=self._before_sleep,
+            reraise=True,
+        )
+        async for attempt in retrying:
+            with attempt:
+                return await self.router.generate_async(contents, task, thinking_level)
+
+    async def generate_async(self, contents, task, thinking_level=None, idempotency_key=None):
+        # Versi asyncio dari generate(): penggabungan cuma antar-request di event loop yang sama.
+        self._count("calls")
+        key = prompt_hash(task, thinking_level, contents)
+        if idempotency_key:
+            found, response = self.idempotency_cache.get((idempotency_key, key))
+            if found:
+                self._count("idempotent_hits")
+                return response
+
+        future = self._inflight_async.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._call_upstream_async(contents, task, thinking_level))
+            self._inflight_async[key] = future
+            future.add_done_callback(lambda _: self._inflight_async.pop(key, None))
+        else:
+            self._count("coalesced")
+        response = await asyncio.shield(future)
+
+        if idempotency_key:
+            self.idempotency_cache.set((idempotency_key, key), response)
+        return response
+
+    def stream(self, contents, task, thinking_level=None):
+        # Streaming gak digabung (tiap client butuh potongannya sendiri), tapi tetap lewat token bucket.
+        self._count("calls")
+        self._count("upstream_calls")
+        return self.router.stream(contents, task, thinking_level)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, inflight=len(self._inflight) + len(self._inflight_async))
+        stats["rate_limiter"] = gemini_rate_limiter.stats()
+        return stats
+
+
+gemini_gateway = GeminiGateway(
+    model_router,
+    GEMINI_RETRY_ATTEMPTS,
+    GEMINI_RETRY_INITIAL_WAIT,
+    GEMINI_RETRY_MAX_WAIT,
+    TtlLruCache(IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_TTL),
+)
+
+
+def gemini_gateway_stats():
+    return gemini_gateway.stats()
+
+
+def call_gemini(contents, thinking_level=None, task="answer"):
+    # thinking_level kosong = ikut konfigurasi rute tugasnya.
+    with timed("gemini"):
+        return gemini_gateway.generate(contents, task, thinking_level, current_idempotency_key())
+
+
+async def call_gemini_async(contents, thinking_level=None, task="answer", idempotency_key=None):
+    # Dipakai mode ASGI (asgi.py); idempotency key dioper manual karena bukan request Flask.
+    start = time.perf_counter()
+    try:
+        return await gemini_gateway.generate_async(contents, task, thinking_level, idempotency_key)
+    finally:
+        record_stage("gemini", time.perf_counter() - start)
+
+
+def call_gemini_stream(contents, thinking_level=None, task="answer"):
+    # Versi streaming: yield potongan teks begitu model ngirim.
+    return gemini_gateway.stream(contents, task, thinking_level)
+
+
+# --- KLASIFIKASI RELEVANSI PERTANYAAN CUSTOM ---
+# Urutan: memo (pasangan benda+pertanyaan yang pernah dicek) -> heuristik kata kunci ->
+# model lokal (regresi logistik n-gram) -> Gemini kalau model lokal kurang yakin.
+# Tiap vonis Gemini dicatat ke RELATEDNESS_LOG_FILE buat melatih ulang model lokal
+# (python train_relatedness.py).
+RELATEDNESS_MODEL_FILE = os.getenv("RELATEDNESS_MODEL_FILE", "relatedness_model.json")
+RELATEDNESS_LOG_FILE = os.getenv("RELATEDNESS_LOG_FILE", "relatedness_log.jsonl")
+# Model lokal cuma dipercaya kalau probabilitasnya >= ini (atau <= 1 - ini).
+RELATEDNESS_CONFIDENCE = float(os.getenv("RELATEDNESS_CONFIDENCE", "0.85"))
+RELATEDNESS_MEMO_SIZE = int(os.getenv("RELATEDNESS_MEMO_SIZE", "4096"))
+RELATEDNESS_MEMO_TTL = float(os.getenv("RELATEDNESS_MEMO_TTL", "86400"))
+
+relatedness_memo = TtlLruCache(RELATEDNESS_MEMO_SIZE, RELATEDNESS_MEMO_TTL)
+_relatedness_stats = {"heuristic": 0, "local": 0, "gemini": 0, "gemini_failed": 0, "local_ms_total": 0.0}
+_relatedness_lock = threading.Lock()
+
+
+def relatedness_features(object_name, question):
+    obj = " ".join(str(object_name or "").lower().split())
+    q = " ".join(str(question or "").lower().split())
+    words = re.findall(r"[a-z0-9]+", q)
+    features = {"bias_q": 1.0}
+    for word in words:
+        features[f"w:{word}"] = 1.0
+    padded = f" {q} "
+    for i in range(len(padded) - 2):
+        features[f"c:{padded[i:i + 3]}"] = 1.0
+    obj_words = [w for w in re.findall(r"[a-z0-9]+", obj) if len(w) >= 3]
+    if obj_words and any(w in words or w.rstrip("s") in words for w in obj_words):
+        features["obj_mentioned"] = 1.0
+    # Normalisasi panjang biar pertanyaan panjang gak otomatis dapet skor ekstrem.
+    scale = 1.0 / math.sqrt(len(features))
+    return {k: v * scale for k, v in features.items()}
+
+
+class RelatednessModel:
+    def __init__(self, weights=None, bias=0.0, meta=None):
+        self.weights = weights or {}
+        self.bias = bias
+        self.meta = meta or {}
+
+    def predict_proba(self, object_name, question):
+        if not self.weights:
+            return 0.5
+        features = relatedness_features(object_name, question)
+        z = self.bias + sum(self.weights.get(k, 0.0) * v for k, v in features.items())
+        z = max(-30.0, min(30.0, z))
+        return 1.0 / (1.0 + math.exp(-z))
+
+    @classmethod
+    def train(cls, examples, epochs=30, learning_rate=0.5, l2=1e-4, seed=7):
+        # examples: list of (object_name, question, label bool). SGD regresi logistik biasa.
+        rng = random.Random(seed)
+        data = [(relatedness_features(o, q), 1.0 if label else 0.0) for o, q, label in examples]
+        weights = {}
+        bias = 0.0
+        for _ in range(epochs):
+            rng.shuffle(data)
+            for features, target in data:
+                z = bias + sum(weights.get(k, 0.0) * v for k, v in features.items())
+                z = max(-30.0, min(30.0, z))
+                error = 1.0 / (1.0 + math.exp(-z)) - target
+                bias -= learning_rate * error
+                for k, v in features.items():
+                    w = weights.get(k, 0.0)
+                    weights[k] = w - learning_rate * (error * v + l2 * w)
+        weights = {k: round(w, 6) for k, w in weights.items() if abs(w) > 1e-4}
+        return cls(weights, bias, {"examples": len(examples), "epochs": epochs, "trained_at": time.time()})
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({"weights": self.weights, "bias": self.bias, "meta": self.meta}, file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+        return cls(data.get("weights"), data.get("bias", 0.0), data.get("meta"))
+
+
+_relatedness_model = RelatednessModel()
+_relatedness_model_mtime = None
+_relatedness_model_checked = 0.0
+
+
+def get_relatedness_model():
+    # Model di-load ulang otomatis kalau filenya diganti (cek maksimal tiap 60 detik).
+    global _relatedness_model, _relatedness_model_mtime, _relatedness_model_checked
+    now = time.monotonic()
+    if now - _relatedness_model_checked < 60 and _relatedness_model_checked:
+        return _relatedness_model
+    _relatedness_model_checked = now
+    try:
+        mtime = os.path.getmtime(RELATEDNESS_MODEL_FILE)
+    except OSError:
+        return _relatedness_model
+    if mtime != _relatedness_model_mtime:
+        try:
+            _relatedness_model = RelatednessModel.load(RELATEDNESS_MODEL_FILE)
+            _relatedness_model_mtime = mtime
+            print(f"✅ Model relevansi lokal dimuat ({len(_relatedness_model.weights)} fitur).")
+        except Exception as e:
+            print(f"⚠️ Model relevansi lokal gagal dimuat: {e}")
+    return _relatedness_model
+
+
+def log_relatedness_verdict(object_name, question, verdict):
+    if not RELATEDNESS_LOG_FILE:
+        return
+    line = json.dumps({"object": object_name, "question": question, "related": verdict, "ts": int(time.time())})
+    try:
+        with _relatedness_lock:
+            with open(RELATEDNESS_LOG_FILE, 'a', encoding='utf-8') as file:
+                file.write(line + "\n")
+    except OSError as e:
+        print(f"⚠️ Gagal catat vonis relevansi: {e}")
+
+
+def _count_relatedness(key, local_ms=None):
+    with _relatedness_lock:
+        _relatedness_stats[key] += 1
+        if local_ms is not None:
+            _relatedness_stats["local_ms_total"] += local_ms
+
+
+def relatedness_stats():
+    with _relatedness_lock:
+        stats = dict(_relatedness_stats)
+    memo = relatedness_memo.stats()
+    resolved = stats["heuristic"] + stats["local"] + stats["gemini"] + stats["gemini_failed"] + memo["hits"]
+    return {
+        **{k: (round(v, 3) if isinstance(v, float) else v) for k, v in stats.items()},
+        "memo_hits": memo["hits"],
+        "resolved_without_gemini": round(1 - (stats["gemini"] + stats["gemini_failed"]) / resolved, 4) if resolved else 0.0,
+        "model_features": len(_relatedness_model.weights),
+    }
+
+
+def classify_relatedness_locally(obj, q):
+    # Balikin True/False kalau model lokal yakin, None kalau harus tanya Gemini.
+    start = time.perf_counter()
+    proba = get_relatedness_model().predict_proba(obj, q)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if proba >= RELATEDNESS_CONFIDENCE:
+        _count_relatedness("local", elapsed_ms)
+        return True
+    if proba <= 1 - RELATEDNESS_CONFIDENCE:
+        _count_relatedness("local", elapsed_ms)
+        return False
+    return None
+
+
+def is_related_custom_question(object_name, question_text):
+    obj = str(object_name or "").strip().lower()
+    q = " ".join(str(question_text or "").strip().lower().split())
+    if not obj or not q:
+        return False
+
+    found, verdict = relatedness_memo.get((obj, q))
+    if found:
+        return verdict
+
+    with timed("relatedness"):
+        verdict, cacheable = _classify_relatedness(obj, q)
+    if cacheable:
+        relatedness_memo.set((obj, q), verdict)
+    return verdict
+
+
+def relatedness_by_heuristics(obj, q):
+    # Balikin True/False kalau heuristik kata kunci udah yakin, None kalau belum.
+    # Strong allow: explicit object mention.
+    if obj in q:
+        return True
+
+    # Allow partial mention for multi-word objects, e.g. "remote" for "remote control".
+    obj_parts = [p for p in obj.replace("-", " ").split() if len(p) >= 4]
+    if any(part in q for part in obj_parts):
+        return True
+
+    intent_keywords = [
+        "shape", "color", "size", "material", "function", "use", "used", "price", "buy", "store", "where",
+        "bentuk", "warna", "ukuran", "bahan", "fungsi", "kegunaan", "harga", "beli", "toko", "dimana", "di mana"
+    ]
+    contextual_refs = ["it", "this", "that", "this object", "benda ini", "itu", "ini"]
+    if any(k in q for k in intent_keywords) and any(r in q for r in contextual_refs):
+        return True
+
+    # Strong block for obvious out-of-topic world questions when object not mentioned.
+    off_topic = [
+        "president", "prime minister", "chancellor", "germany", "jerman", "celebrity", "actor", "football", "math",
+        "politik", "pemerintah", "negara", "ibukota", "capital city", "planet", "history", "sejarah"
+    ]
+    if any(k in q for k in off_topic):
+        return False
+
+    return None
+
+
+def _classify_relatedness(obj, q):
+    verdict = relatedness_by_heuristics(obj, q)
+    if verdict is not None:
+        _count_relatedness("heuristic")
+        return verdict, True
+
+    verdict = classify_relatedness_locally(obj, q)
+    if verdict is not None:
+        return verdict, True
+
+    # Fallback semantic check with Gemini in bilingual mode.
+    classify_prompt = (
+        "You are a classifier.\n"
+        "Task: Decide if the user question is related to the scanned object.\n"
+        "Object: " + obj + "\n"
+        "Question: " + q + "\n"
+        "Rules:\n"
+        "- Related if asking attributes, function, usage, place to buy, care, parts, examples, spelling, or sentence about that object.\n"
+        "- Question can be in English or Indonesian.\n"
+        "- Unrelated if about politics, celebrities, random world facts, or another object.\n"
+        "Output exactly one word: RELATED or UNRELATED."
+    )
+
+    try:
+        resp = call_gemini(contents=classify_prompt, task="classify")
+        label = (resp.text or "").strip().upper()
+    except Exception:
+        _count_relatedness("gemini_failed")
+        return False, False
+    verdict = label.startswith("RELATED")
+    _count_relatedness("gemini")
+    log_relatedness_verdict(obj, q, verdict)
+    return verdict, True
+
+
+RAG_DATASET_FILE = 'Dataset_RAG_Englishv2.csv'
+
+
+def parse_rag_dataset():
+    rows = []
+    knowledge_base = {}
+    try:
+        # Membaca file CSV (cuma kalau snapshot di disk belum ada / dataset-nya berubah)
+        with open(RAG_DATASET_FILE, mode='r', encoding='utf-8') as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                rows.append(row)
+                # Ambil nama bahasa inggrisnya dan jadikan huruf kecil semua
+                nama_inggris = row['English Name'].strip().lower()
+                # Satu nama bisa muncul di beberapa ruangan (table, door, ...): semua kategorinya disimpan.
+                kategori_semua = list((knowledge_base.get(nama_inggris) or {}).get('kategori_semua', []))
+                kategori = row.get('Category', '').strip()
+                if kategori and kategori not in kategori_semua:
+                    kategori_semua.append(kategori)
+                knowledge_base[nama_inggris] = {
+                    'deskripsi': row['Simple Description (Context for AI)'],
+                    'kalimat_lks': row['Example Sentence (from LKS)'],
+                    'qna_lks': row.get('Asking and Giving Information', ''),
+                    'nama_indonesia': row.get('Indonesian Name', '').strip(),
+                    'kategori': kategori,
+                    'kategori_semua': kategori_semua,
+                }
+    except Exception as e:
+        print(f"⚠️ File materi_lks.csv tidak ditemukan atau error: {e}")
+    return rows, knowledge_base
+
+
+# --- RETRIEVAL TF-IDF (BUAT PERTANYAAN CUSTOM) ---
+# Semua kolom dataset (nama, deskripsi, contoh kalimat, QnA LKS) di-index sekali pas start.
+# Vektornya sparse (dict term -> bobot) + inverted index, jadi query top-k cukup satu
+# perkalian matriks-vektor sparse (jalan < 1 ms buat ukuran dataset ini).
+# KNOWLEDGE_BASE + index disimpan jadi satu snapshot JSON di disk, jadi worker berikutnya
+# tinggal load tanpa parse CSV & bikin index ulang. Sengaja JSON, bukan pickle: file di disk
+# gak boleh bisa ngejalanin kode pas di-load.
+RAG_INDEX_FILE = os.getenv("RAG_INDEX_FILE", "rag_index.json")
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "3"))
+RAG_MIN_SCORE = float(os.getenv("RAG_MIN_SCORE", "0.15"))
+RAG_INDEX_VERSION = 3
+
+RAG_STOPWORDS = {
+    "a", "an", "the", "is", "are", "it", "its", "it's", "this", "that", "of", "to", "in", "on", "and", "or",
+    "for", "with", "what", "how", "why", "do", "does", "can", "i", "you", "my", "your", "be", "as", "at",
+    "by", "from", "q", "isn't", "there", "usually", "often", "used", "use",
+    "apa", "ini", "itu", "yang", "dan", "di", "ke", "untuk",
+}
+
+
+def _rag_tokens(text):
+    return [t for t in re.findall(r"[a-z0-9]+", str(text or "").lower()) if t not in RAG_STOPWORDS]
+
+
+def _rag_row_text(row):
+    return " ".join([
+        row.get('English Name', ''),
+        row.get('Indonesian Name', ''),
+        row.get('Category', ''),
+        row.get('Simple Description (Context for AI)', ''),
+        row.get('Example Sentence (from LKS)', ''),
+        row.get('Asking and Giving Information', ''),
+    ])
+
+
+class TfidfIndex:
+    def __init__(self, docs, idf, postings):
+        self.docs = docs  # list of {"object_name", "kategori", "deskripsi", "kalimat_lks", "qna_lks"}
+        self.idf = idf
+        self.postings = postings  # term -> [(doc_id, bobot)]
+
+    @staticmethod
+    def _weights(tokens, idf):
+        counts = {}
+        for token in tokens:
+            if token in idf:
+                counts[token] = counts.get(token, 0) + 1
+        weights = {t: (1 + math.log(c)) * idf[t] for t, c in counts.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        return {t: w / norm for t, w in weights.items()}
+
+    @classmethod
+    def build(cls, rows):
+        docs = []
+        doc_tokens = []
+        for row in rows:
+            docs.append({
+                "object_name": row.get('English Name', '').strip().lower(),
+                "kategori": row.get('Category', '').strip(),
+                "deskripsi": row.get('Simple Description (Context for AI)', ''),
+                "kalimat_lks": row.get('Example Sentence (from LKS)', ''),
+                "qna_lks": row.get('Asking and Giving Information', ''),
+            })
+            doc_tokens.append(_rag_tokens(_rag_row_text(row)))
+
+        n_docs = len(docs)
+        df = {}
+        for tokens in doc_tokens:
+            for token in set(tokens):
+                df[token] = df.get(token, 0) + 1
+        idf = {t: math.log((n_docs + 1) / (d + 1)) + 1 for t, d in df.items()}
+
+        postings = {}
+        for doc_id, tokens in enumerate(doc_tokens):
+            for term, weight in cls._weights(tokens, idf).items():
+                postings.setdefault(term, []).append((doc_id, weight))
+        return cls(docs, idf, postings)
+
+    def search(self, query, k=RAG_TOP_K, min_score=RAG_MIN_SCORE):
+        scores = {}
+        for term, q_weight in self._weights(_rag_tokens(query), self.idf).items():
+            for doc_id, d_weight in self.postings.get(term, ()):
+                scores[doc_id] = scores.get(doc_id, 0.0) + q_weight * d_weight
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return [(round(score, 4), self.docs[doc_id]) for doc_id, score in ranked[:k] if score >= min_score]
+
+
+def _dataset_fingerprint():
+    try:
+        with open(RAG_DATASET_FILE, 'rb') as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    except OSError:
+        return ""
+
+
+def load_knowledge_snapshot():
+    # Balikin (KNOWLEDGE_BASE, index TF-IDF). Snapshot dipakai kalau versi & sidik jari CSV-nya cocok.
+    fingerprint = _dataset_fingerprint()
+    if RAG_INDEX_FILE and os.path.exists(RAG_INDEX_FILE):
+        try:
+            with open(RAG_INDEX_FILE, encoding='utf-8') as file:
+                saved = json.load(file)
+            if saved.get("version") == RAG_INDEX_VERSION and saved.get("fingerprint") == fingerprint:
+                return saved["knowledge_base"], TfidfIndex(saved["docs"], saved["idf"], saved["postings"])
+        except Exception as e:
+            print(f"⚠️ Snapshot RAG di disk gak kebaca, bikin ulang: {e}")
+
+    rows, knowledge_base = parse_rag_dataset()
+    index = TfidfIndex.build(rows)
+    if RAG_INDEX_FILE and rows:
+        try:
+            tmp_path = f"{RAG_INDEX_FILE}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump({
+                    "version": RAG_INDEX_VERSION,
+                    "fingerprint": fingerprint,
+                    "knowledge_base": knowledge_base,
+                    "docs": index.docs,
+                    "idf": index.idf,
+                    "postings": index.postings,
+                }, file, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, RAG_INDEX_FILE)
+        except OSError as e:
+            print(f"⚠️ Gagal simpan snapshot RAG ke disk: {e}")
+    return knowledge_base, index
+
+
+KNOWLEDGE_BASE, RAG_INDEX = load_knowledge_snapshot()
+print(f"✅ RAG Berhasil dimuat: {len(KNOWLEDGE_BASE)} materi LKS siap digunakan.")
+
+
+def build_rag_context(object_name, question):
+    # Fakta benda yang di-scan selalu ikut, ditambah baris dataset lain yang paling nyambung sama pertanyaan.
+    lines = []
+    data_lks = KNOWLEDGE_BASE.get(object_name)
+    if data_lks:
+        lines.append(f"Fact about {object_name}: {data_lks['deskripsi']}")
+    seen = {(object_name, (data_lks or {}).get('deskripsi'))}
+    for _, doc in RAG_INDEX.search(f"{object_name} {question}"):
+        if doc["object_name"] == object_name:
+            for extra in (doc["qna_lks"], doc["kalimat_lks"]):
+                if extra and (object_name, extra) not in seen:
+                    lines.append(f"LKS example about {object_name}: {extra}")
+                    seen.add((object_name, extra))
+        elif (doc["object_name"], doc["deskripsi"]) not in seen:
+            lines.append(f"Related fact ({doc['object_name']}): {doc['deskripsi']}")
+            seen.add((doc["object_name"], doc["deskripsi"]))
+    return "".join(f"{line}\n" for line in lines)
+
+
+# --- RESOLVER NAMA BENDA (NAMA KANONIK) ---
+# "books", "a book", "buku", "phone charger", "remot tv" semua harus jadi satu nama yang sama
+# sebelum dipakai buat RAG, tabel objects/quizzes, dan cache. Kalau gak, tiap variasi bikin
+# baris cache sendiri dan panggilan Gemini dobel.
+# Fuzzy cuma buat salah ketik di nama panjang ("televison"): nama pendek kayak "hair"/"chair" atau
+# "paints"/"pants" itu kata beda beneran, jangan sampai ketulis jadi objek lain di DB.
+OBJECT_FUZZY_MAX_DISTANCE = int(os.getenv("OBJECT_FUZZY_MAX_DISTANCE", "1"))
+OBJECT_FUZZY_MIN_LENGTH = int(os.getenv("OBJECT_FUZZY_MIN_LENGTH", "7"))
+OBJECT_SYNONYMS_FILE = os.getenv("OBJECT_SYNONYMS_FILE", "object_synonyms.json")
+
+# Sinonim bawaan -> nama Inggris di dataset. Bisa ditambah lewat file JSON OBJECT_SYNONYMS_FILE.
+OBJECT_SYNONYMS = {
+    "remote": "remote control",
+    "tv remote": "remote control",
+    "remot": "remote control",
+    "tv": "television",
+    "phone charger": "charger",
+    "cellphone charger": "charger",
+    "charger hp": "charger",
+    "casan": "charger",
+    "ac": "air condition",
+    "air conditioner": "air condition",
+    "couch": "sofa",
+    "bookshelf": "bookcase",
+    "teddy": "teddy bear",
+    "wardrobe": "cupboard",
+    "closet": "cupboard",
+    "rug": "carpet",
+    "notebook computer": "laptop",
+    "pc": "computer",
+    "sandal": "slippers",
+    "bedsheet": "bed sheet",
+    "light switch": "switch",
+    "tissue": "tissue pack",
+    "coat hanger": "hanger",
+    "hair brush": "hairbrush",
+    "piggybank": "piggy bank",
+    "desk lamp": "table lamp",
+    "bedside lamp": "night lamp",
+    "wall clock": "clock",
+    "photo": "photograph",
+    "shirt": "clothes",
+    "trousers": "pants",
+    "sneakers": "shoes",
+}
+LEADING_WORDS = ("a", "an", "the", "my", "this", "that", "some", "sebuah", "seorang", "satu")
+
+_resolver_stats = {"exact": 0, "synonym": 0, "plural": 0, "fuzzy": 0, "unknown": 0}
+_resolver_lock = threading.Lock()
+
+
+def normalize_object_name(text):
+    cleaned = re.sub(r"[^a-z0-9 ]+", " ", str(text or "").lower().replace("-", " "))
+    words = cleaned.split()
+    while len(words) > 1 and words[0] in LEADING_WORDS:
+        words = words[1:]
+    return " ".join(words)
+
+
+def _plural_variants(name):
+    # Cuma kata terakhir yang diubah: "toy cars" -> "toy car", "sock" -> "socks".
+    variants = []
+    if name.endswith("ies"):
+        variants.append(name[:-3] + "y")
+    if name.endswith("es"):
+        variants.append(name[:-2])
+    if name.endswith("s"):
+        variants.append(name[:-1])
+    variants.extend([name + "s", name + "es"])
+    return variants
+
+
+def _load_synonyms():
+    synonyms = dict(OBJECT_SYNONYMS)
+    if OBJECT_SYNONYMS_FILE and os.path.exists(OBJECT_SYNONYMS_FILE):
+        try:
+            with open(OBJECT_SYNONYMS_FILE, mode='r', encoding='utf-8') as file:
+                synonyms.update({str(k): str(v) for k, v in json.load(file).items()})
+        except Exception as e:
+            print(f"⚠️ File sinonim {OBJECT_SYNONYMS_FILE} gagal dibaca: {e}")
+    return synonyms
+
+
+def build_object_name_index(knowledge_base, synonyms):
+    # nama ternormalisasi -> (nama kanonik, sumber). Nama Inggris menang dari nama Indonesia & sinonim.
+    index = {}
+    for nama_inggris in knowledge_base:
+        index[normalize_object_name(nama_inggris)] = (nama_inggris, "exact")
+    for nama_inggris, data in knowledge_base.items():
+        nama_indonesia = normalize_object_name(data.get('nama_indonesia', ''))
+        if nama_indonesia:
+            index.setdefault(nama_indonesia, (nama_inggris, "synonym"))
+    for alias, target in synonyms.items():
+        target = normalize_object_name(target)
+        if target in knowledge_base:
+            index.setdefault(normalize_object_name(alias), (target, "synonym"))
+    return index
+
+
+OBJECT_NAME_INDEX = build_object_name_index(KNOWLEDGE_BASE, _load_synonyms())
+
+
+def _count_resolution(method):
+    with _resolver_lock:
+        _resolver_stats[method] += 1
+
+
+def resolver_stats():
+    with _resolver_lock:
+        return {**_resolver_stats, "index_size": len(OBJECT_NAME_INDEX)}
+
+
+def edit_distance(a, b, limit):
+    # Damerau-Levenshtein (tukar dua huruf dihitung 1), berhenti kalau udah pasti > limit.
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            if previous2 is not None and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def _fuzzy_match(name):
+    if OBJECT_FUZZY_MAX_DISTANCE <= 0 or len(name) < OBJECT_FUZZY_MIN_LENGTH:
+        return None
+    matches = {
+        OBJECT_NAME_INDEX[key][0]
+        for key in OBJECT_NAME_INDEX
+        if len(key) >= OBJECT_FUZZY_MIN_LENGTH and edit_distance(name, key, OBJECT_FUZZY_MAX_DISTANCE) <= OBJECT_FUZZY_MAX_DISTANCE
+    }
+    # Kalau mirip ke lebih dari satu objek, gak usah nebak.
+    return matches.pop() if len(matches) == 1 else None
+
+
+@functools.lru_cache(maxsize=4096)
+def _resolve_normalized(name):
+    if name in OBJECT_NAME_INDEX:
+        return OBJECT_NAME_INDEX[name]
+    for variant in _plural_variants(name):
+        if variant in OBJECT_NAME_INDEX:
+            return OBJECT_NAME_INDEX[variant][0], "plural"
+    match = _fuzzy_match(name)
+    if match:
+        # Hasil di-cache lru, jadi log ini cuma sekali per nama per proses.
+        print(f"🔎 Nama '{name}' dianggap salah ketik dari '{match}' (fuzzy).")
+        return match, "fuzzy"
+    # Benda di luar dataset tetap dipakai, cukup versi ternormalisasinya.
+    return name, "unknown"
+
+
+def resolve_object_name(text):
+    name = normalize_object_name(text)
+    if not name:
+        return ""
+    canonical, method = _resolve_normalized(name)
+    _count_resolution(method)
+    return canonical
+
+
+# --- JAWABAN LOKAL (TANPA GEMINI) ---
+# Pertanyaan yang jawabannya udah pasti dari dataset (ejaan, kalimat LKS, terjemahan, letak benda)
+# dijawab langsung di sini: gak makan kuota API dan latency-nya mikrodetik.
+# Kalau Gemini error / kena rate limit, jawaban dari deskripsi dataset dipakai sebagai cadangan.
+LOCAL_ANSWER_ENABLED = os.getenv("LOCAL_ANSWER_ENABLED", "1") == "1"
+
+_local_answer_stats = {"hits": 0, "degraded": 0}
+_local_answer_lock = threading.Lock()
+
+TO_INDONESIAN_PATTERNS = (
+    "in indonesian", "in bahasa", "indonesian word", "bahasa indonesia", "bahasa indonesianya",
+    "indonesianya", "artinya", "arti kata", "mean in",
+)
+TO_ENGLISH_PATTERNS = ("in english", "bahasa inggris", "inggrisnya")
+# Kata utuh: "eja" gak boleh kena di "meja".
+SPELLING_PATTERN = re.compile(r"\b(spell\w*|eja|ejaan|mengeja|dieja)\b")
+LOCATION_PATTERNS = ("where is", "where's", "which room", "di mana letak", "dimana letak", "ada di ruangan")
+
+
+def _count_local_answer(key):
+    with _local_answer_lock:
+        _local_answer_stats[key] += 1
+
+
+def local_answer_stats():
+    with _local_answer_lock:
+        return dict(_local_answer_stats)
+
+
+def spell_word(word):
+    letters = [ch.upper() for ch in str(word) if ch.isalnum()]
+    return " ".join(f"{ch}." for ch in letters)
+
+
+def _capitalize_first(text):
+    return text[:1].upper() + text[1:]
+
+
+def _first_sentence(text):
+    parts = re.split(r"(?<=[.!?])\s+", str(text or "").strip())
+    return parts[0] if parts and parts[0] else ""
+
+
+def _mentions(q, name):
+    return bool(name) and re.search(rf"\b{re.escape(name.lower())}\b", q) is not None
+
+
+def object_categories(object_name):
+    # Semua ruangan tempat benda ini muncul di dataset, urut sesuai CSV.
+    data_lks = KNOWLEDGE_BASE.get(object_name) or {}
+    return data_lks.get('kategori_semua') or ([data_lks['kategori']] if data_lks.get('kategori') else [])
+
+
+def _local_custom_answer(object_name, data_lks, question):
+    q = " ".join(str(question or "").strip().lower().split())
+    if not q:
+        return None
+    # Terjemahan dicek duluan: "apa bahasa inggrisnya meja ini?" itu nanya terjemahan, bukan ejaan.
+    nama_indonesia = (data_lks or {}).get('nama_indonesia')
+    if nama_indonesia:
+        if _mentions(q, nama_indonesia) and any(p in q for p in TO_ENGLISH_PATTERNS):
+            return f"{_capitalize_first(nama_indonesia)} in English is {object_name}."
+        if _mentions(q, object_name) and any(p in q for p in TO_INDONESIAN_PATTERNS):
+            return f"{_capitalize_first(object_name)} in Indonesian is {nama_indonesia}."
+    # Ejaan & letak cuma dijawab lokal kalau jelas nanyain benda ini, bukan "spell president".
+    about_object = _mentions(q, object_name) or re.search(r"\b(it|this|ini|itu)\b", q) is not None
+    if about_object and SPELLING_PATTERN.search(q):
+        return f"{_capitalize_first(object_name)} is spelled {spell_word(object_name)}"
+    if not data_lks:
+        return None
+    kategori_list = object_categories(object_name)
+    if kategori_list and about_object and any(p in q for p in LOCATION_PATTERNS):
+        rooms = " or the ".join(kategori.lower() for kategori in kategori_list)
+        return f"The {object_name} is usually in the {rooms}."
+    return None
+
+
+def local_answer(object_name, question_key, custom_question="", degraded=False):
+    # degraded=True -> boleh jawab pakai deskripsi dataset (dipakai pas Gemini lagi gak bisa).
+    if not LOCAL_ANSWER_ENABLED and not degraded:
+        return None
+    data_lks = KNOWLEDGE_BASE.get(object_name)
+    answer = None
+
+    if question_key == "ejaan":
+        answer = spell_word(object_name) or None
+    elif question_key == "kalimat":
+        kalimat_lks = (data_lks or {}).get('kalimat_lks', '').strip()
+        if kalimat_lks and object_name in kalimat_lks.lower():
+            answer = kalimat_lks
+    elif question_key == "custom":
+        answer = _local_custom_answer(object_name, data_lks, custom_question)
+
+    if answer is None and degraded and data_lks:
+        deskripsi = data_lks.get('deskripsi', '')
+        if question_key == "definisi":
+            answer = _first_sentence(deskripsi)
+        elif question_key == "fungsi":
+            sentences = re.split(r"(?<=[.!?])\s+", deskripsi.strip())
+            answer = next((s for s in sentences if re.search(r"\bus(e|ed)\b", s.lower())), _first_sentence(deskripsi))
+        if answer:
+            _count_local_answer("degraded")
+            return answer
+
+    if answer:
+        _count_local_answer("hits")
+    return answer or None
+
+
+# --- FUNGSI HELPER DATABASE ---
+# --- CONNECTION POOL NEON (BIAR GAK HANDSHAKE TLS TIAP QUERY) ---
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# Neon auto-suspend bikin koneksi nganggur bisa mati diam-diam, jadi yang
+# nganggur lebih lama dari ini dicek dulu pakai SELECT 1 sebelum dipakai.
+DB_HEALTHCHECK_IDLE = float(os.getenv("DB_HEALTHCHECK_IDLE", "30"))
+# Matikan (0) kalau DATABASE_URL lewat pooler mode transaction yang gak dukung PREPARE.
+DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "1") == "1"
+
+# Query tetap yang di-PREPARE sekali per koneksi (server-side prepared statement).
+PREPARED_QUERIES = {
+    # Kolom ditulis satu-satu: prepared statement `SELECT *` rusak ("cached plan must not change result type")
+    # begitu tabelnya di-ALTER.
+    "select_object": "SELECT object_name, definisi, fungsi, ejaan, kalimat FROM objects WHERE object_name = %s",
+    "insert_object": "INSERT INTO objects (object_name) VALUES (%s) ON CONFLICT (object_name) DO NOTHING",
+    "select_object_names": "SELECT DISTINCT object_name FROM objects",
+    # questions_json dikirim apa adanya ke client tanpa json.loads. Sengaja bukan questions::text: JSONB
+    # nulis ulang spasi & urutan key, padahal content_hash (ETag) dihitung dari teks questions_json.
+    "select_quiz": "SELECT questions_json, validator_version, content_hash FROM quizzes WHERE object_name = %s",
+    "upsert_quiz": (
+        "INSERT INTO quizzes (object_name, questions_json, questions, validator_version, content_hash) "
+        "VALUES (%s, %s, %s::jsonb, %s, %s) "
+        "ON CONFLICT (object_name) DO UPDATE SET questions_json = EXCLUDED.questions_json, "
+        "questions = EXCLUDED.questions, validator_version = EXCLUDED.validator_version, "
+        "content_hash = EXCLUDED.content_hash"
+    ),
+    "select_bank": "SELECT question_type, item FROM question_bank WHERE object_name = %s",
+}
+
+# Skema tambahan, dibuat/ditambah otomatis sekali per proses (semuanya IF NOT EXISTS).
+# - question_bank: tiap soal quiz yang lolos validasi disimpan satu baris, jadi soal bagus
+#   gak ikut kebuang waktu satu respon Gemini ditolak.
+# - quizzes.questions (JSONB) + validator_version + content_hash: quiz yang dicap versi validator
+#   terbaru bisa langsung dikirim tanpa parse & validasi ulang. questions_json (teks) tetap diisi
+#   buat kompatibilitas.
+# - quizzes.sweep_attempted_at: kapan sweep terakhir nyoba baris ini, biar yang gagal terus gak
+#   nutupin baris lain.
+SCHEMA_DDL = (
+    "CREATE TABLE IF NOT EXISTS question_bank ("
+    " object_name TEXT NOT NULL,"
+    " question_key TEXT NOT NULL,"
+    " question_type TEXT NOT NULL,"
+    " item JSONB NOT NULL,"
+    " created_at TIMESTAMPTZ NOT NULL DEFAULT now(),"
+    " PRIMARY KEY (object_name, question_key));"
+    "CREATE INDEX IF NOT EXISTS question_bank_object_type_idx ON question_bank (object_name, question_type);"
+    "ALTER TABLE quizzes ADD COLUMN IF NOT EXISTS questions JSONB;"
+    "ALTER TABLE quizzes ADD COLUMN IF NOT EXISTS validator_version INTEGER;"
+    "ALTER TABLE quizzes ADD COLUMN IF NOT EXISTS content_hash TEXT;"
+    "ALTER TABLE quizzes ADD COLUMN IF NOT EXISTS sweep_attempted_at TIMESTAMPTZ;"
+)
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def ensure_schema(conn):
+    # Dipanggil sebelum query yang butuh skema tambahan; DDL-nya di-commit sendiri.
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            with conn.cursor() as cur:
+                cur.execute(SCHEMA_DDL)
+            conn.commit()
+            _schema_ready = True
+
+
+@functools.lru_cache(maxsize=None)
+def _pooled_connection_class():
+    # Dibikin pas koneksi pertama, biar psycopg2 gak perlu di-import waktu start.
+    class _PooledConnection(psycopg2_extensions.connection):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
+            self.last_used = time.monotonic()
+
+    return _PooledConnection
+
+
+class DbPool:
+    def __init__(self, dsn, minconn, maxconn, timeout, healthcheck_idle):
+        self.dsn = dsn
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._idle = deque()
+        self._open = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            "acquired": 0,
+            "waited": 0,
+            "timeouts": 0,
+            "connects": 0,
+            "healthcheck_failed": 0,
+            "discarded": 0,
+            "wait_total_ms": 0.0,
+            "wait_max_ms": 0.0,
+            "max_in_use": 0,
+        }
+        # Pre-warm: buka koneksi minimum dari awal biar request pertama gak nunggu handshake.
+        for _ in range(self.minconn):
+            conn = self._connect()
+            with self._cond:
+                self._open += 1
+                self._idle.append(conn)
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, connection_factory=_pooled_connection_class())
+        with self._cond:
+            self._stats["connects"] += 1
+        return conn
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.last_used < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        with self._cond:
+            while not self._idle and self._open >= self.maxconn:
+                waited = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    if not self._idle and self._open >= self.maxconn:
+                        self._stats["timeouts"] += 1
+                        raise pg_pool.PoolError(
+                            f"Pool DB penuh ({self.maxconn} koneksi), timeout {self.timeout}s"
+                        )
+            conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                self._open += 1
+            self._in_use += 1
+            wait_ms = (time.monotonic() - start) * 1000
+            self._stats["acquired"] += 1
+            self._stats["waited"] += int(waited)
+            self._stats["wait_total_ms"] += wait_ms
+            self._stats["wait_max_ms"] = max(self._stats["wait_max_ms"], wait_ms)
+            self._stats["max_in_use"] = max(self._stats["max_in_use"], self._in_use)
+
+        try:
+            if conn is not None and not self._is_healthy(conn):
+                with self._cond:
+                    self._stats["healthcheck_failed"] += 1
+                self._close_quietly(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            self._release(None, discard=True)
+            raise
+        return conn
+
+    def _release(self, conn, discard=False):
+        if conn is not None and not discard:
+            try:
+                status = conn.info.transaction_status
+                if status == psycopg2_extensions.TRANSACTION_STATUS_UNKNOWN:
+                    discard = True
+                elif status != psycopg2_extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        if conn is not None and (discard or conn.closed):
+            self._close_quietly(conn)
+            discard = True
+        with self._cond:
+            self._in_use -= 1
+            if conn is None or discard:
+                self._open -= 1
+                self._stats["discarded"] += int(conn is not None)
+            else:
+                conn.last_used = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self._release(conn, discard=broken)
+
+    def stats(self):
+        with self._cond:
+            acquired = self._stats["acquired"]
+            return {
+                "min": self.minconn,
+                "max": self.maxconn,
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "avg_wait_ms": round(self._stats["wait_total_ms"] / acquired, 3) if acquired else 0.0,
+                **{k: (round(v, 3) if isinstance(v, float) else v) for k, v in self._stats.items()},
+            }
+
+    def close(self):
+        with self._cond:
+            conns = list(self._idle)
+            self._idle.clear()
+            self._open -= len(conns)
+        for conn in conns:
+            self._close_quietly(conn)
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def _get_db_pool():
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = DbPool(
+                    os.getenv("DATABASE_URL"),
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    healthcheck_idle=DB_HEALTHCHECK_IDLE,
+                )
+                print(f"✅ Pool DB siap ({DB_POOL_MIN}-{DB_POOL_MAX} koneksi).")
+    return _db_pool
+
+
+@contextmanager
+def get_db_connection():
+    # Dipakai: `with get_db_connection() as conn:` -> koneksi balik ke pool setelah blok selesai.
+    start = time.perf_counter()
+    with _get_db_pool().connection() as conn:
+        record_stage("db_acquire", time.perf_counter() - start)
+        yield conn
+
+
+def execute_prepared(cur, name, params=()):
+    with timed("db_query"):
+        _execute_prepared(cur, name, params)
+
+
+def _execute_prepared(cur, name, params):
+    sql = PREPARED_QUERIES[name]
+    prepared = getattr(cur.connection, "prepared", None)
+    if not DB_PREPARED_STATEMENTS or prepared is None:
+        cur.execute(sql, params)
+        return
+    try:
+        _execute_prepared_statement(cur, name, sql, params, prepared)
+    except Exception as e:
+        if getattr(e, "pgcode", None) != "0A000" or "cached plan" not in str(e):
+            raise
+        # Skema tabel berubah sejak PREPARE: buang semua prepared statement di koneksi ini.
+        # SELECT langsung dicoba ulang; tulisan dilempar lagi biar pemanggilnya (write-behind) yang retry.
+        print(f"⚠️ Prepared statement {name} basi setelah perubahan skema, di-PREPARE ulang.")
+        cur.connection.rollback()
+        cur.execute("DEALLOCATE ALL")
+        prepared.clear()
+        if not sql.lstrip().upper().startswith("SELECT"):
+            raise
+        _execute_prepared_statement(cur, name, sql, params, prepared)
+
+
+def _execute_prepared_statement(cur, name, sql, params, prepared):
+    if name not in prepared:
+        counter = iter(range(1, len(params) + 1))
+        positional_sql = re.sub(r"%s", lambda _: f"${next(counter)}", sql)
+        cur.execute(f"PREPARE {name} AS {positional_sql}")
+        prepared.add(name)
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+
+def db_pool_stats():
+    if _db_pool is None:
+        return {"status": "belum dibuat"}
+    return _db_pool.stats()
+
+
+def _prewarm_db_pool():
+    try:
+        _get_db_pool()
+    except Exception as e:
+        print(f"⚠️ Gagal pre-warm pool DB: {e}")
+
+
+@atexit.register
+def _close_db_pool():
+    if _db_pool is not None:
+        _db_pool.close()
+
+
+# Baris tabel objects (definisi/fungsi/kalimat/ejaan) jarang berubah setelah keisi,
+# jadi disimpan di memori biar cache hit gak perlu SELECT ke Neon.
+OBJECT_ANSWER_COLUMNS = ("definisi", "fungsi", "ejaan", "kalimat")
+OBJECT_CACHE_MAX_ENTRIES = int(os.getenv("OBJECT_CACHE_MAX_ENTRIES", "1024"))
+OBJECT_CACHE_TTL = float(os.getenv("OBJECT_CACHE_TTL", "600"))
+OBJECT_CACHE_NEGATIVE_TTL = float(os.getenv("OBJECT_CACHE_NEGATIVE_TTL", "30"))
+
+object_row_cache = TtlLruCache(OBJECT_CACHE_MAX_ENTRIES, OBJECT_CACHE_TTL)
+
+
+def note_object_inserted(object_name):
+    # Dipanggil habis INSERT objek baru: entry negatif diganti baris kosong biar UPDATE berikutnya ke-cache.
+    found, row = object_row_cache.get(object_name)
+    if found and row is None:
+        object_row_cache.set(object_name, {"object_name": object_name, **{col: None for col in OBJECT_ANSWER_COLUMNS}})
+    object_list_snapshot.note_inserted(object_name)
+
+
+# --- WRITE-BEHIND: TULIS KE DB DI BACKGROUND ---
+# Respon ke siswa gak nunggu INSERT/UPDATE/commit ke Neon. Tulisan masuk antrean,
+# lalu worker background nge-batch (multi-row), nggabungin tulisan dobel, dan retry kalau gagal.
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "1") == "1"
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "1000"))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "200"))
+WRITE_BEHIND_LINGER = float(os.getenv("WRITE_BEHIND_LINGER", "0.2"))
+WRITE_BEHIND_MAX_RETRIES = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "5"))
+WRITE_BEHIND_SHUTDOWN_TIMEOUT = float(os.getenv("WRITE_BEHIND_SHUTDOWN_TIMEOUT", "10"))
+
+
+class WriteBehindQueue:
+    def __init__(self, max_queue, batch_size, linger, max_retries):
+        self.batch_size = max(1, batch_size)
+        self.linger = linger
+        self.max_retries = max(0, max_retries)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "enqueued": 0,
+            "written": 0,
+            "coalesced": 0,
+            "batches": 0,
+            "retries": 0,
+            "failed": 0,
+            "dropped": 0,
+            "isolated_retries": 0,
+            "sync_writes": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, op, *args):
+        if op not in ("insert_object", "update_object", "upsert_quiz", "insert_bank_item"):
+            raise ValueError(f"Operasi write-behind tidak dikenal: {op}")
+        if op == "update_object" and args[1] not in OBJECT_ANSWER_COLUMNS:
+            raise ValueError(f"Kolom objects tidak dikenal: {args[1]}")
+        if not WRITE_BEHIND_ENABLED:
+            # Tulis langsung, tapi cuma sekali coba: request (atau event loop asgi) gak boleh ikut nunggu backoff.
+            with self._lock:
+                self._stats["sync_writes"] += 1
+            try:
+                self._write([(op, args)])
+            except Exception as db_error:
+                with self._lock:
+                    self._stats["failed"] += 1
+                print(f"⚠️ Tulis langsung ke DB gagal ({op} dibuang): {db_error}")
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((op, args))
+            with self._lock:
+                self._stats["enqueued"] += 1
+        except queue.Full:
+            # Antrean penuh = DB lagi lambat banget. Tulisan ini dibuang (semuanya cache, bisa dibikin ulang)
+            # daripada request-nya ikut nunggu DB.
+            with self._lock:
+                self._stats["dropped"] += 1
+            print(f"⚠️ Antrean write-behind penuh, {op} dibuang.")
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.linger
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._write_with_retry(batch)
+            finally:
+                for _ in range(len(batch) + int(stop)):
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def _write_with_retry(self, batch):
+        # Cuma dipanggil dari thread write-behind, jadi boleh tidur di sini.
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._write(batch)
+                return True
+            except Exception as db_error:
+                if attempt >= self.max_retries:
+                    if len(batch) > 1:
+                        return self._write_one_by_one(batch, db_error)
+                    with self._lock:
+                        self._stats["failed"] += 1
+                    print(f"⚠️ Write-behind gagal permanen (1 tulisan dibuang): {db_error}")
+                    return False
+                with self._lock:
+                    self._stats["retries"] += 1
+                time.sleep(min(0.5 * (2 ** attempt), 10))
+
+    def _write_one_by_one(self, batch, batch_error):
+        # Satu baris jelek bikin satu batch gagal: tulis satu-satu (urutan asli, jadi yang terakhir tetap menang)
+        # biar yang kebuang cuma baris yang emang bermasalah.
+        print(f"⚠️ Batch write-behind gagal ({batch_error}), coba tulis {len(batch)} tulisan satu-satu.")
+        with self._lock:
+            self._stats["isolated_retries"] += 1
+        failed = 0
+        for op, args in batch:
+            try:
+                self._write([(op, args)])
+            except Exception as db_error:
+                failed += 1
+                print(f"⚠️ Write-behind gagal permanen ({op} {args[0]!r} dibuang): {db_error}")
+        with self._lock:
+            self._stats["failed"] += failed
+        return failed == 0
+
+    def _write(self, batch):
+        # Gabungin tulisan dobel: INSERT objek yang sama cukup sekali, UPDATE/upsert ambil yang terakhir.
+        inserts = {}
+        updates = {}
+        quizzes = {}
+        bank_items = {}
+        for op, args in batch:
+            if op == "insert_object":
+                inserts[args[0]] = None
+            elif op == "update_object":
+                object_name, column, value = args
+                updates.setdefault(column, {})[object_name] = value
+            elif op == "upsert_quiz":
+                quizzes[args[0]] = args[1:]
+            elif op == "insert_bank_item":
+                object_name, question_key, question_type, item_json = args
+                bank_items[(object_name, question_key)] = (question_type, item_json)
+        unique_ops = len(inserts) + sum(len(rows) for rows in updates.values()) + len(quizzes) + len(bank_items)
+
+        start = time.monotonic()
+        with get_db_connection() as conn:
+            if quizzes or bank_items:
+                ensure_schema(conn)
+            with conn.cursor() as cur:
+                if len(inserts) == 1:
+                    execute_prepared(cur, "insert_object", tuple(inserts))
+                elif inserts:
+                    pg_extras.execute_values(
+                        cur,
+                        "INSERT INTO objects (object_name) VALUES %s ON CONFLICT (object_name) DO NOTHING",
+                        [(name,) for name in inserts],
+                    )
+                for column, rows in updates.items():
+                    pg_extras.execute_values(
+                        cur,
+                        f"UPDATE objects AS o SET {column} = v.value "
+                        f"FROM (VALUES %s) AS v(object_name, value) WHERE o.object_name = v.object_name",
+                        list(rows.items()),
+                    )
+                quiz_rows = [(name, text, text, version, digest) for name, (text, version, digest) in quizzes.items()]
+                if len(quiz_rows) == 1:
+                    execute_prepared(cur, "upsert_quiz", quiz_rows[0])
+                elif quiz_rows:
+                    pg_extras.execute_values(
+                        cur,
+                        "INSERT INTO quizzes (object_name, questions_json, questions, validator_version, content_hash) "
+                        "VALUES %s ON CONFLICT (object_name) DO UPDATE SET questions_json = EXCLUDED.questions_json, "
+                        "questions = EXCLUDED.questions, validator_version = EXCLUDED.validator_version, "
+                        "content_hash = EXCLUDED.content_hash",
+                        quiz_rows,
+                        template="(%s, %s, %s::jsonb, %s, %s)",
+                    )
+                if bank_items:
+                    pg_extras.execute_values(
+                        cur,
+                        "INSERT INTO question_bank (object_name, question_key, question_type, item) VALUES %s "
+                        "ON CONFLICT (object_name, question_key) DO NOTHING",
+                        [(name, key, qtype, item) for (name, key), (qtype, item) in bank_items.items()],
+                    )
+                conn.commit()
+        elapsed_ms = (time.monotonic() - start) * 1000
+
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["written"] += unique_ops
+            self._stats["coalesced"] += len(batch) - unique_ops
+            self._stats["last_flush_ms"] = elapsed_ms
+            self._stats["max_flush_ms"] = max(self._stats["max_flush_ms"], elapsed_ms)
+            self._stats["total_flush_ms"] += elapsed_ms
+
+    def flush(self, timeout=None):
+        # Tunggu sampai semua tulisan di antrean udah diproses. True kalau beres sebelum timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            batches = self._stats["batches"]
+            return {
+                **{k: (round(v, 3) if isinstance(v, float) else v) for k, v in self._stats.items()},
+                "depth": self._queue.qsize(),
+                "avg_flush_ms": round(self._stats["total_flush_ms"] / batches, 3) if batches else 0.0,
+            }
+
+
+write_behind = WriteBehindQueue(
+    WRITE_BEHIND_MAX_QUEUE,
+    batch_size=WRITE_BEHIND_BATCH_SIZE,
+    linger=WRITE_BEHIND_LINGER,
+    max_retries=WRITE_BEHIND_MAX_RETRIES,
+)
+
+
+@atexit.register
+def _flush_write_behind():
+    # Jalan sebelum pool DB ditutup (atexit urutannya kebalik dari registrasi).
+    write_behind.close(WRITE_BEHIND_SHUTDOWN_TIMEOUT)
+
+
+# --- FUNGSI HELPER TTS KE BASE64 (BARU!) ---
+# --- FUNGSI HELPER TTS NEURAL (EDGE-TTS) ---
+# Pilihan Suara Guru:
+# "en-US-AriaNeural" (Cewek dewasa, ramah)
+# "en-US-AnaNeural" (Cewek ceria, cocok buat anak kecil)
+# "en-US-GuyNeural" (Cowok)
+TTS_VOICE = os.getenv("TTS_VOICE", "en-CA-ClaraNeural")
+
+# --- CACHE AUDIO TTS (MEMORI LRU + DISK) ---
+# Teks yang sama ("I see a book", jawaban cache DB, blocked_answer) gak perlu di-synthesize ulang.
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "tts_cache")
+TTS_CACHE_MEMORY_MB = float(os.getenv("TTS_CACHE_MEMORY_MB", "64"))
+TTS_CACHE_DISK_MB = float(os.getenv("TTS_CACHE_DISK_MB", "1024"))
+
+
+class AudioCache:
+    def __init__(self, directory, memory_limit_bytes, disk_limit_bytes):
+        self.directory = directory
+        self.memory_limit = int(memory_limit_bytes)
+        self.disk_limit = int(disk_limit_bytes)
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+        }
+        self._load_disk_index()
+
+    @staticmethod
+    def make_key(voice, text):
+        return hashlib.sha256(f"{voice}\n{text}".encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def _load_disk_index(self):
+        if not self.directory or self.disk_limit <= 0:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.name.endswith(".mp3"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.name[:-4], st.st_size))
+            # Urut dari yang paling lama dipakai biar eviction-nya LRU juga setelah restart.
+            for _, key, size in sorted(entries):
+                self._disk[key] = size
+                self._disk_bytes += size
+            self._evict_disk()
+        except Exception as e:
+            print(f"⚠️ Cache audio disk gak bisa dipakai: {e}")
+            self.disk_limit = 0
+
+    def _remember(self, key, data):
+        if len(data) > self.memory_limit:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_limit and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._stats["memory_evictions"] += 1
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.disk_limit and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self._stats["disk_evictions"] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get(self, key, record_stats=True):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += int(record_stats)
+                return data
+            on_disk = key in self._disk
+        if on_disk:
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+                os.utime(self._path(key))
+            except OSError:
+                data = None
+            with self._lock:
+                if data:
+                    self._disk.move_to_end(key)
+                    self._remember(key, data)
+                    self._stats["disk_hits"] += int(record_stats)
+                    return data
+                size = self._disk.pop(key, None)
+                if size is not None:
+                    self._disk_bytes -= size
+        with self._lock:
+            self._stats["misses"] += int(record_stats)
+        return None
+
+    def put(self, key, data):
+        if not data:
+            return
+        with self._lock:
+            self._remember(key, data)
+            self._stats["stores"] += 1
+            write_disk = self.disk_limit > 0 and key not in self._disk
+        if not write_disk:
+            return
+        try:
+            tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f"⚠️ Gagal simpan audio ke disk: {e}")
+            return
+        with self._lock:
+            if key not in self._disk:
+                self._disk[key] = len(data)
+                self._disk_bytes += len(data)
+            self._evict_disk()
+
+    def stats(self):
+        with self._lock:
+            hits = self._stats["memory_hits"] + self._stats["disk_hits"]
+            total = hits + self._stats["misses"]
+            return {
+                **self._stats,
+                "hit_ratio": round(hits / total, 4) if total else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
+
+
+audio_cache = AudioCache(
+    TTS_CACHE_DIR,
+    memory_limit_bytes=TTS_CACHE_MEMORY_MB * 1024 * 1024,
+    disk_limit_bytes=TTS_CACHE_DISK_MB * 1024 * 1024,
+)
+
+
+# --- WORKER TTS (SATU EVENT LOOP BACKGROUND BUAT SEMUA REQUEST) ---
+# Daripada asyncio.run() bikin event loop baru tiap request, semua synthesis edge-tts
+# jalan di satu loop di thread terpisah. Thread Flask cukup submit job lalu nunggu future.
+TTS_MAX_CONCURRENCY = int(os.getenv("TTS_MAX_CONCURRENCY", "8"))
+TTS_TIMEOUT = float(os.getenv("TTS_TIMEOUT", "20"))
+# Batas nunggu giliran kalau semua slot concurrency lagi kepakai.
+TTS_QUEUE_TIMEOUT = float(os.getenv("TTS_QUEUE_TIMEOUT", "30"))
+
+
+class TtsWorker:
+    def __init__(self, max_concurrency, timeout, queue_timeout):
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "timeouts": 0,
+            "queue_timeouts": 0,
+            "active": 0,
+            "total_ms": 0.0,
+        }
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return self._loop
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def _run():
+                asyncio.set_event_loop(loop)
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                ready.set()
+                loop.run_forever()
+
+            self._loop = loop
+            self._thread = threading.Thread(target=_run, name="tts-worker", daemon=True)
+            self._thread.start()
+            ready.wait()
+            return loop
+
+    async def _stream_audio(self, text, voice, on_chunk=None):
+        communicate = edge_tts.Communicate(text, voice)
+        # Kumpulin chunk di list lalu join sekali, bukan bytes += (kuadratik).
+        chunks = []
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                chunks.append(chunk["data"])
+                if on_chunk is not None:
+                    on_chunk(chunk["data"])
+        return b"".join(chunks)
+
+    def _count(self, name, elapsed_ms=None):
+        with self._lock:
+            self._stats[name] += 1
+            if elapsed_ms is not None:
+                self._stats["total_ms"] += elapsed_ms
+
+    async def _synthesize(self, text, voice, on_chunk=None):
+        async with self._semaphore:
+            with self._lock:
+                self._stats["active"] += 1
+            start = time.monotonic()
+            try:
+                result = await asyncio.wait_for(
+                    self._stream_audio(text, voice, on_chunk), timeout=self.timeout
+                )
+            except asyncio.TimeoutError:
+                self._count("timeouts", (time.monotonic() - start) * 1000)
+                raise
+            except Exception:
+                self._count("failed", (time.monotonic() - start) * 1000)
+                raise
+            finally:
+                with self._lock:
+                    self._stats["active"] -= 1
+            self._count("completed", (time.monotonic() - start) * 1000)
+            return result
+
+    def submit(self, text, voice, on_chunk=None):
+        # on_chunk (opsional) dipanggil dari thread worker tiap ada potongan audio baru,
+        # dipakai mode streaming biar audio bisa dikirim sebelum synthesis selesai.
+        loop = self._ensure_started()
+        self._count("submitted")
+        return asyncio.run_coroutine_threadsafe(self._synthesize(text, voice, on_chunk), loop)
+
+    async def synthesize_async(self, text, voice):
+        # Buat mode ASGI: synthesis tetap jalan di loop worker, pemanggil cukup await tanpa nahan thread.
+        future = self.submit(text, voice)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout + self.queue_timeout)
+        except asyncio.TimeoutError:
+            if future.cancel():
+                self._count("queue_timeouts")
+            raise TimeoutError(f"TTS timeout (synthesis {self.timeout}s, antrean {self.queue_timeout}s)")
+
+    def synthesize(self, text, voice):
+        future = self.submit(text, voice)
+        try:
+            # wait_for di loop motong synthesis yang kelamaan, sisanya batas nunggu antrean.
+            return future.result(timeout=self.timeout + self.queue_timeout)
+        except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+            if future.cancel():
+                self._count("queue_timeouts")
+            raise TimeoutError(f"TTS timeout (synthesis {self.timeout}s, antrean {self.queue_timeout}s)")
+
+    def stats(self):
+        with self._lock:
+            done = self._stats["completed"] + self._stats["failed"] + self._stats["timeouts"]
+            return {
+                **{k: (round(v, 3) if isinstance(v, float) else v) for k, v in self._stats.items()},
+                "max_concurrency": self.max_concurrency,
+                "avg_ms": round(self._stats["total_ms"] / done, 3) if done else 0.0,
+                "running": self._thread is not None and self._thread.is_alive(),
+            }
+
+
+tts_worker = TtsWorker(TTS_MAX_CONCURRENCY, TTS_TIMEOUT, TTS_QUEUE_TIMEOUT)
+
+
+def generate_audio_bytes(text, voice=TTS_VOICE):
+    key = AudioCache.make_key(voice, text)
+    with timed("tts_cache"):
+        audio_bytes = audio_cache.get(key)
+    if audio_bytes is None:
+        with timed("tts"):
+            audio_bytes = tts_worker.synthesize(text, voice)
+        audio_cache.put(key, audio_bytes)
+    return audio_bytes
+
+
+async def generate_audio_bytes_async(text, voice=TTS_VOICE):
+    key = AudioCache.make_key(voice, text)
+    audio_bytes = audio_cache.get(key)
+    if audio_bytes is None:
+        start = time.perf_counter()
+        try:
+            audio_bytes = await tts_worker.synthesize_async(text, voice)
+        finally:
+            record_stage("tts", time.perf_counter() - start)
+        audio_cache.put(key, audio_bytes)
+    return audio_bytes
+
+
+def generate_audio_base64(text):
+    try:
+        audio_bytes = generate_audio_bytes(text)
+
+        # Ubah ke Base64 buat dikirim ke Unity
+        return base64.b64encode(audio_bytes).decode('utf-8')
+    except Exception as e:
+        print(f"⚠️ Error generate Neural TTS: {e}")
+        return ""
+
+# --- AUDIO BY REFERENCE (OPT-IN) ---
+# Client kirim audio_mode=url (query, JSON, atau form) -> respon isinya audio_id + audio_url,
+# audionya diambil lewat GET /audio/<audio_id> yang bisa di-cache client/CDN dan dukung Range.
+AUDIO_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def _wants_audio_url():
+    mode = request.args.get("audio_mode")
+    if not mode and request.is_json:
+        mode = (request.get_json(silent=True) or {}).get("audio_mode")
+    if not mode and request.form:
+        mode = request.form.get("audio_mode")
+    return str(mode or "").strip().lower() == "url"
+
+
+def build_audio_payload(text):
+    if not _wants_audio_url():
+        return {"audio_base64": generate_audio_base64(text) if text else ""}
 
-GEMINI_MODEL = "gemini-3.1-flash-lite"
+    if not text:
+        return {"audio_id": "", "audio_url": ""}
+    try:
+        audio_bytes = generate_audio_bytes(text)
+    except Exception as e:
+        print(f"⚠️ Error generate Neural TTS: {e}")
+        audio_bytes = b""
+    if not audio_bytes:
+        return {"audio_id": "", "audio_url": ""}
+    audio_id = AudioCache.make_key(TTS_VOICE, text)
+    return {"audio_id": audio_id, "audio_url": url_for("get_audio", audio_id=audio_id)}
 
-# --- INISIALISASI GEMINI ---
-client = None
-try:
-    client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-    print("✅ Koneksi Gemini API berhasil.")
-except Exception as e:
-    print(f"❌ Error Gemini API: {e}")
 
+def generate_audio_bytes_many(texts, voice=TTS_VOICE):
+    # Semua teks yang belum ada di cache dikirim barengan ke worker TTS (tetap dibatasi TTS_MAX_CONCURRENCY),
+    # jadi total waktunya kira-kira satu synthesis, bukan dijumlah satu-satu. Teks yang gagal gak ada di hasil.
+    results = {}
+    pending = {}
+    for text in dict.fromkeys(t for t in texts if t):
+        audio_bytes = audio_cache.get(AudioCache.make_key(voice, text))
+        if audio_bytes is not None:
+            results[text] = audio_bytes
+        else:
+            pending[text] = tts_worker.submit(text, voice)
+    if not pending:
+        return results
+    deadline = time.monotonic() + tts_worker.timeout + tts_worker.queue_timeout
+    with timed("tts"):
+        for text, future in pending.items():
+            try:
+                audio_bytes = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except Exception as e:
+                future.cancel()
+                print(f"⚠️ Error generate Neural TTS: {e}")
+                continue
+            audio_cache.put(AudioCache.make_key(voice, text), audio_bytes)
+            results[text] = audio_bytes
+    return results
 
-def call_gemini(contents, thinking_level="HIGH"):
-    config = types.GenerateContentConfig(
-        thinking_config=types.ThinkingConfig(thinking_level=thinking_level)
-    )
-    return client.models.generate_content(
-        model=GEMINI_MODEL,
-        contents=contents,
-        config=config,
-    )
 
+def build_audio_payloads(texts):
+    # Versi banyak-teks dari build_audio_payload(): teks -> payload audio.
+    as_url = _wants_audio_url()
+    audio = generate_audio_bytes_many(texts)
+    payloads = {}
+    for text in texts:
+        audio_bytes = audio.get(text, b"")
+        if not as_url:
+            payloads[text] = {"audio_base64": base64.b64encode(audio_bytes).decode('utf-8') if audio_bytes else ""}
+        elif audio_bytes:
+            audio_id = AudioCache.make_key(TTS_VOICE, text)
+            payloads[text] = {"audio_id": audio_id, "audio_url": url_for("get_audio", audio_id=audio_id)}
+        else:
+            payloads[text] = {"audio_id": "", "audio_url": ""}
+    return payloads
 
-def is_related_custom_question(object_name, question_text):
-    obj = str(object_name or "").strip().lower()
-    q = " ".join(str(question_text or "").strip().lower().split())
-    if not obj or not q:
-        return False
 
-    # Strong allow: explicit object mention.
-    if obj in q:
-        return True
+# --- STREAMING JAWABAN (SSE) + TTS PER KALIMAT ---
+# Teks dari Gemini dikirim sepotong-sepotong, dan tiap kalimat yang udah lengkap langsung
+# dikirim ke TTS. Jadi siswa udah bisa denger kalimat pertama sebelum Gemini selesai ngetik.
+STREAM_MIN_SENTENCE_CHARS = int(os.getenv("STREAM_MIN_SENTENCE_CHARS", "12"))
+STREAM_IDLE_TIMEOUT = float(os.getenv("STREAM_IDLE_TIMEOUT", "60"))
+SENTENCE_END_PATTERN = re.compile(r"[.!?]+[\"')\]]*\s+")
 
-    # Allow partial mention for multi-word objects, e.g. "remote" for "remote control".
-    obj_parts = [p for p in obj.replace("-", " ").split() if len(p) >= 4]
-    if any(part in q for part in obj_parts):
-        return True
 
-    intent_keywords = [
-        "shape", "color", "size", "material", "function", "use", "used", "price", "buy", "store", "where",
-        "bentuk", "warna", "ukuran", "bahan", "fungsi", "kegunaan", "harga", "beli", "toko", "dimana", "di mana"
-    ]
-    contextual_refs = ["it", "this", "that", "this object", "benda ini", "itu", "ini"]
-    if any(k in q for k in intent_keywords) and any(r in q for r in contextual_refs):
-        return True
+def split_complete_sentences(buffer):
+    # Kalimat yang kependekan (misal "B." di ejaan) digabung sama kalimat berikutnya.
+    sentences = []
+    start = 0
+    for match in SENTENCE_END_PATTERN.finditer(buffer):
+        candidate = buffer[start:match.end()].strip()
+        if len(candidate) >= STREAM_MIN_SENTENCE_CHARS:
+            sentences.append(candidate)
+            start = match.end()
+    return sentences, buffer[start:]
 
-    # Strong block for obvious out-of-topic world questions when object not mentioned.
-    off_topic = [
-        "president", "prime minister", "chancellor", "germany", "jerman", "celebrity", "actor", "football", "math",
-        "politik", "pemerintah", "negara", "ibukota", "capital city", "planet", "history", "sejarah"
-    ]
-    if any(k in q for k in off_topic):
-        return False
 
-    # Fallback semantic check with Gemini in bilingual mode.
-    classify_prompt = (
-        "You are a classifier.\n"
-        "Task: Decide if the user question is related to the scanned object.\n"
-        "Object: " + obj + "\n"
-        "Question: " + q + "\n"
-        "Rules:\n"
-        "- Related if asking attributes, function, usage, place to buy, care, parts, examples, spelling, or sentence about that object.\n"
-        "- Question can be in English or Indonesian.\n"
-        "- Unrelated if about politics, celebrities, random world facts, or another object.\n"
-        "Output exactly one word: RELATED or UNRELATED."
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _with_request_timing(events):
+    # Body SSE baru dialirkan setelah teardown request, jadi timing request-nya dipasang lagi selama
+    # generator jalan (biar tahap gemini_stream/tts tetap kecatat ke endpoint-nya, bukan "background").
+    timing = _request_timing.get()
+
+    def run():
+        token = _request_timing.set(timing)
+        try:
+            yield from events
+        finally:
+            _request_timing.reset(token)
+
+    return run()
+
+
+def sse_response(events):
+    return Response(
+        stream_with_context(_with_request_timing(events)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
-    try:
-        resp = call_gemini(contents=classify_prompt, thinking_level="HIGH")
-        label = (resp.text or "").strip().upper()
-        return label.startswith("RELATED")
-    except Exception:
-        return False
 
-KNOWLEDGE_BASE = {}
-try:
-    # Membaca file CSV saat server pertama kali nyala (biar enteng)
-    with open('Dataset_RAG_Englishv2.csv', mode='r', encoding='utf-8') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            # Ambil nama bahasa inggrisnya dan jadikan huruf kecil semua
-            nama_inggris = row['English Name'].strip().lower()
-            KNOWLEDGE_BASE[nama_inggris] = {
-                'deskripsi': row['Simple Description (Context for AI)'],
-                'kalimat_lks': row['Example Sentence (from LKS)'],
-                'qna_lks': row.get('Asking and Giving Information', '')
-            }
-    print(f"✅ RAG Berhasil dimuat: {len(KNOWLEDGE_BASE)} materi LKS siap digunakan.")
-except Exception as e:
-    print(f"⚠️ File materi_lks.csv tidak ditemukan atau error: {e}")
+def stream_answer_events(deltas, fallback_text, on_complete=None, on_error=None, voice=TTS_VOICE):
+    # Event yang dikirim ke client:
+    #   text      {"delta"}                  -> potongan teks dari Gemini
+    #   sentence  {"index", "text"}          -> kalimat lengkap yang lagi di-TTS
+    #   audio     {"index", "audio_base64"}  -> potongan MP3 kalimat ke-index (urut)
+    #   audio_end {"index"}                  -> audio kalimat ke-index selesai
+    #   done      {"status", "jawaban"}      -> semua selesai
+    #   error     {"status", "pesan"}
+    events = queue.Queue()
 
-# --- FUNGSI HELPER DATABASE ---
-# --- FUNGSI HELPER DATABASE (UPDATE BUAT NEON) ---
-def get_db_connection():
-    # Langsung tembak pakai DATABASE_URL dari .env
-    return psycopg2.connect(os.getenv("DATABASE_URL"))
+    def _start_tts(index, sentence):
+        events.put(("sentence", index, sentence))
+        key = AudioCache.make_key(voice, sentence)
+        cached = audio_cache.get(key)
+        if cached:
+            events.put(("audio", index, cached))
+            events.put(("audio_end", index, None))
+            return
+
+        def _on_done(future):
+            error = None
+            try:
+                audio_cache.put(key, future.result())
+            except Exception as e:
+                error = str(e) or e.__class__.__name__
+            events.put(("audio_end", index, error))
+
+        try:
+            future = tts_worker.submit(sentence, voice, on_chunk=lambda data: events.put(("audio", index, data)))
+        except Exception as e:
+            events.put(("audio_end", index, str(e)))
+            return
+        future.add_done_callback(_on_done)
+
+    def _produce():
+        parts = []
+        buffer = ""
+        count = 0
+        error = None
+        cacheable = True
+        try:
+            for delta in deltas:
+                if not delta:
+                    continue
+                parts.append(delta)
+                events.put(("text", delta))
+                sentences, buffer = split_complete_sentences(buffer + delta)
+                for sentence in sentences:
+                    _start_tts(count, sentence)
+                    count += 1
+        except Exception as e:
+            error = str(e)
+            # on_error (opsional) ngasih jawaban cadangan kalau Gemini gagal sebelum ngirim teks apa pun.
+            jawaban_darurat = on_error() if on_error is not None and not parts else None
+            if jawaban_darurat:
+                print(f"⚠️ Gemini gagal ({error}), pakai jawaban lokal.")
+                error = None
+                cacheable = False
+                parts = [jawaban_darurat]
+                buffer = jawaban_darurat
+                events.put(("text", jawaban_darurat))
+        full_text = "".join(parts).strip()
+        if not error and not full_text:
+            full_text = buffer = fallback_text
+            events.put(("text", fallback_text))
+        if not error and buffer.strip():
+            _start_tts(count, buffer.strip())
+            count += 1
+        events.put(("llm_end", full_text, count, error, cacheable))
+
+    def _generate():
+        threading.Thread(target=_produce, name="sse-producer", daemon=True).start()
+        buffered = {}
+        ended = {}
+        next_index = 0
+        total = None
+        full_text = ""
+        error = None
+        cacheable = False
+        while total is None or next_index < total:
+            try:
+                item = events.get(timeout=STREAM_IDLE_TIMEOUT)
+            except queue.Empty:
+                yield _sse("error", {"status": "gagal", "pesan": "Streaming timeout"})
+                return
+            kind = item[0]
+            if kind == "text":
+                yield _sse("text", {"delta": item[1]})
+            elif kind == "sentence":
+                yield _sse("sentence", {"index": item[1], "text": item[2]})
+            elif kind == "audio":
+                _, index, data = item
+                if index == next_index:
+                    yield _sse("audio", {"index": index, "audio_base64": base64.b64encode(data).decode('utf-8')})
+                else:
+                    buffered.setdefault(index, []).append(data)
+            elif kind == "audio_end":
+                ended[item[1]] = item[2]
+                # Audio harus diputar urut, jadi kalimat berikutnya baru dikirim setelah yang sekarang beres.
+                while next_index in ended:
+                    audio_error = ended.pop(next_index)
+                    yield _sse("audio_end", {"index": next_index, **({"pesan": audio_error} if audio_error else {})})
+                    next_index += 1
+                    for data in buffered.pop(next_index, []):
+                        yield _sse("audio", {"index": next_index, "audio_base64": base64.b64encode(data).decode('utf-8')})
+            elif kind == "llm_end":
+                _, full_text, total, error, cacheable = item
+
+        if error:
+            yield _sse("error", {"status": "gagal", "pesan": error})
+            return
+        yield _sse("done", {"status": "sukses", "jawaban": full_text})
+        if on_complete is not None and cacheable:
+            on_complete(full_text)
+
+    return _generate()
 
-# --- FUNGSI HELPER TTS KE BASE64 (BARU!) ---
-# --- FUNGSI HELPER TTS NEURAL (EDGE-TTS) ---
-def generate_audio_base64(text):
-    try:
-        # Pilihan Suara Guru: 
-        # "en-US-AriaNeural" (Cewek dewasa, ramah)
-        # "en-US-AnaNeural" (Cewek ceria, cocok buat anak kecil)
-        # "en-US-GuyNeural" (Cowok)
-        voice = "en-CA-ClaraNeural" 
-        
-        # Karena edge-tts itu asynchronous, kita bungkus pakai asyncio
-        async def _generate():
-            communicate = edge_tts.Communicate(text, voice)
-            audio_data = b""
-            async for chunk in communicate.stream():
-                if chunk["type"] == "audio":
-                    audio_data += chunk["data"]
-            return audio_data
-
-        # Jalankan dan tangkap hasil byte audio-nya
-        audio_bytes = asyncio.run(_generate())
-        
-        # Ubah ke Base64 buat dikirim ke Unity
-        return base64.b64encode(audio_bytes).decode('utf-8')
-    except Exception as e:
-        print(f"⚠️ Error generate Neural TTS: {e}")
-        return ""
 
 @app.route('/')
 def index():
     return "🚀 Backend AR Skripsi Nova Ready!"
 
+# --- ENDPOINT STATISTIK INTERNAL (POOL DB, DLL) ---
+def collect_stats():
+    return {
+        "db_pool": db_pool_stats(),
+        "tts_cache": audio_cache.stats(),
+        "tts_worker": tts_worker.stats(),
+        "write_behind": write_behind.stats(),
+        "local_answer": local_answer_stats(),
+        "object_cache": object_row_cache.stats(),
+        "object_resolver": resolver_stats(),
+        "relatedness": relatedness_stats(),
+        "model_router": model_router_stats(),
+        "gemini_gateway": gemini_gateway_stats(),
+        "image_hash_cache": image_hash_cache.stats(),
+        "quiz": quiz_stats(),
+        "quiz_cache": quiz_cache_stats(),
+        "tanya_batch": tanya_batch_stats(),
+        "prefetch": scan_prefetcher.stats(),
+        "object_list": object_list_snapshot.stats(),
+    }
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({"status": "sukses", **collect_stats()})
+
+
+def _flatten_stats(prefix, value):
+    # Angka-angka di /stats (hit/miss cache, antrean, dll.) ikut diekspor sebagai gauge.
+    if isinstance(value, bool):
+        yield prefix, int(value)
+    elif isinstance(value, (int, float)):
+        yield prefix, value
+    elif isinstance(value, dict):
+        for key, inner in value.items():
+            yield from _flatten_stats(f"{prefix}.{key}" if prefix else str(key), inner)
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    gauges = []
+    for component, values in collect_stats().items():
+        for stat, value in _flatten_stats("", values):
+            gauges.append(("ar_component_stat", {"component": component, "stat": stat}, value))
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+# --- ENDPOINT AMBIL AUDIO BY REFERENCE ---
+@app.route('/audio/<audio_id>', methods=['GET'])
+def get_audio(audio_id):
+    audio_id = audio_id.removesuffix(".mp3").lower()
+    if not AUDIO_ID_PATTERN.match(audio_id):
+        return jsonify({"status": "gagal", "pesan": "audio_id tidak valid"}), 400
+
+    audio_bytes = audio_cache.get(audio_id, record_stats=False)
+    if not audio_bytes:
+        return jsonify({"status": "gagal", "pesan": "Audio tidak ditemukan atau sudah kedaluwarsa"}), 404
+
+    # audio_id = hash isi (voice + teks), jadi isinya gak akan berubah -> aman di-cache selamanya.
+    response = Response(audio_bytes, mimetype="audio/mpeg")
+    response.set_etag(audio_id)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(audio_bytes))
+
 # --- 1. ENDPOINT TEXT-TO-SPEECH (Tetap dipertahankan) ---
 @app.route('/text-to-speech', methods=['POST'])
 def text_to_speech():
@@ -159,7 +2781,7 @@ def text_to_speech():
         return jsonify({"status": "gagal", "pesan": "Butuh parameter 'text'"}), 400
 
     try:
-        tts = gTTS(text=data['text'], lang='en', slow=False)
+        tts = gtts.gTTS(text=data['text'], lang='en', slow=False)
         mp3_fp = io.BytesIO()
         tts.write_to_fp(mp3_fp)
         mp3_fp.seek(0)
@@ -168,93 +2790,270 @@ def text_to_speech():
     except Exception as e:
         return jsonify({"status": "gagal", "pesan": str(e)}), 500
 
+# --- CACHE HASH PERSEPTUAL BUAT HASIL SCAN ---
+# Frame yang hampir sama (siswa scan ulang benda yang sama di marker yang sama) dikenali lewat dHash
+# 64-bit; kalau jarak Hamming-nya <= IMAGE_HASH_MAX_DISTANCE, nama benda langsung diambil dari cache.
+# Sebagian kecil hit (IMAGE_HASH_VERIFY_RATE) tetap dicek ke Gemini buat ngukur salah-cocok.
+IMAGE_HASH_ENABLED = os.getenv("IMAGE_HASH_ENABLED", "1") == "1"
+IMAGE_HASH_MAX_DISTANCE = int(os.getenv("IMAGE_HASH_MAX_DISTANCE", "6"))
+IMAGE_HASH_TTL = float(os.getenv("IMAGE_HASH_TTL", "300"))
+# Marker kosong ("unknown") cepat berubah jadi ada bendanya, jadi cache-nya dibikin pendek.
+IMAGE_HASH_UNKNOWN_TTL = float(os.getenv("IMAGE_HASH_UNKNOWN_TTL", "10"))
+IMAGE_HASH_MAX_ENTRIES = int(os.getenv("IMAGE_HASH_MAX_ENTRIES", "512"))
+IMAGE_HASH_VERIFY_RATE = float(os.getenv("IMAGE_HASH_VERIFY_RATE", "0.02"))
+
+
+def dhash_image(image, hash_size=8):
+    # Grayscale, kecilin ke (hash_size+1) x hash_size, lalu bandingin piksel kiri-kanan.
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+class ImageHashCache:
+    def __init__(self, max_entries, ttl, unknown_ttl, max_distance):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.unknown_ttl = unknown_ttl
+        self.max_distance = max_distance
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"lookups": 0, "hits": 0, "misses": 0, "verified": 0, "false_matches": 0, "distance_total": 0}
+
+    def lookup(self, image_hash):
+        now = time.monotonic()
+        best = None
+        with self._lock:
+            self._stats["lookups"] += 1
+            for key in [k for k, (_, expires) in self._entries.items() if expires <= now]:
+                del self._entries[key]
+            for key, (object_name, _) in self._entries.items():
+                distance = bin(key ^ image_hash).count("1")
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (key, distance, object_name)
+                    if distance == 0:
+                        break
+            if best is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(best[0])
+            self._stats["hits"] += 1
+            self._stats["distance_total"] += best[1]
+        return best[2]
+
+    def put(self, image_hash, object_name):
+        ttl = self.unknown_ttl if object_name == "unknown" else self.ttl
+        with self._lock:
+            self._entries[image_hash] = (object_name, time.monotonic() + ttl)
+            self._entries.move_to_end(image_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record_verification(self, cached_name, actual_name):
+        with self._lock:
+            self._stats["verified"] += 1
+            if cached_name != actual_name:
+                self._stats["false_matches"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries))
+        hits = stats.pop("distance_total")
+        stats["avg_hit_distance"] = round(hits / stats["hits"], 2) if stats["hits"] else 0.0
+        stats["hit_rate"] = round(stats["hits"] / stats["lookups"], 4) if stats["lookups"] else 0.0
+        stats["false_match_rate"] = round(stats["false_matches"] / stats["verified"], 4) if stats["verified"] else 0.0
+        stats["max_distance"] = self.max_distance
+        return stats
+
+
+image_hash_cache = ImageHashCache(IMAGE_HASH_MAX_ENTRIES, IMAGE_HASH_TTL, IMAGE_HASH_UNKNOWN_TTL, IMAGE_HASH_MAX_DISTANCE)
+
+
+IDENTIFIKASI_PROMPT = """
+        Kamu adalah API backend untuk sebuah aplikasi edukasi AR Bahasa Inggris.
+        Tugasmu adalah mengidentifikasi benda di kamar tidur atau ruang tamu.
+        Fokus HANYA pada objek yang diletakkan DI ATAS marker. 
+        Jika ada tulisan "taruh benda di sini" terlihat sangat jelas tanpa tertutup benda, jawab "unknown".
+        Abaikan background. Balas HANYA dengan nama objek dalam Bahasa Inggris (tunggal).
+        Contoh: 'book', 'lamp', 'eraser'. jika ada mascot guru dan papan tulis di gambar abaikan saja itu hanya 3d model virtual fokus identifikasi objek yang ada di atas marker aja.
+        dan jawab kata bendanya secara umum saja misalnya phone charger menjadi charger, dll"
+        """
+
+
+def _identified_name(response):
+    object_name = (response.text or "").strip().lower()
+    if object_name and object_name != "unknown":
+        object_name = resolve_object_name(object_name) or "unknown"
+    return object_name
+
+
+def lookup_scan_cache(image, refresh=False):
+    # Balikin (hash, nama dari cache, boleh langsung dipakai?). Hash None kalau cache dimatikan.
+    if not IMAGE_HASH_ENABLED:
+        return None, None, False
+    image_hash = dhash_image(image)
+    cached_name = image_hash_cache.lookup(image_hash)
+    # refresh=True (client minta scan ulang) = lewati cache, tapi hasilnya tetap dipakai buat ngukur salah-cocok.
+    serve = cached_name is not None and not refresh and random.random() >= IMAGE_HASH_VERIFY_RATE
+    if serve:
+        print(f"✅ Scan mirip frame sebelumnya, pakai cache: {cached_name}")
+    return image_hash, cached_name, serve
+
+
+def remember_scan(image_hash, cached_name, object_name):
+    if image_hash is None:
+        return
+    if cached_name is not None:
+        image_hash_cache.record_verification(cached_name, object_name)
+    if object_name:
+        image_hash_cache.put(image_hash, object_name)
+
+
+def identify_object(image, refresh=False):
+    image_hash, cached_name, serve = lookup_scan_cache(image, refresh)
+    if serve:
+        return cached_name
+    object_name = _identified_name(call_gemini(contents=[image, IDENTIFIKASI_PROMPT], task="identify"))
+    remember_scan(image_hash, cached_name, object_name)
+    return object_name
+
+
+async def identify_object_async(image, refresh=False):
+    image_hash, cached_name, serve = lookup_scan_cache(image, refresh)
+    if serve:
+        return cached_name
+    response = await call_gemini_async(contents=[image, IDENTIFIKASI_PROMPT], task="identify")
+    object_name = _identified_name(response)
+    remember_scan(image_hash, cached_name, object_name)
+    return object_name
+
+
 # --- 2. ENDPOINT IDENTIFIKASI OBJEK ---
+def _request_option(name):
+    # Opsi kecil dari query string, form, atau body JSON (huruf kecil, "" kalau gak ada).
+    value = request.values.get(name)
+    if value is None and request.is_json:
+        value = (request.get_json(silent=True) or {}).get(name)
+    return str(value if value is not None else "").strip().lower()
+
+
 @app.route('/identifikasi-objek', methods=['POST'])
 def identifikasi_objek():
     image = None
     if 'file' in request.files:
-        image = Image.open(request.files['file'].stream)
+        image = decode_image(request.files['file'].stream)
     elif request.is_json and 'image_base64' in request.get_json():
         image_data = base64.b64decode(request.get_json()['image_base64'])
-        image = Image.open(io.BytesIO(image_data))
+        image = decode_image(io.BytesIO(image_data))
     else:
         return jsonify({"status": "gagal", "pesan": "Kirim file gambar atau JSON image_base64"}), 400
 
     try:
-        prompt = """
-        Kamu adalah API backend untuk sebuah aplikasi edukasi AR Bahasa Inggris.
-        Tugasmu adalah mengidentifikasi benda di kamar tidur atau ruang tamu.
-        Fokus HANYA pada objek yang diletakkan DI ATAS marker. 
-        Jika ada tulisan "taruh benda di sini" terlihat sangat jelas tanpa tertutup benda, jawab "unknown".
-        Abaikan background. Balas HANYA dengan nama objek dalam Bahasa Inggris (tunggal).
-        Contoh: 'book', 'lamp', 'eraser'. jika ada mascot guru dan papan tulis di gambar abaikan saja itu hanya 3d model virtual fokus identifikasi objek yang ada di atas marker aja.
-        dan jawab kata bendanya secara umum saja misalnya phone charger menjadi charger, dll"
-        """
-        
-        response = call_gemini(contents=[image, prompt], thinking_level="HIGH")
-        object_name = (response.text or "").strip().lower()
+        object_name = identify_object(image, refresh=_request_option("refresh") in ("1", "true"))
 
-        audio_b64 = "" # Variabel kosong buat suara
+        audio_payload = build_audio_payload("") # Variabel kosong buat suara
 
         if object_name and object_name != "unknown":
+            write_behind.enqueue("insert_object", object_name)
+            note_object_inserted(object_name)
+            # Jawaban template, audionya & quiz disiapin di background selagi siswa baca hasil scan.
+            prefetch_after_scan(object_name, _request_option("prefetch"))
+
             # --- TAMBAHAN SUARA PAS SCAN ---
             # Si Guru bakal ngomong: "I see a book!"
-            audio_b64 = generate_audio_base64(f"I see a {object_name}")
-
-            try:
-                with closing(get_db_connection()) as conn:
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            "INSERT INTO objects (object_name) VALUES (%s) ON CONFLICT (object_name) DO NOTHING",
-                            (object_name,)
-                        )
-                        conn.commit()
-            except Exception as db_error:
-                print(f"⚠️ DB Error: {db_error}")
+            audio_payload = build_audio_payload(f"I see a {object_name}")
 
-        # Balikannya sekarang ada audio_base64
+        # Balikannya sekarang ada audio_base64 (atau audio_id/audio_url kalau audio_mode=url)
         return jsonify({
             "status": "sukses", 
             "object_name": object_name,
-            "audio_base64": audio_b64
+            **audio_payload
         })
 
     except Exception as e:
         return jsonify({"status": "gagal", "pesan": str(e)}), 500
 
 # --- 3. ENDPOINT Q&A TEMPLATE ---
-@app.route('/tanya-ai', methods=['POST'])
-def tanya_ai():
-    data = request.get_json()
-    if not data or 'object_name' not in data or 'question_key' not in data:
-        return jsonify({"status": "gagal", "pesan": "Data tidak lengkap"}), 400
+TANYA_AI_CACHE_KEYS = OBJECT_ANSWER_COLUMNS
+TANYA_AI_FALLBACK_ANSWER = "I only know basic info about this object."
+
+
+def _read_object_row_db(object_name):
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=pg_extras.RealDictCursor) as cur:
+            execute_prepared(cur, "select_object", (object_name,))
+            row = cur.fetchone()
+            return dict(row) if row else None
+
+
+def read_object_row(object_name):
+    # Lewat cache in-memory dulu, jadi jawaban yang udah ada gak perlu round trip ke Neon.
+    found, row = object_row_cache.get(object_name)
+    if found:
+        return dict(row) if row else None
+    return remember_object_row(object_name, _read_object_row_db(object_name))
+
+
+def remember_object_row(object_name, row):
+    if row:
+        object_row_cache.set(object_name, row)
+    else:
+        object_row_cache.set(object_name, None, ttl=OBJECT_CACHE_NEGATIVE_TTL)
+    return dict(row) if row else None
 
-    object_name = str(data['object_name']).strip().lower()
-    question_key = data['question_key']
-    custom_question = data.get('custom_question', '')
 
+def _read_cached_answer(object_name, question_key):
     # --- CEK CACHE DATABASE (HEMAT API GEMINI) ---
-    if question_key != "custom":
-        try:
-            with closing(get_db_connection()) as conn:
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute("SELECT * FROM objects WHERE object_name = %s", (object_name,))
-                    db_result = cur.fetchone()
-                    if db_result and question_key in db_result and db_result[question_key]:
-                        print(f"✅ BINGO! Jawaban {question_key} untuk {object_name} diambil dari DATABASE NEON!")
-                        audio_b64 = generate_audio_base64(db_result[question_key])
-                        return jsonify({"status": "sukses", "jawaban": db_result[question_key], "audio_base64": audio_b64})
-        except Exception as db_error:
-            print(f"⚠️ Gagal cek cache database: {db_error}")
+    try:
+        db_result = read_object_row(object_name)
+        if db_result and db_result.get(question_key):
+            print(f"✅ BINGO! Jawaban {question_key} untuk {object_name} diambil dari CACHE DATABASE!")
+            return db_result[question_key]
+    except Exception as db_error:
+        print(f"⚠️ Gagal cek cache database: {db_error}")
+    return None
+
+
+def _save_cached_answer(object_name, question_key, jawaban_ai):
+    # Disimpan lewat write-behind, jadi respon gak nunggu UPDATE ke Neon.
+    write_behind.enqueue("update_object", object_name, question_key, jawaban_ai)
+    # Write-through: cache in-memory langsung ikut di-update (UPDATE di DB gak ngapa-ngapain
+    # kalau barisnya belum ada, jadi entry negatif dibiarin).
+    object_row_cache.update(object_name, lambda row: {**row, question_key: jawaban_ai} if row else row)
+
+
+def prepare_tanya_ai(object_name, question_key, custom_question=""):
+    # Hasilnya salah satu dari:
+    #   ("jawaban", teks)        -> jawaban udah ada (cache DB / pertanyaan diblokir)
+    #   ("prompt", prompt)       -> perlu dijawab Gemini pakai prompt ini
+    #   ("gagal", (pesan, kode)) -> request-nya salah
+    if question_key == "custom" and not custom_question:
+        return "gagal", ("Pertanyaan manual kosong", 400)
+
+    # --- 0. JAWABAN LOKAL DARI DATASET (GAK PERLU DB / GEMINI) ---
+    jawaban_lokal = local_answer(object_name, question_key, custom_question)
+    if jawaban_lokal:
+        print(f"⚡ Jawaban {question_key} untuk {object_name} dijawab lokal dari dataset.")
+        return "jawaban", jawaban_lokal
+
+    if question_key in TANYA_AI_CACHE_KEYS:
+        cached_answer = _read_cached_answer(object_name, question_key)
+        if cached_answer:
+            return "jawaban", cached_answer
 
     # --- 2. SIAPKAN PROMPT GEMINI ---
     print(f"🤖 Memanggil AI Gemini untuk menjawab {question_key} dari {object_name}...")
+    return build_tanya_prompt(object_name, question_key, custom_question)
 
-    # --- 2. SIAPKAN PROMPT / JAWABAN ---
-    prompt = ""
-    jawaban_ai = ""
 
-# --- CEK APAKAH BENDA ADA DI BUKU LKS (RAG SYSTEM) ---
+def build_tanya_prompt(object_name, question_key, custom_question=""):
+    # Sama kayak prepare_tanya_ai tapi tanpa cek cache DB.
+    # --- CEK APAKAH BENDA ADA DI BUKU LKS (RAG SYSTEM) ---
     data_lks = None
     if object_name in KNOWLEDGE_BASE:
         data_lks = KNOWLEDGE_BASE[object_name]
@@ -270,14 +3069,12 @@ def tanya_ai():
 
     if question_key == "custom":
         if not custom_question:
-            return jsonify({"status": "gagal", "pesan": "Pertanyaan manual kosong"}), 400
+            return "gagal", ("Pertanyaan manual kosong", 400)
 
         if not is_related_custom_question(object_name, custom_question):
-            blocked_answer = f"Sorry, I can only answer questions about {object_name}."
-            audio_b64 = generate_audio_base64(blocked_answer)
-            return jsonify({"status": "sukses", "jawaban": blocked_answer, "audio_base64": audio_b64})
+            return "jawaban", f"Sorry, I can only answer questions about {object_name}."
         
-        context_str = f"Fact about {object_name}: {data_lks['deskripsi']}\n" if data_lks else ""
+        context_str = build_rag_context(object_name, custom_question)
         
         prompt = (f"{base_instruction}"
                   f"4. The student question is already confirmed related to '{object_name}'.\n"
@@ -340,81 +3137,514 @@ def tanya_ai():
             f"Separate each letter with a period. Example for 'BOOK': B. O. O. K."
         )
     else:
-        return jsonify({"status": "gagal", "pesan": "Kunci pertanyaan salah"}), 400
+        return "gagal", ("Kunci pertanyaan salah", 400)
+
+    return "prompt", prompt
+
+
+
+def tanya_task(question_key):
+    # Jenis tugas buat model router (lihat DEFAULT_MODEL_ROUTES).
+    if question_key == "ejaan":
+        return "spelling"
+    if question_key == "custom":
+        return "custom_answer"
+    return "answer"
+
+
+def generate_template_answer(object_name, question_key):
+    # Dipakai warmup: jawaban lokal kalau ada, kalau gak langsung minta Gemini tanpa cek cache DB.
+    jawaban_lokal = local_answer(object_name, question_key)
+    if jawaban_lokal:
+        return jawaban_lokal
+    kind, value = build_tanya_prompt(object_name, question_key)
+    if kind != "prompt":
+        return value if kind == "jawaban" else None
+    response = call_gemini(contents=value, task=tanya_task(question_key))
+    return (response.text or "").strip() or TANYA_AI_FALLBACK_ANSWER
+
+
+@app.route('/tanya-ai', methods=['POST'])
+def tanya_ai():
+    data = request.get_json()
+    if not data or 'object_name' not in data or 'question_key' not in data:
+        return jsonify({"status": "gagal", "pesan": "Data tidak lengkap"}), 400
+
+    object_name = resolve_object_name(data['object_name'])
+    if not object_name:
+        return jsonify({"status": "gagal", "pesan": "Nama objek tidak valid"}), 400
+    question_key = data['question_key']
+    custom_question = data.get('custom_question', '')
+
+    kind, value = prepare_tanya_ai(object_name, question_key, custom_question)
+    if kind == "gagal":
+        pesan, status_code = value
+        return jsonify({"status": "gagal", "pesan": pesan}), status_code
+    if kind == "jawaban":
+        audio_payload = build_audio_payload(value)
+        return jsonify({"status": "sukses", "jawaban": value, **audio_payload})
 
     try:
-        if not jawaban_ai:
-            response = call_gemini(contents=prompt, thinking_level="HIGH")
-            jawaban_ai = (response.text or "").strip()
+        try:
+            response = call_gemini(contents=value, task=tanya_task(question_key))
+        except Exception as gemini_error:
+            # Mode darurat: Gemini error / kena limit, coba jawab dari dataset.
+            jawaban_darurat = local_answer(object_name, question_key, custom_question, degraded=True)
+            if not jawaban_darurat:
+                raise
+            print(f"⚠️ Gemini gagal ({gemini_error}), pakai jawaban lokal untuk {object_name}.")
+            audio_payload = build_audio_payload(jawaban_darurat)
+            return jsonify({"status": "sukses", "jawaban": jawaban_darurat, **audio_payload})
+
+        jawaban_ai = (response.text or "").strip()
 
         if not jawaban_ai:
-            jawaban_ai = "I only know basic info about this object."
+            jawaban_ai = TANYA_AI_FALLBACK_ANSWER
 
         # --- TAMBAHAN SUARA JAWABAN GEMINI ---
-        audio_b64 = generate_audio_base64(jawaban_ai)
+        audio_payload = build_audio_payload(jawaban_ai)
 
-        if question_key != "custom":
-            try:
-                with closing(get_db_connection()) as conn:
-                    with conn.cursor() as cur:
-                        if question_key in ["definisi", "fungsi", "ejaan", "kalimat"]:
-                            sql = f"UPDATE objects SET {question_key} = %s WHERE object_name = %s"
-                            cur.execute(sql, (jawaban_ai, object_name))
-                            conn.commit()
-            except Exception as db_error:
-                print(f"⚠️ Gagal simpan ke cache: {db_error}")
+        if question_key in TANYA_AI_CACHE_KEYS:
+            _save_cached_answer(object_name, question_key, jawaban_ai)
 
         # Balikannya sekarang ada audio_base64
-        return jsonify({"status": "sukses", "jawaban": jawaban_ai, "audio_base64": audio_b64})
+        return jsonify({"status": "sukses", "jawaban": jawaban_ai, **audio_payload})
+
+    except Exception as e:
+        return jsonify({"status": "gagal", "pesan": str(e)}), 500
+
+
+@app.route('/tanya-ai/stream', methods=['POST'])
+def tanya_ai_stream():
+    data = request.get_json()
+    if not data or 'object_name' not in data or 'question_key' not in data:
+        return jsonify({"status": "gagal", "pesan": "Data tidak lengkap"}), 400
+
+    object_name = resolve_object_name(data['object_name'])
+    if not object_name:
+        return jsonify({"status": "gagal", "pesan": "Nama objek tidak valid"}), 400
+    question_key = data['question_key']
+    custom_question = data.get('custom_question', '')
+
+    kind, value = prepare_tanya_ai(object_name, question_key, custom_question)
+    if kind == "gagal":
+        pesan, status_code = value
+        return jsonify({"status": "gagal", "pesan": pesan}), status_code
+
+    on_complete = None
+    if question_key in TANYA_AI_CACHE_KEYS:
+        on_complete = lambda jawaban: _save_cached_answer(object_name, question_key, jawaban)
+
+    if kind == "jawaban":
+        return sse_response(stream_answer_events(iter([value]), TANYA_AI_FALLBACK_ANSWER))
+    deltas = call_gemini_stream(contents=value, task=tanya_task(question_key))
+    return sse_response(stream_answer_events(
+        deltas,
+        TANYA_AI_FALLBACK_ANSWER,
+        on_complete=on_complete,
+        on_error=lambda: local_answer(object_name, question_key, custom_question, degraded=True),
+    ))
+
+
+# --- 3B. ENDPOINT Q&A TEMPLATE SEKALIGUS (BATCH) ---
+# Unity biasanya langsung minta definisi, fungsi, kalimat & ejaan sekaligus setelah scan.
+# Di sini cukup 1 request: 1 baca baris objects, 1 panggilan Gemini (jawaban yang kurang diminta
+# barengan dalam 1 JSON), dan TTS semua jawaban jalan paralel.
+_tanya_batch_stats = {
+    "requests": 0,
+    "keys": 0,
+    "local": 0,
+    "cached": 0,
+    "batched_calls": 0,
+    "batched_answers": 0,
+    "single_calls": 0,
+    "degraded": 0,
+    "rate_limited": 0,
+    "failed": 0,
+}
+_tanya_batch_lock = threading.Lock()
+
+
+def _count_tanya_batch(key, amount=1):
+    with _tanya_batch_lock:
+        _tanya_batch_stats[key] += amount
+
+
+def tanya_batch_stats():
+    with _tanya_batch_lock:
+        return dict(_tanya_batch_stats)
+
+
+def build_batch_tanya_prompt(object_name, prompts):
+    # prompts: question_key -> prompt satuan dari build_tanya_prompt(); aturan tiap tugas tetap dipakai apa adanya.
+    sections = "\n\n".join(f"### TASK \"{key}\"\n{prompt}" for key, prompt in prompts.items())
+    return (
+        f"You will answer {len(prompts)} separate tasks about the same object '{object_name}'.\n"
+        f"Follow the rules inside each task for that task's answer only.\n"
+        f"STRICT OUTPUT FORMAT: Return ONLY a raw JSON object with exactly these keys: {json.dumps(list(prompts))}.\n"
+        f"Each value is the final answer text for that task. Do not use Markdown blocks (```json).\n\n"
+        f"{sections}\n"
+    )
+
+
+def _parse_batch_answers(raw_text, question_keys):
+    raw_text = (raw_text or "").strip()
+    if raw_text.startswith("```"):
+        raw_text = raw_text.replace("```json", "").replace("```", "").strip()
+    data = json.loads(raw_text)
+    if not isinstance(data, dict):
+        return {}
+    answers = {}
+    for key in question_keys:
+        value = data.get(key)
+        if isinstance(value, str) and value.strip():
+            answers[key] = value.strip()
+    return answers
+
+
+def _degraded_answer(object_name, question_key, gemini_error):
+    jawaban_darurat = local_answer(object_name, question_key, degraded=True)
+    if not jawaban_darurat:
+        print(f"⚠️ Gemini gagal jawab {question_key} untuk {object_name}: {gemini_error}")
+        return None
+    _count_tanya_batch("degraded")
+    return jawaban_darurat
+
+
+def _answer_single(object_name, question_key, prompt):
+    # Cadangan kalau jawaban satu kunci gak ada di respon batch (atau cuma 1 kunci yang kurang).
+    # Balikin (jawaban, boleh disimpan, error rate limit kalau kena).
+    _count_tanya_batch("single_calls")
+    try:
+        response = call_gemini(contents=prompt, task=tanya_task(question_key))
+        return (response.text or "").strip() or TANYA_AI_FALLBACK_ANSWER, True, None
+    except Exception as gemini_error:
+        rate_limit_error = gemini_error if is_rate_limit_error(gemini_error) else None
+        return _degraded_answer(object_name, question_key, gemini_error), False, rate_limit_error
+
 
+def answer_template_batch(object_name, question_keys, allow_gemini=True):
+    # Balikin question_key -> jawaban (None kalau gagal total). allow_gemini=False (dipakai prefetch pas
+    # limit lagi tipis): cuma jawaban lokal & cache, yang belum ada gak ikut di hasil.
+    answers = {}
+    missing = []
+    for key in question_keys:
+        jawaban_lokal = local_answer(object_name, key)
+        if jawaban_lokal:
+            answers[key] = jawaban_lokal
+            _count_tanya_batch("local")
+        else:
+            missing.append(key)
+
+    if missing:
+        # Satu baca baris objects buat semua kolom (lewat cache in-memory juga).
+        try:
+            row = read_object_row(object_name) or {}
+        except Exception as db_error:
+            print(f"⚠️ Gagal cek cache database: {db_error}")
+            row = {}
+        cached = [key for key in missing if row.get(key)]
+        for key in cached:
+            answers[key] = row[key]
+        _count_tanya_batch("cached", len(cached))
+        missing = [key for key in missing if key not in cached]
+        if cached:
+            print(f"✅ BINGO! Jawaban {', '.join(cached)} untuk {object_name} diambil dari CACHE DATABASE!")
+
+    if not missing or not allow_gemini:
+        return answers
+
+    prompts = {}
+    for key in missing:
+        kind, value = build_tanya_prompt(object_name, key)
+        if kind == "prompt":
+            prompts[key] = value
+        else:
+            answers[key] = value if kind == "jawaban" else None
+
+    generated = {}
+    rate_limit_error = None
+    if len(prompts) > 1:
+        print(f"🤖 Memanggil AI Gemini untuk menjawab {', '.join(prompts)} dari {object_name} sekaligus...")
+        _count_tanya_batch("batched_calls")
+        try:
+            response = call_gemini(contents=build_batch_tanya_prompt(object_name, prompts), task="answer")
+            generated = _parse_batch_answers(response.text, list(prompts))
+        except Exception as e:
+            if is_rate_limit_error(e):
+                # Kena limit: jangan dipecah jadi N panggilan lagi, langsung jawaban darurat dari dataset.
+                rate_limit_error = e
+                print(f"⚠️ Jawaban batch {object_name} kena rate limit ({e}), pakai jawaban lokal.")
+            else:
+                print(f"⚠️ Jawaban batch {object_name} gagal ({e}), lanjut satu-satu.")
+        _count_tanya_batch("batched_answers", len(generated))
+
+    for key, prompt in prompts.items():
+        cacheable = key in generated
+        if not cacheable and rate_limit_error is not None:
+            _count_tanya_batch("rate_limited")
+            generated[key] = _degraded_answer(object_name, key, rate_limit_error)
+        elif not cacheable:
+            # Satu panggilan kena limit -> kunci sisanya juga langsung jawaban lokal.
+            generated[key], cacheable, rate_limit_error = _answer_single(object_name, key, prompt)
+        answers[key] = generated[key]
+        # Jawaban darurat dari dataset gak disimpan, biar nanti tetap dicoba ke Gemini.
+        if cacheable and generated[key]:
+            _save_cached_answer(object_name, key, generated[key])
+    return answers
+
+
+@app.route('/tanya-ai/batch', methods=['POST'])
+def tanya_ai_batch():
+    data = request.get_json(silent=True)
+    if not data or 'object_name' not in data:
+        return jsonify({"status": "gagal", "pesan": "Data tidak lengkap"}), 400
+
+    question_keys = data.get('question_keys') or list(TANYA_AI_CACHE_KEYS)
+    if not isinstance(question_keys, list) or any(key not in TANYA_AI_CACHE_KEYS for key in question_keys):
+        return jsonify({
+            "status": "gagal",
+            "pesan": f"question_keys cuma boleh berisi: {', '.join(TANYA_AI_CACHE_KEYS)}",
+        }), 400
+    question_keys = list(dict.fromkeys(question_keys))
+    object_name = resolve_object_name(data['object_name'])
+    if not object_name:
+        return jsonify({"status": "gagal", "pesan": "Nama objek tidak valid"}), 400
+
+    try:
+        answers = answer_template_batch(object_name, question_keys)
+        audio_payloads = build_audio_payloads([text for text in answers.values() if text])
     except Exception as e:
         return jsonify({"status": "gagal", "pesan": str(e)}), 500
 
+    _count_tanya_batch("requests")
+    _count_tanya_batch("keys", len(question_keys))
+    hasil = []
+    for key in question_keys:
+        jawaban = answers.get(key)
+        if jawaban:
+            hasil.append({"question_key": key, "status": "sukses", "jawaban": jawaban, **audio_payloads[jawaban]})
+        else:
+            _count_tanya_batch("failed")
+            hasil.append({"question_key": key, "status": "gagal", "pesan": "AI gagal menjawab, coba lagi."})
+
+    if not any(item["status"] == "sukses" for item in hasil):
+        return jsonify({"status": "gagal", "pesan": "AI gagal menjawab semua pertanyaan.", "hasil": hasil}), 500
+    return jsonify({"status": "sukses", "object_name": object_name, "hasil": hasil})
+
+
 # --- 4. ENDPOINT TANYA MANUAL GAMBAR ---
+TANYA_GAMBAR_FALLBACK_ANSWER = "Sorry, I don't know how to answer that."
+
+
+def _build_gambar_manual_prompt(question_text):
+    return f"""
+        Lihat gambar ini. Jawab pertanyaan siswa: "{question_text}"
+        Jawab dengan Bahasa Inggris yang SANGAT SINGKAT (cocok untuk anak 10 tahun).
+        Jangan menyapa, langsung jawabannya. Use simple words. Add commas (,) frequently to create natural reading pauses."
+        """
+
+
 @app.route('/tanya-gambar-manual', methods=['POST'])
 def tanya_gambar_manual():
     if 'image_file' not in request.files or 'question_text' not in request.form:
         return jsonify({"status": "gagal", "pesan": "Kirim file gambar dan teks pertanyaan"}), 400
 
     try:
-        image = Image.open(request.files['image_file'].stream)
+        image = decode_image(request.files['image_file'].stream)
         question_text = request.form['question_text']
         
-        prompt = f"""
-        Lihat gambar ini. Jawab pertanyaan siswa: "{question_text}"
-        Jawab dengan Bahasa Inggris yang SANGAT SINGKAT (cocok untuk anak 10 tahun).
-        Jangan menyapa, langsung jawabannya. Use simple words. Add commas (,) frequently to create natural reading pauses."
-        """
-        response = call_gemini(contents=[image, prompt], thinking_level="HIGH")
+        prompt = _build_gambar_manual_prompt(question_text)
+        response = call_gemini(contents=[image, prompt], task="image_qa")
         jawaban_ai_text = (response.text or "").strip()
 
         if not jawaban_ai_text:
-            jawaban_ai_text = "Sorry, I don't know how to answer that."
+            jawaban_ai_text = TANYA_GAMBAR_FALLBACK_ANSWER
 
         # --- TAMBAHAN SUARA BUAT GAMBAR MANUAL ---
-        audio_b64 = generate_audio_base64(jawaban_ai_text)
+        audio_payload = build_audio_payload(jawaban_ai_text)
 
         # Balikannya sekarang ada audio_base64
-        return jsonify({"status": "sukses", "jawaban": jawaban_ai_text, "audio_base64": audio_b64})
+        return jsonify({"status": "sukses", "jawaban": jawaban_ai_text, **audio_payload})
 
     except Exception as e:
         return jsonify({"status": "gagal", "pesan": str(e)}), 500
 
+
+@app.route('/tanya-gambar-manual/stream', methods=['POST'])
+def tanya_gambar_manual_stream():
+    if 'image_file' not in request.files or 'question_text' not in request.form:
+        return jsonify({"status": "gagal", "pesan": "Kirim file gambar dan teks pertanyaan"}), 400
+
+    try:
+        image = decode_image(request.files['image_file'].stream)
+        image.load()
+    except Exception as e:
+        return jsonify({"status": "gagal", "pesan": str(e)}), 400
+
+    prompt = _build_gambar_manual_prompt(request.form['question_text'])
+    deltas = call_gemini_stream(contents=[image, prompt], task="image_qa")
+    return sse_response(stream_answer_events(deltas, TANYA_GAMBAR_FALLBACK_ANSWER))
+
 # --- 1. API UNTUK AMBIL DAFTAR BENDA (BUAT MENU QUIZ) ---
+# --- DAFTAR OBJEK (SNAPSHOT IN-MEMORY) ---
+# Daftar nama benda cuma berubah kalau ada objek baru di-scan, jadi disimpan di memori: INSERT dari
+# proses ini langsung nambahin snapshot, dan snapshot dibaca ulang dari DB tiap OBJECT_LIST_TTL detik
+# buat nangkep INSERT dari worker lain. Versinya = hash isi daftar, jadi sama di semua worker dan bisa
+# dipakai jadi ETag (If-None-Match -> 304).
+OBJECT_LIST_TTL = float(os.getenv("OBJECT_LIST_TTL", "60"))
+OBJECT_LIST_MAX_LIMIT = int(os.getenv("OBJECT_LIST_MAX_LIMIT", "500"))
+
+
+def _normalize_category(text):
+    return " ".join(re.sub(r"[-_]+", " ", str(text or "")).lower().split())
+
+
+class ObjectListSnapshot:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._names = None
+        self._by_category = {}
+        self._version = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stats = {"served": 0, "not_modified": 0, "refreshes": 0, "refresh_failed": 0, "inserts_applied": 0}
+
+    def record(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _publish(self, names):
+        # Dipanggil dengan self._lock dipegang.
+        self._names = sorted(names)
+        by_category = {}
+        for name in self._names:
+            # Benda yang ada di dua ruangan (table, door, ...) masuk ke dua-duanya.
+            for kategori in object_categories(name):
+                by_category.setdefault(_normalize_category(kategori), []).append(name)
+        self._by_category = by_category
+        self._version = hashlib.sha256("\n".join(self._names).encode("utf-8")).hexdigest()[:16]
+
+    def _load_from_db(self):
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                # Ambil semua nama benda yang pernah di-scan
+                execute_prepared(cur, "select_object_names")
+                return [row[0] for row in cur.fetchall()]
+
+    def current(self):
+        # Balikin (versi, daftar nama urut, daftar per kategori). Kalau DB gagal tapi masih ada
+        # snapshot lama, yang lama dipakai; kalau belum pernah ke-load, error-nya diterusin.
+        with self._lock:
+            fresh = self._names is not None and time.monotonic() - self._loaded_at < self.ttl
+            if fresh:
+                return self._version, self._names, self._by_category
+        with self._refresh_lock:
+            with self._lock:
+                if self._names is not None and time.monotonic() - self._loaded_at < self.ttl:
+                    return self._version, self._names, self._by_category
+            try:
+                names = self._load_from_db()
+            except Exception as e:
+                self.record("refresh_failed")
+                with self._lock:
+                    if self._names is None:
+                        raise
+                    print(f"⚠️ Gagal refresh daftar objek, pakai snapshot lama: {e}")
+                    # Coba lagi nanti, jangan tiap request.
+                    self._loaded_at = time.monotonic()
+                    return self._version, self._names, self._by_category
+            with self._lock:
+                self._publish(names)
+                self._loaded_at = time.monotonic()
+                self._stats["refreshes"] += 1
+                return self._version, self._names, self._by_category
+
+    def note_inserted(self, object_name):
+        with self._lock:
+            if self._names is None or not object_name or object_name in self._names:
+                return
+            self._publish(self._names + [object_name])
+            self._stats["inserts_applied"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                "loaded": self._names is not None,
+                "objects": len(self._names or ()),
+                "version": self._version,
+            }
+
+
+object_list_snapshot = ObjectListSnapshot(OBJECT_LIST_TTL)
+
+
+def _encode_list_cursor(name):
+    return base64.urlsafe_b64encode(name.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_list_cursor(cursor):
+    padded = cursor + "=" * (-len(cursor) % 4)
+    return base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8")
+
+
 @app.route('/list-objects', methods=['GET'])
 def list_objects():
+    # Query opsional: category (Bedroom / Living Room), limit, cursor (dari next_cursor halaman sebelumnya).
+    # Tanpa parameter hasilnya sama kayak dulu: semua objek.
     try:
-        with closing(get_db_connection()) as conn:
-            with conn.cursor() as cur:
-                # Ambil semua nama benda yang pernah di-scan
-                cur.execute("SELECT DISTINCT object_name FROM objects")
-                rows = cur.fetchall()
-                # Ubah jadi list simple
-                object_list = [row[0] for row in rows] 
-                return jsonify({"status": "sukses", "objects": object_list})
+        version, names, by_category = object_list_snapshot.current()
     except Exception as e:
         return jsonify({"status": "gagal", "pesan": str(e)}), 500
 
+    if request.if_none_match.contains(version):
+        object_list_snapshot.record("not_modified")
+        response = Response(status=304)
+        response.set_etag(version)
+        return response
+
+    category = _normalize_category(request.args.get("category"))
+    if category:
+        kategori_list = sorted({kategori for name in KNOWLEDGE_BASE for kategori in object_categories(name)})
+        if category not in {_normalize_category(kategori) for kategori in kategori_list}:
+            return jsonify({"status": "gagal", "pesan": f"Kategori cuma boleh: {', '.join(kategori_list)}"}), 400
+        names = by_category.get(category, [])
+
+    start = 0
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            start = bisect.bisect_right(names, _decode_list_cursor(cursor))
+        except Exception:
+            return jsonify({"status": "gagal", "pesan": "cursor tidak valid"}), 400
+
+    limit = request.args.get("limit")
+    if limit:
+        try:
+            limit = max(1, min(int(limit), OBJECT_LIST_MAX_LIMIT))
+        except ValueError:
+            return jsonify({"status": "gagal", "pesan": "limit harus angka"}), 400
+        page = names[start:start + limit]
+        next_cursor = _encode_list_cursor(page[-1]) if page and start + limit < len(names) else None
+    else:
+        page = names[start:]
+        next_cursor = None
+
+    object_list_snapshot.record("served")
+    response = jsonify({
+        "status": "sukses",
+        "objects": page,
+        "next_cursor": next_cursor,
+        "total": len(names),
+        "version": version,
+    })
+    response.set_etag(version)
+    # Client boleh simpan, tapi wajib tanya ulang (If-None-Match) tiap kali mau pakai.
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
 # --- 5. ENDPOINT KHUSUS BUAT BACAIN SOAL KUIS ---
 @app.route('/tts-soal', methods=['POST'])
 def tts_soal():
@@ -426,41 +3656,36 @@ def tts_soal():
     print(f"🔊 Generate Voice Soal: {text}")
     
     # Langsung pakai fungsi helper Edge-TTS yang udah ada di kodemu!
-    audio_b64 = generate_audio_base64(text)
+    audio_payload = build_audio_payload(text)
 
-    if audio_b64:
-        return jsonify({"status": "sukses", "audio_base64": audio_b64})
+    if any(audio_payload.values()):
+        return jsonify({"status": "sukses", **audio_payload})
     else:
         return jsonify({"status": "gagal", "pesan": "Gagal generate audio"}), 500
 
 # --- 2. API UNTUK GENERATE / AMBIL SOAL QUIZ ---
-@app.route('/generate-quiz', methods=['POST'])
-def generate_quiz():
-    data = request.get_json()
-    if not data or 'object_name' not in data:
-        return jsonify({"status": "gagal", "pesan": "Data tidak lengkap"}), 400
+QUIZ_MAX_ATTEMPTS = 5
+# Berapa kandidat quiz diminta barengan per putaran; yang pertama lolos validasi yang dipakai.
+# Tetap dibatasi sisa kuota token bucket & QUIZ_MAX_ATTEMPTS. 1 = mode lama (satu-satu).
+QUIZ_SPECULATIVE_CANDIDATES = int(os.getenv("QUIZ_SPECULATIVE_CANDIDATES", "3"))
+QUIZ_EXECUTOR_WORKERS = int(os.getenv("QUIZ_EXECUTOR_WORKERS", "16"))
 
-    object_name = str(data['object_name']).strip().lower()
-    force_regenerate = bool(data.get('force_regenerate', False))
-    cached_quiz = None
+QUIZ_AMBIGUOUS_OPTION_GROUPS = [
+    {"pen", "pencil", "marker", "crayon", "chalk"},
+    {"book", "notebook"},
+    {"sofa", "couch"},
+    {"phone", "smartphone", "mobile phone", "cell phone"},
+    {"cup", "mug", "glass"},
+]
 
-    # A. CEK DATABASE DULU (SIAPA TAU UDAH PERNAH DIBIKIN)
-    if not force_regenerate:
-        try:
-            with closing(get_db_connection()) as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT questions_json FROM quizzes WHERE object_name = %s", (object_name,))
-                    result = cur.fetchone()
-
-                    if result:
-                        try:
-                            cached_quiz = json.loads(result[0])
-                        except Exception:
-                            cached_quiz = None
-                            print(f"⚠️ Cache quiz untuk {object_name} rusak, akan regenerate.")
-        except Exception as e:
-            print(f"⚠️ Gagal cek cache database quiz: {e}")
+QUIZ_OFF_TOPIC_KEYWORDS = [
+    "president", "prime minister", "germany", "jerman", "planet", "history", "sejarah",
+    "celebrity", "football", "chancellor", "capital city", "politik", "pemerintah"
+]
 
+
+def _build_quiz_prompt(object_name, excluded_questions=None, variant=0, count=10, min_blank=2, min_translation=1):
+    # Default-nya minta 1 quiz utuh (10 soal); kalau bank soal udah sebagian isi, cukup minta kekurangannya.
     rag_data = KNOWLEDGE_BASE.get(object_name)
     rag_context = ""
     if rag_data:
@@ -470,248 +3695,743 @@ def generate_quiz():
             f"RAG Fact - QnA: {rag_data.get('qna_lks', '')}\n"
         )
 
-    ambiguous_option_groups = [
-        {"pen", "pencil", "marker", "crayon", "chalk"},
-        {"book", "notebook"},
-        {"sofa", "couch"},
-        {"phone", "smartphone", "mobile phone", "cell phone"},
-        {"cup", "mug", "glass"},
-    ]
+    blank_rule = f"Include at least {min_blank} sentence-completion questions" if min_blank else "Sentence-completion questions are optional"
+    translation_rule = f"Include at least {min_translation} translation question" if min_translation else "Translation questions are optional"
 
-    off_topic_keywords = [
-        "president", "prime minister", "germany", "jerman", "planet", "history", "sejarah",
-        "celebrity", "football", "chancellor", "capital city", "politik", "pemerintah"
-    ]
+    excluded_questions = excluded_questions or []
+    # Kandidat paralel dibedain biar gak digabung gateway & hasilnya gak kembar.
+    variant_line = ""
+    if variant:
+        variant_line = f"Variation #{variant}: use a different mix of question types and wording than usual.\n"
+    excluded_block = ""
+    if excluded_questions:
+        excluded_block = (
+            "Do not generate any of these question texts again:\n"
+            + "\n".join([f"- {q}" for q in excluded_questions])
+            + "\n"
+        )
 
-    def _build_quiz_prompt(excluded_questions=None):
-        excluded_questions = excluded_questions or []
-        excluded_block = ""
-        if excluded_questions:
-            excluded_block = (
-                "Do not generate any of these question texts again:\n"
-                + "\n".join([f"- {q}" for q in excluded_questions])
-                + "\n"
-            )
+    rag_rules = ""
+    if rag_data:
+        rag_rules = (
+            "RAG POLICY:\n"
+            "- Use the RAG facts below as primary source.\n"
+            f"- At least {math.ceil(count * 0.6)} out of {count} questions must be directly answerable from these RAG facts.\n"
+            f"- If RAG Fact - QnA exists, create at least {min(2, count)} questions inspired by that QnA pattern.\n"
+            "- If using location information from RAG, ask concrete place-choice questions like 'Where is the charger?' instead of yes/no questions.\n"
+            "- The remaining questions may use simple common knowledge, but still must stay about the same object.\n"
+            "- Never contradict RAG facts.\n"
+            f"{rag_context}\n"
+        )
+    else:
+        rag_rules = (
+            "RAG POLICY:\n"
+            "- This object is not found in RAG dataset.\n"
+            "- Use simple, safe general knowledge about the object.\n"
+            "- Keep quality and difficulty at 4th-grade beginner level.\n"
+        )
 
-        rag_rules = ""
-        if rag_data:
-            rag_rules = (
-                "RAG POLICY:\n"
-                "- Use the RAG facts below as primary source.\n"
-                "- At least 6 out of 10 questions must be directly answerable from these RAG facts.\n"
-                "- If RAG Fact - QnA exists, create at least 2 questions inspired by that QnA pattern.\n"
-                "- If using location information from RAG, ask concrete place-choice questions like 'Where is the charger?' instead of yes/no questions.\n"
-                "- The remaining questions may use simple common knowledge, but still must stay about the same object.\n"
-                "- Never contradict RAG facts.\n"
-                f"{rag_context}\n"
-            )
-        else:
-            rag_rules = (
-                "RAG POLICY:\n"
-                "- This object is not found in RAG dataset.\n"
-                "- Use simple, safe general knowledge about the object.\n"
-                "- Keep quality and difficulty at 4th-grade beginner level.\n"
-            )
+    return (
+        f"Create a text-only multiple-choice quiz about the physical object '{object_name}' for 4th-grade elementary students in Indonesia who are beginners in English.\n"
+        f"IMPORTANT: Treat '{object_name}' strictly as a physical noun (a thing you can touch/see), NEVER as an adjective or verb.\n"
+        f"Generate exactly {count} questions.\n"
+        f"STRICT OUTPUT FORMAT: Return ONLY a raw JSON array. Do not use Markdown blocks (```json).\n"
+        f"Format Structure:\n"
+        f"[\n"
+        f"  {{ \"question\": \"Where do you usually find a {object_name}?\", \"options\": [\"A) Option1\", \"B) Option2\", \"C) Option3\", \"D) Option4\"], \"correct_index\": 0 }}\n"
+        f"]\n"
+        f"Rules you MUST follow:\n"
+        f"1. NO IMAGE REFERENCES: The quiz is TEXT-ONLY.\n"
+        f"2. UNIQUE QUESTIONS: All {count} question texts must be different in meaning and wording.\n"
+        f"3. EXTREMELY SIMPLE ENGLISH: Max 8 words per question.\n"
+        f"4. SHORT OPTIONS: Each option is 1 to 3 words only.\n"
+        f"5. MANDATORY PREFIX: options must start with exactly 'A) ', 'B) ', 'C) ', 'D) '.\n"
+        f"6. correct_index is integer 0..3 matching correct option.\n"
+        f"7. Keep questions answerable by kids (no tricky/ambiguous wording).\n"
+        f"8. Every question must have exactly one clearly correct answer. Avoid questions that can have multiple logical answers in real life.\n"
+        f"9. DO NOT make yes/no questions like 'Is this in the living room?' or 'Can it be on a table?'.\n"
+        f"10. {blank_rule} using exactly one blank: '....'. Example: 'I use a .... to charge my phone.'\n"
+        f"11. {translation_rule} from Indonesian to English. Example pattern: What is \"meja\" in English?\n"
+        f"12. For that translation question, the correct option must be '{object_name}' (or same word with article/plural form).\n"
+        f"13. Prefer these question types: function, part, material, place, sentence completion, translation (Indonesian-to-English), and simple vocabulary.\n"
+        f"14. Every non-blank and non-translation question must mention '{object_name}' (or its clear short form).\n"
+        f"15. Never use generic templates like 'What do you use to write?'. Use object-focused wording such as 'What is a pen for?'.\n"
+        f"16. Wrong options must be clearly wrong for kids. Never put two options that can both be true in daily life.\n"
+        f"17. Keep all questions on-topic about '{object_name}', never random world facts.\n"
+        f"{rag_rules}"
+        f"{excluded_block}"
+        f"{variant_line}"
+    )
 
-        return (
-            f"Create a text-only multiple-choice quiz about the physical object '{object_name}' for 4th-grade elementary students in Indonesia who are beginners in English.\n"
-            f"IMPORTANT: Treat '{object_name}' strictly as a physical noun (a thing you can touch/see), NEVER as an adjective or verb.\n"
-            f"Generate exactly 10 questions.\n"
-            f"STRICT OUTPUT FORMAT: Return ONLY a raw JSON array. Do not use Markdown blocks (```json).\n"
-            f"Format Structure:\n"
-            f"[\n"
-            f"  {{ \"question\": \"Where do you usually find a {object_name}?\", \"options\": [\"A) Option1\", \"B) Option2\", \"C) Option3\", \"D) Option4\"], \"correct_index\": 0 }}\n"
-            f"]\n"
-            f"Rules you MUST follow:\n"
-            f"1. NO IMAGE REFERENCES: The quiz is TEXT-ONLY.\n"
-            f"2. UNIQUE QUESTIONS: All 10 question texts must be different in meaning and wording.\n"
-            f"3. EXTREMELY SIMPLE ENGLISH: Max 8 words per question.\n"
-            f"4. SHORT OPTIONS: Each option is 1 to 3 words only.\n"
-            f"5. MANDATORY PREFIX: options must start with exactly 'A) ', 'B) ', 'C) ', 'D) '.\n"
-            f"6. correct_index is integer 0..3 matching correct option.\n"
-            f"7. Keep questions answerable by kids (no tricky/ambiguous wording).\n"
-            f"8. Every question must have exactly one clearly correct answer. Avoid questions that can have multiple logical answers in real life.\n"
-            f"9. DO NOT make yes/no questions like 'Is this in the living room?' or 'Can it be on a table?'.\n"
-            f"10. Include at least 2 sentence-completion questions using exactly one blank: '....'. Example: 'I use a .... to charge my phone.'\n"
-            f"11. Include at least 1 translation question from Indonesian to English. Example pattern: What is \"meja\" in English?\n"
-            f"12. For that translation question, the correct option must be '{object_name}' (or same word with article/plural form).\n"
-            f"13. Prefer these question types: function, part, material, place, sentence completion, translation (Indonesian-to-English), and simple vocabulary.\n"
-            f"14. Every non-blank and non-translation question must mention '{object_name}' (or its clear short form).\n"
-            f"15. Never use generic templates like 'What do you use to write?'. Use object-focused wording such as 'What is a pen for?'.\n"
-            f"16. Wrong options must be clearly wrong for kids. Never put two options that can both be true in daily life.\n"
-            f"17. Keep all questions on-topic about '{object_name}', never random world facts.\n"
-            f"{rag_rules}"
-            f"{excluded_block}"
-        )
 
-    def _normalize_question_text(text):
-        return " ".join(str(text).strip().lower().split())
+def _normalize_question_text(text):
+    return " ".join(str(text).strip().lower().split())
 
-    def _normalize_option_text(text):
-        cleaned = re.sub(r"[^a-z0-9 ]+", " ", str(text).strip().lower())
-        return " ".join(cleaned.split())
 
-    def _option_matches_object(option_text):
-        obj = _normalize_option_text(object_name)
-        opt = _normalize_option_text(option_text)
-        if not obj or not opt:
-            return False
-        if opt == obj:
-            return True
-        if opt.endswith("s") and opt[:-1] == obj:
-            return True
-        return obj in opt
+def _normalize_option_text(text):
+    cleaned = re.sub(r"[^a-z0-9 ]+", " ", str(text).strip().lower())
+    return " ".join(cleaned.split())
 
-    def _question_mentions_object(question_text):
-        obj = _normalize_question_text(object_name)
-        q = _normalize_question_text(question_text)
-        if not obj or not q:
-            return False
-        if obj in q:
-            return True
-        obj_parts = [part for part in obj.replace("-", " ").split() if len(part) >= 4]
-        return any(part in q for part in obj_parts)
 
-    def _is_ambiguous_yes_no_question(text):
-        normalized = _normalize_question_text(text)
-        blocked_starts = (
-            "is ", "are ", "can ", "do ", "does ", "did ", "was ", "were ", "has ", "have "
-        )
-        return normalized.startswith(blocked_starts)
-
-    def _is_generic_function_question(text):
-        normalized = _normalize_question_text(text)
-        generic_patterns = (
-            "what do you use to",
-            "what can you use to",
-            "what is used to",
-            "which tool do you use to",
-            "what do we use to",
-        )
-        return any(pattern in normalized for pattern in generic_patterns)
+def _option_matches_object(object_name, option_text):
+    obj = _normalize_option_text(object_name)
+    opt = _normalize_option_text(option_text)
+    if not obj or not opt:
+        return False
+    if opt == obj:
+        return True
+    if opt.endswith("s") and opt[:-1] == obj:
+        return True
+    return obj in opt
 
-    def _is_translation_question(text):
-        normalized = _normalize_question_text(text)
-        if not normalized.startswith("what is "):
-            return False
-        return " in english" in normalized
 
-    def _is_off_topic_question(text):
-        normalized = _normalize_question_text(text)
-        return any(keyword in normalized for keyword in off_topic_keywords)
+def _question_mentions_object(object_name, question_text):
+    obj = _normalize_question_text(object_name)
+    q = _normalize_question_text(question_text)
+    if not obj or not q:
+        return False
+    if obj in q:
+        return True
+    obj_parts = [part for part in obj.replace("-", " ").split() if len(part) >= 4]
+    return any(part in q for part in obj_parts)
 
-    def _validate_quiz_payload(items):
-        if not isinstance(items, list):
-            return False
-        if len(items) != 10:
-            return False
 
-        seen_questions = set()
-        sentence_completion_count = 0
-        translation_question_count = 0
-        for item in items:
-            if not isinstance(item, dict):
-                return False
-            if "question" not in item or "options" not in item or "correct_index" not in item:
-                return False
+def _is_ambiguous_yes_no_question(text):
+    normalized = _normalize_question_text(text)
+    blocked_starts = (
+        "is ", "are ", "can ", "do ", "does ", "did ", "was ", "were ", "has ", "have "
+    )
+    return normalized.startswith(blocked_starts)
 
-            q_text = _normalize_question_text(item["question"])
-            if not q_text or q_text in seen_questions:
-                return False
-            if _is_ambiguous_yes_no_question(q_text):
-                return False
-            if _is_off_topic_question(q_text):
-                return False
-            if len(q_text.replace("....", " ").split()) > 8:
-                return False
-            seen_questions.add(q_text)
-
-            has_blank = "...." in str(item["question"])
-            is_translation = _is_translation_question(item["question"])
-            if has_blank:
-                sentence_completion_count += 1
-            elif is_translation:
-                translation_question_count += 1
-            elif not _question_mentions_object(q_text):
-                return False
 
-            options = item["options"]
-            if not isinstance(options, list) or len(options) != 4:
-                return False
-            expected_prefix = ["A) ", "B) ", "C) ", "D) "]
-            normalized_options = []
-            for idx, opt in enumerate(options):
-                if not isinstance(opt, str) or not opt.startswith(expected_prefix[idx]):
-                    return False
-                option_text = _normalize_option_text(opt[3:])
-                if not option_text:
-                    return False
-                if len(option_text.split()) > 3:
-                    return False
-                normalized_options.append(option_text)
+def _is_generic_function_question(text):
+    normalized = _normalize_question_text(text)
+    generic_patterns = (
+        "what do you use to",
+        "what can you use to",
+        "what is used to",
+        "which tool do you use to",
+        "what do we use to",
+    )
+    return any(pattern in normalized for pattern in generic_patterns)
 
-            if len(set(normalized_options)) != 4:
-                return False
 
-            if _is_generic_function_question(q_text):
-                if not _question_mentions_object(q_text):
-                    return False
-                for group in ambiguous_option_groups:
-                    group_hits = sum(1 for opt in normalized_options if opt in group)
-                    if group_hits >= 2:
-                        return False
+def _is_translation_question(text):
+    normalized = _normalize_question_text(text)
+    if not normalized.startswith("what is "):
+        return False
+    return " in english" in normalized
 
-            correct_index = item["correct_index"]
-            if not isinstance(correct_index, int) or correct_index < 0 or correct_index > 3:
-                return False
 
-            if is_translation:
-                correct_option = normalized_options[correct_index]
-                if not _option_matches_object(correct_option):
-                    return False
+def _is_off_topic_question(text):
+    normalized = _normalize_question_text(text)
+    return any(keyword in normalized for keyword in QUIZ_OFF_TOPIC_KEYWORDS)
+
+
+# Aturan komposisi 1 quiz: (minimal, maksimal yang diutamakan) per tipe soal.
+QUIZ_SIZE = 10
+QUIZ_TYPE_LIMITS = {"sentence_completion": (2, 4), "translation": (1, 2)}
+QUIZ_MAX_PER_OTHER_TYPE = 3
+
+
+def _classify_quiz_question(question_text):
+    if "...." in str(question_text):
+        return "sentence_completion"
+    if _is_translation_question(question_text):
+        return "translation"
+    q = _normalize_question_text(question_text)
+    if "made of" in q or "material" in q:
+        return "material"
+    if q.startswith("where") or " where " in q:
+        return "place"
+    if "part" in q.split():
+        return "part"
+    if q.endswith(" for?") or " use" in q or " used" in q:
+        return "function"
+    if any(word in q for word in ("color", "colour", "shape", "size", "big", "small")):
+        return "appearance"
+    return "vocabulary"
+
+
+def _validate_quiz_item(object_name, item):
+    # Cek satu soal; balikin tipe soalnya kalau lolos, None kalau gak.
+    if not isinstance(item, dict):
+        return None
+    if "question" not in item or "options" not in item or "correct_index" not in item:
+        return None
+
+    q_text = _normalize_question_text(item["question"])
+    if not q_text:
+        return None
+    if _is_ambiguous_yes_no_question(q_text):
+        return None
+    if _is_off_topic_question(q_text):
+        return None
+    if len(q_text.replace("....", " ").split()) > 8:
+        return None
+
+    has_blank = "...." in str(item["question"])
+    is_translation = _is_translation_question(item["question"])
+    if not has_blank and not is_translation and not _question_mentions_object(object_name, q_text):
+        return None
+
+    options = item["options"]
+    if not isinstance(options, list) or len(options) != 4:
+        return None
+    expected_prefix = ["A) ", "B) ", "C) ", "D) "]
+    normalized_options = []
+    for idx, opt in enumerate(options):
+        if not isinstance(opt, str) or not opt.startswith(expected_prefix[idx]):
+            return None
+        option_text = _normalize_option_text(opt[3:])
+        if not option_text:
+            return None
+        if len(option_text.split()) > 3:
+            return None
+        normalized_options.append(option_text)
+
+    if len(set(normalized_options)) != 4:
+        return None
+
+    if _is_generic_function_question(q_text):
+        if not _question_mentions_object(object_name, q_text):
+            return None
+        for group in QUIZ_AMBIGUOUS_OPTION_GROUPS:
+            group_hits = sum(1 for opt in normalized_options if opt in group)
+            if group_hits >= 2:
+                return None
 
-        if sentence_completion_count < 2:
+    correct_index = item["correct_index"]
+    if not isinstance(correct_index, int) or correct_index < 0 or correct_index > 3:
+        return None
+
+    if is_translation:
+        correct_option = normalized_options[correct_index]
+        if not _option_matches_object(object_name, correct_option):
+            return None
+
+    return _classify_quiz_question(item["question"])
+
+
+def _salvage_quiz_items(object_name, items):
+    # Ambil soal-soal yang lolos dari satu respon Gemini (yang gagal aja yang dibuang).
+    if not isinstance(items, list):
+        return []
+    salvaged = []
+    for item in items:
+        question_type = _validate_quiz_item(object_name, item)
+        if question_type:
+            salvaged.append((question_type, item))
+    return salvaged
+
+
+def _validate_quiz_payload(object_name, items):
+    if not isinstance(items, list):
+        return False
+    if len(items) != QUIZ_SIZE:
+        return False
+
+    seen_questions = set()
+    type_counts = {}
+    for item in items:
+        question_type = _validate_quiz_item(object_name, item)
+        if not question_type:
+            return False
+        q_text = _normalize_question_text(item["question"])
+        if q_text in seen_questions:
             return False
+        seen_questions.add(q_text)
+        type_counts[question_type] = type_counts.get(question_type, 0) + 1
 
-        if translation_question_count < 1:
+    for question_type, (minimum, _) in QUIZ_TYPE_LIMITS.items():
+        if type_counts.get(question_type, 0) < minimum:
             return False
 
-        return True
+    return True
+
+
+def assemble_quiz(bank_items, rng=None, avoid_questions=()):
+    # Susun 1 quiz dari bank soal [(tipe, item)]. Balikin (quiz, None) kalau cukup,
+    # atau (None, kebutuhan) kalau masih kurang: {"count": n, "min_blank": x, "min_translation": y}.
+    rng = rng or random
+    avoid = {_normalize_question_text(q) for q in avoid_questions}
+    pool = []
+    seen = set()
+    for question_type, item in bank_items:
+        key = _normalize_question_text(item["question"])
+        if key not in seen:
+            seen.add(key)
+            pool.append((question_type, item, key))
+    rng.shuffle(pool)
+    # Soal yang baru aja keluar (force_regenerate) ditaruh paling belakang.
+    pool.sort(key=lambda entry: entry[2] in avoid)
+
+    chosen = []
+    counts = {}
+
+    def take(entry):
+        chosen.append(entry)
+        counts[entry[0]] = counts.get(entry[0], 0) + 1
+
+    for question_type, (minimum, _) in QUIZ_TYPE_LIMITS.items():
+        for entry in pool:
+            if counts.get(question_type, 0) >= minimum:
+                break
+            if entry[0] == question_type:
+                take(entry)
+
+    unmet = {t: minimum - counts.get(t, 0) for t, (minimum, _) in QUIZ_TYPE_LIMITS.items()}
+    free_slots = QUIZ_SIZE - len(chosen) - sum(unmet.values())
+    # Putaran 1 pakai batas per tipe biar variatif; putaran 2 isi sisa slot tanpa batas.
+    for respect_limits in (True, False):
+        for entry in pool:
+            if free_slots <= 0:
+                break
+            if entry in chosen:
+                continue
+            limit = QUIZ_TYPE_LIMITS.get(entry[0], (0, QUIZ_MAX_PER_OTHER_TYPE))[1]
+            if respect_limits and counts.get(entry[0], 0) >= limit:
+                continue
+            take(entry)
+            free_slots -= 1
+
+    if len(chosen) == QUIZ_SIZE:
+        quiz = [entry[1] for entry in chosen]
+        rng.shuffle(quiz)
+        return quiz, None
+    return None, {
+        "count": QUIZ_SIZE - len(chosen),
+        "min_blank": unmet["sentence_completion"],
+        "min_translation": unmet["translation"],
+    }
+
+
+def _parse_quiz_response(raw_text):
+    raw_text = (raw_text or "").strip()
+
+    # Bersihkan "sampah" format dari Gemini (kalau dia bandel ngasih ```json)
+    if raw_text.startswith("```"):
+        raw_text = raw_text.replace("```json", "").replace("```", "").strip()
+
+    return json.loads(raw_text)
+
+
+# Naikin angka ini tiap aturan _validate_quiz_payload / _validate_quiz_item berubah: quiz yang dicap versi
+# lama bakal divalidasi ulang waktu diambil, dan disapu QuizSweeper di background.
+QUIZ_VALIDATOR_VERSION = 2
+# Pendek aja: kalau worker lain force_regenerate, worker ini paling lama segini masih ngirim quiz lama.
+QUIZ_CACHE_TTL = float(os.getenv("QUIZ_CACHE_TTL", "30"))
+QUIZ_SWEEP_INTERVAL = float(os.getenv("QUIZ_SWEEP_INTERVAL", "3600"))
+QUIZ_SWEEP_BATCH = int(os.getenv("QUIZ_SWEEP_BATCH", "20"))
+# Kunci advisory Postgres: cuma satu proses (dari semua worker gunicorn) yang nyapu dalam satu waktu.
+QUIZ_SWEEP_LOCK_ID = int(os.getenv("QUIZ_SWEEP_LOCK_ID", "7412019"))
+
+# object_name -> {"raw": bytes JSON quiz, "version": int/None, "hash": str/None}; None = belum ada quiz.
+quiz_entry_cache = TtlLruCache(OBJECT_CACHE_MAX_ENTRIES, QUIZ_CACHE_TTL)
+_quiz_cache_stats = {
+    "stamped_hits": 0, "revalidated": 0, "restamped": 0, "swept": 0, "sweep_regenerated": 0, "sweep_skipped_locked": 0,
+}
+_quiz_cache_stats_lock = threading.Lock()
+
+
+def _count_quiz_cache(key, amount=1):
+    with _quiz_cache_stats_lock:
+        _quiz_cache_stats[key] += amount
+
+
+def quiz_cache_stats():
+    with _quiz_cache_stats_lock:
+        stats = dict(_quiz_cache_stats)
+    stats["validator_version"] = QUIZ_VALIDATOR_VERSION
+    return stats
+
+
+def quiz_content_hash(quiz_text):
+    return hashlib.sha256(quiz_text.encode("utf-8")).hexdigest()
+
+
+def load_quiz_entry(object_name):
+    # A. CEK DATABASE DULU (SIAPA TAU UDAH PERNAH DIBIKIN), lewat cache in-memory.
+    found, entry = quiz_entry_cache.get(object_name)
+    if found:
+        return entry
+    try:
+        with get_db_connection() as conn:
+            ensure_schema(conn)
+            with conn.cursor() as cur:
+                execute_prepared(cur, "select_quiz", (object_name,))
+                result = cur.fetchone()
+    except Exception as e:
+        print(f"⚠️ Gagal cek cache database quiz: {e}")
+        return None
+
+    entry = None
+    if result and result[0]:
+        # Baris lama (sebelum ada kolom JSONB) belum dicap versi & belum punya hash: hash-nya dihitung
+        # dari teks yang dikirim, biar ETag selalu cocok sama bytes-nya.
+        raw, version, content_hash = result
+        entry = {"raw": raw.encode("utf-8"), "version": version, "hash": content_hash or quiz_content_hash(raw)}
+    quiz_entry_cache.set(object_name, entry)
+    return entry
+
+
+def load_cached_quiz(object_name):
+    entry = load_quiz_entry(object_name)
+    if not entry:
+        return None
+    try:
+        return json.loads(entry["raw"])
+    except Exception:
+        print(f"⚠️ Cache quiz untuk {object_name} rusak, akan regenerate.")
+        return None
+
+
+def load_valid_quiz_entry(object_name):
+    # Entry yang udah dicap versi validator terbaru langsung dipercaya (gak di-parse/validasi ulang).
+    # Entry lama divalidasi sekali, lalu dicap ulang kalau lolos.
+    entry = load_quiz_entry(object_name)
+    if not entry:
+        return None
+    if entry["version"] == QUIZ_VALIDATOR_VERSION:
+        _count_quiz_cache("stamped_hits")
+        return entry
+    _count_quiz_cache("revalidated")
+    quiz_data = load_cached_quiz(object_name)
+    if quiz_data and _validate_quiz_payload(object_name, quiz_data):
+        _count_quiz_cache("restamped")
+        return save_quiz(object_name, quiz_data, log=False)
+    print(f"⚠️ Cache quiz lama untuk {object_name} tidak lolos validasi terbaru, regenerate.")
+    return None
+
 
-    if not force_regenerate and cached_quiz:
-        if _validate_quiz_payload(cached_quiz):
-            print(f"✅ Quiz untuk {object_name} diambil dari DATABASE NEON!")
-            return jsonify({"status": "sukses", "data": cached_quiz})
-        print(f"⚠️ Cache quiz lama untuk {object_name} tidak lolos validasi terbaru, regenerate.")
+quiz_executor = concurrent.futures.ThreadPoolExecutor(max_workers=QUIZ_EXECUTOR_WORKERS, thread_name_prefix="quiz")
+_quiz_stats = {
+    "quizzes": 0,
+    "failed": 0,
+    "from_bank": 0,
+    "attempts": 0,
+    "discarded": 0,
+    "salvaged_items": 0,
+    "late_salvaged_items": 0,
+    "attempts_to_valid": {},
+    "rounds_to_valid": {},
+}
+_quiz_stats_lock = threading.Lock()
 
-    # B. KALAU BELUM ADA, MINTA GEMINI BUATKAN
-    print(f"🤖 Meminta Gemini membuat 10 Soal Quiz untuk: {object_name}...")
 
+def quiz_candidate_count(remaining_attempts, max_candidates=None):
+    # Jangan minta kandidat lebih banyak dari token kuota yang tersisa di provider utama quiz.
+    # max_candidates: batas dari pemanggil (mis. warmup.py yang ngatur slot Gemini sendiri).
+    count = min(max(1, max_candidates or QUIZ_SPECULATIVE_CANDIDATES), remaining_attempts)
+    primary_provider = model_router.routes["quiz"][0][0]
+    available = gemini_rate_limiter.available(primary_provider)
+    if available is not None:
+        count = min(count, max(1, int(available)))
+    return count
+
+
+def _record_quiz_result(attempts, rounds, valid, discarded, salvaged=0, from_bank=False):
+    with _quiz_stats_lock:
+        _quiz_stats["quizzes" if valid else "failed"] += 1
+        _quiz_stats["salvaged_items"] += salvaged
+        if from_bank:
+            _quiz_stats["from_bank"] += 1
+            return
+        _quiz_stats["attempts"] += attempts
+        _quiz_stats["discarded"] += discarded
+        if valid:
+            _quiz_stats["attempts_to_valid"][attempts] = _quiz_stats["attempts_to_valid"].get(attempts, 0) + 1
+            _quiz_stats["rounds_to_valid"][rounds] = _quiz_stats["rounds_to_valid"].get(rounds, 0) + 1
+
+
+def quiz_stats():
+    with _quiz_stats_lock:
+        stats = {
+            **_quiz_stats,
+            "attempts_to_valid": dict(sorted(_quiz_stats["attempts_to_valid"].items())),
+            "rounds_to_valid": dict(sorted(_quiz_stats["rounds_to_valid"].items())),
+        }
+    stats["candidates"] = QUIZ_SPECULATIVE_CANDIDATES
+    stats["avg_attempts"] = round(stats["attempts"] / (stats["quizzes"] + stats["failed"]), 2) if stats["quizzes"] + stats["failed"] else 0.0
+    return stats
+
+
+QUESTION_BANK_CACHE_TTL = float(os.getenv("QUESTION_BANK_CACHE_TTL", "600"))
+# Maks soal lama yang dikirim ke prompt sebagai "jangan diulang" (biar prompt gak kepanjangan).
+QUIZ_MAX_EXCLUDED_IN_PROMPT = int(os.getenv("QUIZ_MAX_EXCLUDED_IN_PROMPT", "30"))
+# Minta sedikit lebih banyak dari kekurangan, jaga-jaga ada soal yang gak lolos validasi.
+QUIZ_FILL_MARGIN = int(os.getenv("QUIZ_FILL_MARGIN", "2"))
+question_bank_cache = TtlLruCache(OBJECT_CACHE_MAX_ENTRIES, QUESTION_BANK_CACHE_TTL)
+
+
+def load_question_bank(object_name):
+    found, items = question_bank_cache.get(object_name)
+    if found:
+        return list(items)
+    items = []
+    try:
+        with get_db_connection() as conn:
+            ensure_schema(conn)
+            with conn.cursor() as cur:
+                execute_prepared(cur, "select_bank", (object_name,))
+                rows = cur.fetchall()
+        for question_type, item in rows:
+            items.append((question_type, item if isinstance(item, dict) else json.loads(item)))
+    except Exception as e:
+        # Jangan di-cache: bisa jadi DB-nya cuma lagi putus sebentar.
+        print(f"⚠️ Gagal baca bank soal {object_name}: {e}")
+        return items
+    question_bank_cache.set(object_name, items)
+    return list(items)
+
+
+def add_to_question_bank(object_name, typed_items):
+    # Write-through ke cache, tulis ke DB lewat write-behind.
+    if not typed_items:
+        return
+    for question_type, item in typed_items:
+        question_key = _normalize_question_text(item["question"])
+        write_behind.enqueue("insert_bank_item", object_name, question_key, question_type, json.dumps(item))
+
+    def merge(existing):
+        existing = list(existing or [])
+        keys = {_normalize_question_text(item["question"]) for _, item in existing}
+        for question_type, item in typed_items:
+            key = _normalize_question_text(item["question"])
+            if key not in keys:
+                keys.add(key)
+                existing.append((question_type, item))
+        return existing
+
+    # Pastikan bank benda ini ada di cache dulu, soalnya tulisan ke DB di atas belum tentu udah masuk.
+    load_question_bank(object_name)
+    question_bank_cache.update(object_name, merge)
+
+
+def _quiz_attempt(object_name, excluded_questions, variant, needs):
+    # Error Gemini dilempar ke atas; JSON rusak dianggap kandidat gagal (None).
+    count = min(QUIZ_SIZE, needs["count"] + QUIZ_FILL_MARGIN)
+    prompt = _build_quiz_prompt(
+        object_name,
+        excluded_questions,
+        variant,
+        count=count,
+        min_blank=needs["min_blank"],
+        min_translation=needs["min_translation"],
+    )
+    response = call_gemini(contents=prompt, task="quiz")
+    try:
+        return _parse_quiz_response(response.text)
+    except Exception:
+        return None
+
+
+def _bank_late_candidate(object_name, future):
+    # Kandidat yang kalah balapan tapi udah terlanjur jalan: token Gemini-nya udah kepakai,
+    # jadi soal yang lolos validasi tetap masuk bank buat quiz berikutnya.
+    if future.cancelled() or future.exception() is not None:
+        return
+    salvaged = _salvage_quiz_items(object_name, future.result())
+    if not salvaged:
+        return
     try:
-        quiz_data = None
-        excluded_questions = []
+        add_to_question_bank(object_name, salvaged)
+    except Exception as e:
+        print(f"⚠️ Gagal simpan soal kandidat sisa {object_name} ke bank: {e}")
+        return
+    with _quiz_stats_lock:
+        _quiz_stats["late_salvaged_items"] += len(salvaged)
 
-        for _ in range(5):
-            prompt = _build_quiz_prompt(excluded_questions)
-            response = call_gemini(contents=prompt, thinking_level="HIGH")
-            raw_text = (response.text or "").strip()
 
-            # Bersihkan "sampah" format dari Gemini (kalau dia bandel ngasih ```json)
-            if raw_text.startswith("```"):
-                raw_text = raw_text.replace("```json", "").replace("```", "").strip()
+def create_quiz(object_name, avoid_questions=(), max_candidates=None):
+    # A. SUSUN DARI BANK SOAL DULU: kalau soal yang lolos validasi udah cukup, gak perlu Gemini.
+    # avoid_questions (force_regenerate) = soal quiz sebelumnya, diusahakan gak keluar lagi.
+    # max_candidates: maks panggilan Gemini barengan per putaran (default QUIZ_SPECULATIVE_CANDIDATES).
+    rng = random.Random()
+    bank = load_question_bank(object_name)
+    quiz, needs = assemble_quiz(bank, rng, avoid_questions)
+    if quiz:
+        print(f"✅ Quiz {object_name} disusun dari bank soal ({len(bank)} soal tersedia).")
+        _record_quiz_result(0, 0, True, 0, from_bank=True)
+        return quiz
 
+    # B. MINTA GEMINI BUATKAN KEKURANGANNYA: tiap putaran beberapa kandidat jalan barengan, soal yang lolos
+    # masuk bank, dan begitu bank cukup buat 1 quiz langsung dipakai (sisa kandidat dibatalin/dibuang).
+    print(f"🤖 Meminta Gemini membuat {needs['count']} Soal Quiz untuk: {object_name}...")
+
+    attempts = 0
+    completed = 0
+    rounds = 0
+    salvaged_total = 0
+    while attempts < QUIZ_MAX_ATTEMPTS:
+        excluded_questions = [item["question"] for _, item in bank][-QUIZ_MAX_EXCLUDED_IN_PROMPT:]
+        count = quiz_candidate_count(QUIZ_MAX_ATTEMPTS - attempts, max_candidates)
+        futures = [
+            submit_with_stage_timings(quiz_executor, _quiz_attempt, object_name, excluded_questions, attempts + i, needs)
+            for i in range(count)
+        ]
+        attempts += count
+        rounds += 1
+
+        errors = []
+        for future in concurrent.futures.as_completed(futures):
+            completed += 1
             try:
-                parsed = json.loads(raw_text)
-            except Exception:
-                excluded_questions = []
+                parsed = future.result()
+            except Exception as e:
+                errors.append(e)
                 continue
 
-            if _validate_quiz_payload(parsed):
-                quiz_data = parsed
-                break
+            salvaged = _salvage_quiz_items(object_name, parsed)
+            if not salvaged:
+                continue
+            salvaged_total += len(salvaged)
+            add_to_question_bank(object_name, salvaged)
+            bank.extend(salvaged)
+            quiz, needs = assemble_quiz(bank, rng, avoid_questions)
+            if quiz:
+                # Yang belum mulai dibatalin, yang udah jalan soalnya masuk bank pas selesai.
+                late = [f for f in futures if f is not future and not f.cancel()]
+                for late_future in late:
+                    late_future.add_done_callback(functools.partial(_bank_late_candidate, object_name))
+                discarded = len(late)
+                _record_quiz_result(completed, rounds, True, discarded, salvaged=salvaged_total)
+                return quiz
+
+        # Semua kandidat putaran ini error dari Gemini (bukan cuma gak valid): lempar ke atas kayak dulu.
+        if len(errors) == count:
+            _record_quiz_result(completed, rounds, False, 0, salvaged=salvaged_total)
+            raise errors[-1]
+
+    _record_quiz_result(completed, rounds, False, 0, salvaged=salvaged_total)
+    return None
+
 
-            if isinstance(parsed, list):
-                excluded_questions = [str(item.get("question", "")).strip() for item in parsed if isinstance(item, dict)]
+def save_quiz(object_name, quiz_data, log=True):
+    # C. SIMPAN KE DATABASE (Biar besok gak mikir lagi) -- lewat write-behind, dicap versi validator.
+    quiz_text = json.dumps(quiz_data, ensure_ascii=False, separators=(",", ":"))
+    content_hash = quiz_content_hash(quiz_text)
+    write_behind.enqueue("upsert_quiz", object_name, quiz_text, QUIZ_VALIDATOR_VERSION, content_hash)
+    entry = {"raw": quiz_text.encode("utf-8"), "version": QUIZ_VALIDATOR_VERSION, "hash": content_hash}
+    quiz_entry_cache.set(object_name, entry)
+    if log:
+        print(f"💾 Quiz {object_name} masuk antrean simpan ke Database!")
+    return entry
+
+
+def quiz_response(entry):
+    # Quiz dikirim apa adanya dari bytes yang tersimpan, tanpa json.loads/jsonify ulang.
+    body = b'{"status":"sukses","data":' + entry["raw"] + b'}'
+    response = Response(body, mimetype="application/json")
+    if entry.get("hash"):
+        response.set_etag(entry["hash"])
+        # GET dengan If-None-Match yang cocok -> 304 tanpa body (werkzeug cuma ngelakuin ini buat GET/HEAD).
+        response.make_conditional(request)
+    return response
+
+
+def sweep_stale_quizzes(limit=QUIZ_SWEEP_BATCH):
+    # Validasi ulang quiz yang dicap versi lama (atau belum dicap) secara massal: yang lolos dicap ulang,
+    # yang gak lolos soal-soal bagusnya masuk bank lalu quiz-nya dibuat ulang.
+    # Koneksi pemegang kunci advisory ditahan selama sweep; worker lain yang gak dapet kunci langsung mundur.
+    with get_db_connection() as lock_conn:
+        ensure_schema(lock_conn)
+        with lock_conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (QUIZ_SWEEP_LOCK_ID,))
+            locked = cur.fetchone()[0]
+        lock_conn.commit()
+        if not locked:
+            _count_quiz_cache("sweep_skipped_locked")
+            return 0, 0
+        try:
+            return _sweep_stale_quizzes_locked(limit)
+        finally:
+            try:
+                with lock_conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (QUIZ_SWEEP_LOCK_ID,))
+                lock_conn.commit()
+            except Exception as e:
+                print(f"⚠️ Gagal lepas kunci sweep quiz: {e}")
+
+
+def _sweep_stale_quizzes_locked(limit):
+    # Baris yang belum pernah dicoba duluan, lalu yang paling lama gak dicoba. Barisnya langsung dicap
+    # waktu percobaan, jadi yang gagal regenerasi pindah ke belakang antrean dan sisanya tetap kebagian.
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE quizzes SET sweep_attempted_at = now() WHERE object_name IN ("
+                " SELECT object_name FROM quizzes WHERE validator_version IS DISTINCT FROM %s"
+                " ORDER BY sweep_attempted_at NULLS FIRST, object_name LIMIT %s) "
+                "RETURNING object_name, COALESCE(questions::text, questions_json)",
+                (QUIZ_VALIDATOR_VERSION, limit),
+            )
+            rows = cur.fetchall()
+        conn.commit()
+
+    regenerated = 0
+    for object_name, raw in rows:
+        try:
+            quiz_data = json.loads(raw) if raw else None
+        except Exception:
+            quiz_data = None
+        if quiz_data and _validate_quiz_payload(object_name, quiz_data):
+            save_quiz(object_name, quiz_data, log=False)
+            continue
+        add_to_question_bank(object_name, _salvage_quiz_items(object_name, quiz_data))
+        try:
+            new_quiz = create_quiz(object_name)
+        except Exception as e:
+            print(f"⚠️ Sweep quiz {object_name} gagal: {e}")
+            continue
+        if new_quiz:
+            save_quiz(object_name, new_quiz, log=False)
+            regenerated += 1
+    _count_quiz_cache("swept", len(rows))
+    _count_quiz_cache("sweep_regenerated", regenerated)
+    return len(rows), regenerated
+
+
+def _quiz_sweep_loop():
+    while True:
+        time.sleep(QUIZ_SWEEP_INTERVAL)
+        try:
+            swept, regenerated = sweep_stale_quizzes()
+            if swept:
+                print(f"🧹 Sweep quiz: {swept} quiz versi lama dicek, {regenerated} dibuat ulang.")
+        except Exception as e:
+            print(f"⚠️ Sweep quiz gagal: {e}")
+
+
+@app.route('/generate-quiz', methods=['GET', 'POST'])
+def generate_quiz():
+    # GET /generate-quiz?object_name=... bisa di-cache client: ETag = hash quiz, If-None-Match -> 304.
+    # force_regenerate cuma lewat POST.
+    data = request.get_json(silent=True) if request.method == 'POST' else {"object_name": request.args.get("object_name")}
+    if not data or not data.get('object_name'):
+        return jsonify({"status": "gagal", "pesan": "Data tidak lengkap"}), 400
+
+    object_name = resolve_object_name(data['object_name'])
+    if not object_name:
+        return jsonify({"status": "gagal", "pesan": "Nama objek tidak valid"}), 400
+    force_regenerate = request.method == 'POST' and bool(data.get('force_regenerate', False))
+
+    if not force_regenerate:
+        entry = load_valid_quiz_entry(object_name)
+        if entry:
+            print(f"✅ Quiz untuk {object_name} diambil dari CACHE DATABASE!")
+            return quiz_response(entry)
+
+    try:
+        cached_quiz = load_cached_quiz(object_name)
+        # force_regenerate: kocok ulang dari bank soal, usahain soalnya beda dari quiz sebelumnya.
+        avoid_questions = []
+        if isinstance(cached_quiz, list):
+            # Soal quiz lama yang masih lolos ikut masuk bank (quiz yang dibuat sebelum ada bank soal).
+            add_to_question_bank(object_name, _salvage_quiz_items(object_name, cached_quiz))
+            if force_regenerate:
+                avoid_questions = [item.get("question", "") for item in cached_quiz if isinstance(item, dict)]
+        quiz_data = create_quiz(object_name, avoid_questions)
 
         if not quiz_data:
             return jsonify({
@@ -719,25 +4439,201 @@ def generate_quiz():
                 "pesan": "AI gagal membuat quiz valid dan unik. Coba lagi."
             }), 500
 
-        # C. SIMPAN KE DATABASE (Biar besok gak mikir lagi)
-        try:
-            with closing(get_db_connection()) as conn:
-                with conn.cursor() as cur:
-                    json_str = json.dumps(quiz_data)
-                    cur.execute(
-                        "INSERT INTO quizzes (object_name, questions_json) VALUES (%s, %s) ON CONFLICT (object_name) DO UPDATE SET questions_json = EXCLUDED.questions_json",
-                        (object_name, json_str)
-                    )
-                    conn.commit()
-                    print(f"💾 Quiz {object_name} berhasil disimpan ke Database!")
-        except Exception as db_e:
-            print(f"⚠️ Gagal simpan quiz ke DB: {db_e}")
-
-        return jsonify({"status": "sukses", "data": quiz_data})
+        return quiz_response(save_quiz(object_name, quiz_data))
 
     except Exception as e:
         print(f"❌ Error API Quiz: {e}")
         return jsonify({"status": "gagal", "pesan": str(e)}), 500
 
+# --- PREFETCH SPEKULATIF SETELAH SCAN ---
+# Habis scan, siswa hampir selalu lanjut buka definisi/fungsi/kalimat dan sering buka quiz.
+# Kalau diaktifkan (SCAN_PREFETCH_ENABLED=1, atau prefetch=1 per request), jawaban template yang
+# belum ada, audionya, dan quiz langsung disiapin di background. Worker-nya dibatasi, objek yang sama
+# gak diproses dobel, dan langkah yang butuh Gemini dilewati kalau token bucket lagi tipis biar
+# request siswa yang beneran gak kebagian limit.
+SCAN_PREFETCH_ENABLED = os.getenv("SCAN_PREFETCH_ENABLED", "0") == "1"
+SCAN_PREFETCH_WORKERS = int(os.getenv("SCAN_PREFETCH_WORKERS", "2"))
+SCAN_PREFETCH_MAX_PENDING = int(os.getenv("SCAN_PREFETCH_MAX_PENDING", "32"))
+# Objek yang baru selesai di-prefetch gak diulang selama ini (detik).
+SCAN_PREFETCH_COOLDOWN = float(os.getenv("SCAN_PREFETCH_COOLDOWN", "300"))
+# Sisa token minimal di token bucket upstream sebelum prefetch boleh manggil Gemini.
+SCAN_PREFETCH_MIN_TOKENS = float(os.getenv("SCAN_PREFETCH_MIN_TOKENS", "2"))
+SCAN_PREFETCH_QUIZ = os.getenv("SCAN_PREFETCH_QUIZ", "1") == "1"
+
+
+class PrefetchCancelled(Exception):
+    pass
+
+
+class ScanPrefetcher:
+    def __init__(self, workers, max_pending, cooldown, min_tokens):
+        self.max_pending = max(1, max_pending)
+        self.min_tokens = min_tokens
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="prefetch")
+        self._jobs = {}  # object_name -> (future, cancel event)
+        self._recent = TtlLruCache(1024, cooldown)
+        self._lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "deduped": 0,
+            "dropped_full": 0,
+            "cancelled": 0,
+            "completed": 0,
+            "failed": 0,
+            "answers_ready": 0,
+            "audio_ready": 0,
+            "quizzes_prefetched": 0,
+            "skipped_rate_limited": 0,
+        }
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def submit(self, object_name):
+        # True kalau job baru dijadwalkan.
+        found, _ = self._recent.get(object_name)
+        with self._lock:
+            if found or object_name in self._jobs:
+                self._stats["deduped"] += 1
+                return False
+            if len(self._jobs) >= self.max_pending:
+                self._stats["dropped_full"] += 1
+                return False
+            cancel_event = threading.Event()
+            future = self._executor.submit(self._run, object_name, cancel_event)
+            self._jobs[object_name] = (future, cancel_event)
+            self._stats["submitted"] += 1
+        return True
+
+    def cancel(self, object_name=None):
+        # object_name None = batalin semua. Job yang lagi jalan berhenti di langkah berikutnya.
+        with self._lock:
+            names = [object_name] if object_name is not None else list(self._jobs)
+            jobs = [(name, self._jobs.get(name)) for name in names]
+        cancelled = 0
+        for name, job in jobs:
+            if job is None:
+                continue
+            future, cancel_event = job
+            cancel_event.set()
+            if future.cancel():
+                # Belum sempat jalan: _run gak bakal dipanggil, jadi dibersihin di sini.
+                with self._lock:
+                    self._jobs.pop(name, None)
+            cancelled += 1
+        self._count("cancelled", cancelled)
+        return cancelled
+
+    def _has_upstream_room(self, task):
+        # Cukup salah satu rute tugas ini yang token bucket-nya masih longgar.
+        for route in model_router._candidates(task):
+            tokens = gemini_rate_limiter.available(route[0])
+            if tokens is None or tokens >= self.min_tokens:
+                return True
+        return False
+
+    @staticmethod
+    def _check(cancel_event):
+        if cancel_event.is_set():
+            raise PrefetchCancelled()
+
+    def _run(self, object_name, cancel_event):
+        try:
+            self._check(cancel_event)
+            allow_gemini = self._has_upstream_room("answer")
+            answers = answer_template_batch(object_name, list(TANYA_AI_CACHE_KEYS), allow_gemini=allow_gemini)
+            texts = [text for text in answers.values() if text]
+            self._count("answers_ready", len(texts))
+            if len(texts) < len(TANYA_AI_CACHE_KEYS) and not allow_gemini:
+                self._count("skipped_rate_limited")
+            self._check(cancel_event)
+            audio = generate_audio_bytes_many(texts)
+            self._count("audio_ready", len(audio))
+            self._check(cancel_event)
+            if SCAN_PREFETCH_QUIZ and load_valid_quiz_entry(object_name) is None:
+                if not self._has_upstream_room("quiz"):
+                    self._count("skipped_rate_limited")
+                else:
+                    quiz_data = create_quiz(object_name)
+                    self._check(cancel_event)
+                    if quiz_data:
+                        save_quiz(object_name, quiz_data, log=False)
+                        self._count("quizzes_prefetched")
+            self._recent.set(object_name, True)
+            self._count("completed")
+            print(f"🔮 Prefetch {object_name} selesai.")
+        except PrefetchCancelled:
+            pass
+        except Exception as e:
+            if cancel_event.is_set():
+                # Dibatalin pas lagi jalan (misal executor quiz ikut ditutup pas shutdown).
+                return
+            self._count("failed")
+            print(f"⚠️ Prefetch {object_name} gagal: {e}")
+        finally:
+            with self._lock:
+                self._jobs.pop(object_name, None)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "pending": len(self._jobs), "enabled_by_default": SCAN_PREFETCH_ENABLED}
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+
+scan_prefetcher = ScanPrefetcher(
+    SCAN_PREFETCH_WORKERS, SCAN_PREFETCH_MAX_PENDING, SCAN_PREFETCH_COOLDOWN, SCAN_PREFETCH_MIN_TOKENS
+)
+atexit.register(scan_prefetcher.shutdown)
+
+
+def prefetch_after_scan(object_name, requested=""):
+    # requested: nilai opsi "prefetch" dari request ("" = ikut SCAN_PREFETCH_ENABLED).
+    enabled = requested in ("1", "true") if requested else SCAN_PREFETCH_ENABLED
+    if enabled and object_name and object_name != "unknown":
+        return scan_prefetcher.submit(object_name)
+    return False
+
+
+@app.route('/prefetch/cancel', methods=['POST'])
+def cancel_prefetch():
+    # Dipanggil Unity kalau siswa udah pindah objek: {"object_name": "..."}; tanpa object_name = batalin semua.
+    data = request.get_json(silent=True) or {}
+    object_name = resolve_object_name(data['object_name']) if data.get('object_name') else None
+    return jsonify({"status": "sukses", "dibatalkan": scan_prefetcher.cancel(object_name)})
+
+
+# --- START WORKER ---
+def start_background_tasks():
+    if os.getenv("DATABASE_URL"):
+        threading.Thread(target=_prewarm_db_pool, daemon=True).start()
+        if QUIZ_SWEEP_INTERVAL > 0:
+            threading.Thread(target=_quiz_sweep_loop, name="quiz-sweep", daemon=True).start()
+
+
+def preload_for_fork():
+    # Dipanggil di proses master: semua yang read-only di-load sekarang biar dipakai bareng worker.
+    for module in HEAVY_MODULES:
+        module.load()
+    # Objek yang udah ada dipindah ke generasi permanen, biar GC di worker gak nyentuh
+    # (dan bikin salinan) halaman memori yang dibagi lewat copy-on-write.
+    gc.freeze()
+
+
+def after_fork():
+    # Dipanggil di tiap worker setelah fork (post_fork gunicorn).
+    get_gemini_client()
+    start_background_tasks()
+
+
+if APP_PRELOAD:
+    preload_for_fork()
+else:
+    start_background_tasks()
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
@@ -0,0 +1,238 @@
+import asyncio
+import base64
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from quart import Quart, g, jsonify, request
+
+import app
+
+# Mode ASGI buat produksi: endpoint yang paling sering dipanggil & paling lama nunggu jaringan
+# (/tanya-ai, /identifikasi-objek) dijalanin async di event loop, jadi satu worker bisa pegang
+# ratusan request yang lagi nunggu Gemini / edge-tts / Neon tanpa makan satu thread per request.
+# Endpoint lain tetap dilayani app Flask lewat jembatan WSGI -> ASGI. Jembatannya jalanin tiap
+# request Flask di thread pool (bukan satu thread bareng kayak WsgiToAsgi bawaan asgiref), jadi
+# /generate-quiz yang lama gak bikin /list-objects ikut antre.
+#
+# Jalanin:
+#   hypercorn -c hypercorn.toml asgi:application
+
+ASYNC_DB_POOL_MAX = int(os.getenv("ASYNC_DB_POOL_MAX", "20"))
+ASYNC_PATHS = {"/tanya-ai", "/identifikasi-objek"}
+# Thread buat request Flask + asyncio.to_thread() (sama-sama pakai default executor event loop).
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "32"))
+ASGI_WSGI_MAX_BODY = int(os.getenv("ASGI_WSGI_MAX_BODY", str(16 * 1024 * 1024)))
+
+async_app = Quart(__name__)
+flask_app = AsyncioWSGIMiddleware(app.app, max_body_size=ASGI_WSGI_MAX_BODY)
+db_pool = None
+
+
+@async_app.before_serving
+async def open_thread_pool():
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix="wsgi")
+    )
+
+
+@async_app.before_serving
+async def open_db_pool():
+    global db_pool
+    if not os.getenv("DATABASE_URL"):
+        return
+    db_pool = AsyncConnectionPool(
+        os.getenv("DATABASE_URL"),
+        min_size=app.DB_POOL_MIN,
+        max_size=ASYNC_DB_POOL_MAX,
+        timeout=app.DB_POOL_TIMEOUT,
+        check=AsyncConnectionPool.check_connection,
+        open=False,
+    )
+    await db_pool.open()
+    print(f"✅ Pool database async siap (maks {ASYNC_DB_POOL_MAX} koneksi).")
+
+
+@async_app.after_serving
+async def close_db_pool():
+    if db_pool is not None:
+        await db_pool.close()
+
+
+# Timing request sama kayak app Flask (contextvar di app.py): Server-Timing, ar_requests_total, histogram
+# "total", dan tahap yang dicatat di dalam (termasuk lewat asyncio.to_thread) masuk ke endpoint ini.
+@async_app.before_request
+async def start_request_timer():
+    g.request_timing_token = app.start_request_timing(request.endpoint)
+
+
+@async_app.after_request
+async def add_server_timing(response):
+    server_timing = app.finish_request_timing(response.status_code)
+    if server_timing:
+        response.headers["Server-Timing"] = server_timing
+    return response
+
+
+@async_app.teardown_request
+async def end_request_timer(error=None):
+    token = g.pop("request_timing_token", None)
+    if token is not None:
+        app.end_request_timing(token)
+
+
+async def warm_object_row(object_name):
+    # Isi cache baris objects pakai driver async, biar prepare_tanya_ai() gak perlu query sync.
+    # Balikin True kalau cache udah keisi (ketemu atau negatif).
+    found, _ = app.object_row_cache.get(object_name)
+    if found:
+        return True
+    if db_pool is None:
+        return False
+    try:
+        async with db_pool.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                # psycopg 3 otomatis nge-prepare query yang sering dipanggil di koneksi yang sama.
+                await cur.execute(app.PREPARED_QUERIES["select_object"], (object_name,))
+                row = await cur.fetchone()
+    except Exception as e:
+        print(f"⚠️ Gagal cek cache database (async): {e}")
+        return False
+    app.remember_object_row(object_name, row)
+    return True
+
+
+async def run_db_write(func, *args):
+    # Write-behind normalnya cuma put_nowait ke antrean. Kalau dimatiin (WRITE_BEHIND_ENABLED=0)
+    # tulisannya langsung lewat psycopg2, jadi dilempar ke thread biar event loop gak ketahan.
+    if app.WRITE_BEHIND_ENABLED:
+        func(*args)
+    else:
+        await asyncio.to_thread(func, *args)
+
+
+async def _request_option(name, data):
+    value = request.args.get(name)
+    if value is None and data:
+        value = data.get(name)
+    if value is None:
+        value = (await request.form).get(name)
+    return str(value or "").strip().lower()
+
+
+async def build_audio_payload(text, audio_mode):
+    if audio_mode != "url":
+        if not text:
+            return {"audio_base64": ""}
+        try:
+            audio_bytes = await app.generate_audio_bytes_async(text)
+        except Exception as e:
+            print(f"⚠️ Error generate Neural TTS: {e}")
+            return {"audio_base64": ""}
+        return {"audio_base64": base64.b64encode(audio_bytes).decode('utf-8')}
+
+    if not text:
+        return {"audio_id": "", "audio_url": ""}
+    try:
+        audio_bytes = await app.generate_audio_bytes_async(text)
+    except Exception as e:
+        print(f"⚠️ Error generate Neural TTS: {e}")
+        audio_bytes = b""
+    if not audio_bytes:
+        return {"audio_id": "", "audio_url": ""}
+    audio_id = app.AudioCache.make_key(app.TTS_VOICE, text)
+    return {"audio_id": audio_id, "audio_url": f"/audio/{audio_id}"}
+
+
+@async_app.route('/identifikasi-objek', methods=['POST'])
+async def identifikasi_objek():
+    files = await request.files
+    data = await request.get_json(silent=True) if request.is_json else None
+    if 'file' in files:
+        image = app.decode_image(files['file'].stream)
+    elif data and 'image_base64' in data:
+        image = app.decode_image(io.BytesIO(base64.b64decode(data['image_base64'])))
+    else:
+        return jsonify({"status": "gagal", "pesan": "Kirim file gambar atau JSON image_base64"}), 400
+
+    try:
+        refresh = await _request_option("refresh", data) in ("1", "true")
+        object_name = await app.identify_object_async(image, refresh=refresh)
+
+        audio_mode = await _request_option("audio_mode", data)
+        audio_payload = await build_audio_payload("", audio_mode)
+        if object_name and object_name != "unknown":
+            await run_db_write(app.write_behind.enqueue, "insert_object", object_name)
+            app.note_object_inserted(object_name)
+            app.prefetch_after_scan(object_name, await _request_option("prefetch", data))
+            audio_payload = await build_audio_payload(f"I see a {object_name}", audio_mode)
+
+        return jsonify({"status": "sukses", "object_name": object_name, **audio_payload})
+    except Exception as e:
+        return jsonify({"status": "gagal", "pesan": str(e)}), 500
+
+
+@async_app.route('/tanya-ai', methods=['POST'])
+async def tanya_ai():
+    data = await request.get_json(silent=True)
+    if not data or 'object_name' not in data or 'question_key' not in data:
+        return jsonify({"status": "gagal", "pesan": "Data tidak lengkap"}), 400
+
+    object_name = app.resolve_object_name(data['object_name'])
+    if not object_name:
+        return jsonify({"status": "gagal", "pesan": "Nama objek tidak valid"}), 400
+    question_key = data['question_key']
+    custom_question = data.get('custom_question', '')
+    audio_mode = await _request_option("audio_mode", data)
+
+    # Pertanyaan custom bisa manggil Gemini buat cek relevansi, dan kalau cache baris belum keisi
+    # prepare_tanya_ai() bakal query sync: dua-duanya dilempar ke thread biar event loop gak ketahan.
+    blocking = question_key == "custom" or (
+        question_key in app.TANYA_AI_CACHE_KEYS and not await warm_object_row(object_name)
+    )
+    if blocking:
+        kind, value = await asyncio.to_thread(app.prepare_tanya_ai, object_name, question_key, custom_question)
+    else:
+        kind, value = app.prepare_tanya_ai(object_name, question_key, custom_question)
+
+    if kind == "gagal":
+        pesan, status_code = value
+        return jsonify({"status": "gagal", "pesan": pesan}), status_code
+    if kind == "jawaban":
+        return jsonify({"status": "sukses", "jawaban": value, **await build_audio_payload(value, audio_mode)})
+
+    try:
+        try:
+            response = await app.call_gemini_async(
+                contents=value,
+                task=app.tanya_task(question_key),
+                idempotency_key=(request.headers.get("Idempotency-Key") or "").strip()[:200] or None,
+            )
+        except Exception as gemini_error:
+            # Mode darurat: Gemini error / kena limit, coba jawab dari dataset.
+            jawaban_darurat = app.local_answer(object_name, question_key, custom_question, degraded=True)
+            if not jawaban_darurat:
+                raise
+            print(f"⚠️ Gemini gagal ({gemini_error}), pakai jawaban lokal untuk {object_name}.")
+            audio_payload = await build_audio_payload(jawaban_darurat, audio_mode)
+            return jsonify({"status": "sukses", "jawaban": jawaban_darurat, **audio_payload})
+
+        jawaban_ai = (response.text or "").strip() or app.TANYA_AI_FALLBACK_ANSWER
+        audio_payload = await build_audio_payload(jawaban_ai, audio_mode)
+        if question_key in app.TANYA_AI_CACHE_KEYS:
+            await run_db_write(app._save_cached_answer, object_name, question_key, jawaban_ai)
+        return jsonify({"status": "sukses", "jawaban": jawaban_ai, **audio_payload})
+
+    except Exception as e:
+        return jsonify({"status": "gagal", "pesan": str(e)}), 500
+
+
+async def application(scope, receive, send):
+    # Lifespan ke Quart (buka/tutup pool async), endpoint async ke Quart, sisanya ke Flask.
+    if scope["type"] == "lifespan" or (scope["type"] == "http" and scope["path"] in ASYNC_PATHS):
+        await async_app(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
@@ -0,0 +1,712 @@
+import argparse
+import asyncio
+import importlib
+import io
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from contextlib import contextmanager, redirect_stdout
+
+import psycopg2
+from PIL import Image, PngImagePlugin
+
+# Benchmark offline: app Flask dijalanin di proses ini, tapi Gemini, edge-tts & Postgres diganti
+# stand-in lokal yang latensi & error rate-nya bisa diatur. Jadi overhead server sendiri bisa diukur
+# & dibandingin antar versi tanpa makan kuota (beda sama tesqna.py yang nembak server produksi).
+#
+# Workload campuran (scan, pertanyaan template, pertanyaan custom, quiz, TTS soal, dan batch template
+# kalau diaktifkan lewat --mix) diputar dengan concurrency yang naik bertahap. Hasilnya (throughput,
+# p50/p95/p99 per endpoint, rasio cache hit, rincian Server-Timing) ditulis ke file JSON yang bisa
+# di-diff antar versi.
+#
+# Contoh:
+#   python benchmark.py
+#   python benchmark.py --stages 1:10,8:20,32:20 --gemini-latency 1.2 --gemini-error-rate 0.05
+#   python benchmark.py --output after.json --compare before.json
+
+app = None
+
+WORKLOADS = {
+    "scan": "/identifikasi-objek",
+    "template": "/tanya-ai",
+    "custom": "/tanya-ai",
+    "quiz": "/generate-quiz",
+    "tts": "/tts-soal",
+    "batch": "/tanya-ai/batch",
+}
+TEMPLATE_KEYS = ("definisi", "fungsi", "kalimat", "ejaan")
+TTS_SENTENCES = (
+    "What is a {obj} for?",
+    "Where do you keep the {obj}?",
+    "I put my .... on the table.",
+    "What is the {obj} made of?",
+)
+
+
+def log(message):
+    # Output app dibuang selama benchmark, jadi progress ditulis langsung ke stdout asli.
+    print(message, file=sys.__stdout__, flush=True)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class Injector:
+    # Latensi = rata-rata ±50% (uniform), error dilempar sesuai error rate.
+    def __init__(self, name, latency, error_rate, seed):
+        self.name = name
+        self.latency = latency
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def draw(self):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency * self._rng.uniform(0.5, 1.5) if self.latency > 0 else 0.0
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            return delay, fail
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "injected_errors": self.errors, "latency_s": self.latency, "error_rate": self.error_rate}
+
+
+# --- STAND-IN GEMINI ---
+class FakeApiError(Exception):
+    def __init__(self, code):
+        super().__init__(f"{code} fake upstream error")
+        self.code = code
+
+
+class FakeGemini:
+    # Meniru client google-genai secukupnya: models.generate_content(_stream) & aio.models.generate_content.
+    # Jawabannya ditebak dari isi prompt, jadi jalur validasi (quiz, relevansi, scan) tetap kepakai.
+    def __init__(self, injector, bad_quiz_rate, seed, unrelated_phrases):
+        self.injector = injector
+        self.bad_quiz_rate = bad_quiz_rate
+        self.unrelated_phrases = unrelated_phrases
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.models = types.SimpleNamespace(
+            generate_content=self.generate_content,
+            generate_content_stream=self.generate_content_stream,
+        )
+        self.aio = types.SimpleNamespace(models=types.SimpleNamespace(generate_content=self.generate_content_async))
+
+    @staticmethod
+    def _response(text, prompt_tokens):
+        usage = types.SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=max(1, len(text) // 4),
+            thoughts_token_count=0,
+            cached_content_token_count=0,
+        )
+        return types.SimpleNamespace(text=text, usage_metadata=usage)
+
+    def _fail_if_needed(self, fail):
+        if fail:
+            with self._lock:
+                code = self._rng.choice((429, 503))
+            raise FakeApiError(code)
+
+    def _answer(self, contents):
+        parts = contents if isinstance(contents, list) else [contents]
+        images = [part for part in parts if isinstance(part, Image.Image)]
+        prompt = " ".join(part for part in parts if isinstance(part, str))
+        tokens = max(1, len(prompt) // 4) + 258 * len(images)
+        if images and "mengidentifikasi benda" in prompt:
+            return images[0].info.get("object", "unknown"), tokens
+        if "RELATED or UNRELATED" in prompt:
+            question = prompt.split("Question:", 1)[-1].lower()
+            unrelated = any(phrase in question for phrase in self.unrelated_phrases)
+            return ("UNRELATED" if unrelated else "RELATED"), tokens
+        batch = re.search(r"exactly these keys: (\[.*?\])", prompt)
+        if batch:
+            obj = re.search(r"about the same object '(.+?)'", prompt).group(1)
+            return json.dumps({key: f"A {obj} is a useful thing at home." for key in json.loads(batch.group(1))}), tokens
+        quiz = re.search(r"quiz about the physical object '(.+?)'", prompt)
+        if quiz:
+            count = int((re.search(r"Generate exactly (\d+) questions", prompt) or [0, 10])[1])
+            return json.dumps(self._quiz(quiz.group(1), count)), tokens
+        obj = re.search(r"Treat '(.+?)' strictly", prompt)
+        name = obj.group(1) if obj else "thing"
+        if images:
+            return f"It is a {name}, and it is on the table.", tokens
+        return f"A {name} is a useful thing at home.", tokens
+
+    def _quiz(self, obj, count):
+        with self._lock:
+            rng = random.Random(self._rng.random())
+            bad = self._rng.random() < self.bad_quiz_rate
+        distractors = [word for word in ("spoon", "shoe", "cup", "pillow", "door", "clock", "bag", "lamp") if word not in obj]
+
+        def options(correct):
+            wrong = rng.sample([word for word in distractors if word != correct], 3)
+            choices = [correct] + wrong
+            rng.shuffle(choices)
+            return [f"{prefix}{choice}" for prefix, choice in zip(("A) ", "B) ", "C) ", "D) "), choices)], choices.index(correct)
+
+        blanks = ["I put my .... on the desk.", "My mother buys a new .....", "There is a .... in my room.",
+                  "I clean the .... every day.", "Look at that .... over there."]
+        translations = ['What is "benda ini" in English?', 'What is "barang itu" in English?']
+        others = [
+            (f"What is a {obj} for?", "reading"),
+            (f"Where is the {obj}?", "bedroom"),
+            (f"What is the {obj} made of?", "plastic"),
+            (f"What color is the {obj}?", "brown"),
+            (f"What part of the {obj} is big?", "top"),
+        ]
+        rng.shuffle(blanks)
+        items = []
+        for question in blanks[:3]:
+            opts, index = options(obj)
+            items.append({"question": question, "options": opts, "correct_index": index})
+        for question in translations:
+            opts, index = options(obj)
+            items.append({"question": question, "options": opts, "correct_index": index})
+        for question, correct in others:
+            opts, index = options(correct)
+            items.append({"question": question, "options": opts, "correct_index": index})
+        items = items[:count]
+        if bad and items:
+            # Satu soal sengaja dibikin gak lolos validasi (yes/no) biar jalur salvage kepakai.
+            items[-1] = dict(items[-1], question=f"Is the {obj} in the kitchen?")
+        return items
+
+    def generate_content(self, model=None, contents=None, config=None):
+        delay, fail = self.injector.draw()
+        time.sleep(delay)
+        self._fail_if_needed(fail)
+        return self._response(*self._answer(contents))
+
+    async def generate_content_async(self, model=None, contents=None, config=None):
+        delay, fail = self.injector.draw()
+        await asyncio.sleep(delay)
+        self._fail_if_needed(fail)
+        return self._response(*self._answer(contents))
+
+    def generate_content_stream(self, model=None, contents=None, config=None):
+        delay, fail = self.injector.draw()
+        text, tokens = self._answer(contents)
+        words = text.split(" ")
+        time.sleep(delay / 2)
+        self._fail_if_needed(fail)
+        for index, word in enumerate(words):
+            time.sleep(delay / 2 / len(words))
+            chunk = word if index == 0 else " " + word
+            yield self._response(chunk, tokens) if index == len(words) - 1 else types.SimpleNamespace(text=chunk)
+
+
+# --- STAND-IN EDGE-TTS ---
+def make_fake_stream_audio(injector):
+    async def _stream_audio(text, voice, on_chunk=None):
+        delay, fail = injector.draw()
+        await asyncio.sleep(delay)
+        if fail:
+            raise ConnectionError("fake edge-tts error")
+        # Kira-kira sebesar MP3 asli: ~1 KB per kata.
+        data = (text.encode("utf-8") + b"\x00") * max(1, 1024 * len(text.split()) // (len(text) + 1))
+        if on_chunk is not None:
+            on_chunk(data)
+        return data
+    return _stream_audio
+
+
+# --- STAND-IN POSTGRES ---
+class FakeDatabase:
+    def __init__(self, query_injector, acquire_injector):
+        self.query = query_injector
+        self.acquire = acquire_injector
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.quizzes = {}
+        self.bank = {}
+
+    def seed_object(self, name, answers):
+        row = {"object_name": name, **{column: None for column in app.OBJECT_ANSWER_COLUMNS}}
+        row.update(answers)
+        self.objects[name] = row
+
+    def _pause(self, injector):
+        delay, fail = injector.draw()
+        time.sleep(delay)
+        if fail:
+            raise psycopg2.OperationalError("fake database error")
+
+    def run(self, sql, params):
+        self._pause(self.query)
+        sql = " ".join(sql.split())
+        with self.lock:
+            if sql.startswith("SELECT object_name, definisi"):
+                row = self.objects.get(params[0])
+                return [dict(row)] if row else []
+            if sql.startswith("SELECT DISTINCT object_name"):
+                return [(name,) for name in self.objects]
+            if sql.startswith("INSERT INTO objects"):
+                self._insert_objects([params])
+            elif sql.startswith("SELECT questions_json"):
+                row = self.quizzes.get(params[0])
+                return [row] if row else []
+            elif sql.startswith("INSERT INTO quizzes"):
+                self._upsert_quizzes([params])
+            elif sql.startswith("SELECT question_type, item"):
+                return [(qtype, json.loads(item)) for qtype, item in self.bank.get(params[0], {}).values()]
+            return []
+
+    def run_values(self, sql, rows):
+        self._pause(self.query)
+        sql = " ".join(sql.split())
+        with self.lock:
+            if sql.startswith("INSERT INTO objects"):
+                self._insert_objects(rows)
+            elif sql.startswith("UPDATE objects"):
+                column = re.match(r"UPDATE objects AS o SET (\w+)", sql).group(1)
+                for name, value in rows:
+                    if name in self.objects:
+                        self.objects[name][column] = value
+            elif sql.startswith("INSERT INTO quizzes"):
+                self._upsert_quizzes(rows)
+            elif sql.startswith("INSERT INTO question_bank"):
+                for name, key, qtype, item in rows:
+                    self.bank.setdefault(name, {}).setdefault(key, (qtype, item))
+
+    def _insert_objects(self, rows):
+        for (name,) in rows:
+            if name not in self.objects:
+                self.objects[name] = {"object_name": name, **{column: None for column in app.OBJECT_ANSWER_COLUMNS}}
+
+    def _upsert_quizzes(self, rows):
+        for name, text, _questions, version, digest in rows:
+            self.quizzes[name] = (text, version, digest)
+
+
+class FakeCursor:
+    def __init__(self, conn, dict_rows):
+        self.connection = conn
+        self.dict_rows = dict_rows
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=()):
+        rows = self.connection.db.run(sql, params)
+        self._rows = [row if self.dict_rows or not isinstance(row, dict) else tuple(row.values()) for row in rows]
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+
+class FakeConnection:
+    # prepared = None -> execute_prepared() pakai jalur cur.execute biasa.
+    prepared = None
+    closed = False
+
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self, dict_rows=cursor_factory is not None)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakePool:
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.Lock()
+        self._acquired = 0
+
+    @contextmanager
+    def connection(self):
+        self.db._pause(self.db.acquire)
+        with self._lock:
+            self._acquired += 1
+        yield FakeConnection(self.db)
+
+    def stats(self):
+        with self._lock:
+            return {"fake": True, "acquired": self._acquired}
+
+    def close(self):
+        pass
+
+
+def fake_execute_values(db):
+    def execute_values(cur, sql, argslist, template=None, page_size=100):
+        db.run_values(sql, [tuple(row) for row in argslist])
+    return execute_values
+
+
+# --- WORKLOAD ---
+def scan_frames(objects, variants, seed):
+    # Tiap objek punya pola dasar sendiri; variasinya cuma noise kecil (kayak kamera goyang),
+    # jadi cache hash perceptual bisa kena juga.
+    rng = random.Random(seed)
+    frames = {}
+    for name in objects + ["unknown"]:
+        base = [rng.randrange(256) for _ in range(16 * 16)]
+        frames[name] = []
+        for _ in range(variants):
+            image = Image.new("L", (16, 16))
+            image.putdata([max(0, min(255, value + rng.randint(-3, 3))) for value in base])
+            image = image.resize((160, 160)).convert("RGB")
+            info = PngImagePlugin.PngInfo()
+            info.add_text("object", name)
+            buffer = io.BytesIO()
+            image.save(buffer, "PNG", pnginfo=info)
+            frames[name].append(buffer.getvalue())
+    return frames
+
+
+class Workload:
+    def __init__(self, objects, mix, frames, related, unrelated, audio_mode, force_quiz_rate):
+        self.objects = objects
+        # Objek populer lebih sering ditanya (kira-kira Zipf).
+        self.weights = [1 / (index + 1) for index in range(len(objects))]
+        self.kinds = list(mix)
+        self.kind_weights = [mix[kind] for kind in self.kinds]
+        self.frames = frames
+        self.related = related
+        self.unrelated = unrelated
+        self.audio_mode = audio_mode
+        self.force_quiz_rate = force_quiz_rate
+
+    def next_request(self, rng):
+        kind = rng.choices(self.kinds, self.kind_weights)[0]
+        obj = rng.choices(self.objects, self.weights)[0]
+        extra = {"audio_mode": self.audio_mode} if self.audio_mode else {}
+        if kind == "scan":
+            name = "unknown" if rng.random() < 0.05 else obj
+            frame = rng.choice(self.frames[name])
+            return kind, {"data": {"file": (io.BytesIO(frame), "scan.png"), **extra}, "content_type": "multipart/form-data"}
+        if kind == "template":
+            return kind, {"json": {"object_name": obj, "question_key": rng.choice(TEMPLATE_KEYS), **extra}}
+        if kind == "custom":
+            pool = self.related if rng.random() < 0.8 else self.unrelated
+            return kind, {"json": {"object_name": obj, "question_key": "custom", "custom_question": rng.choice(pool), **extra}}
+        if kind == "batch":
+            return kind, {"json": {"object_name": obj, **extra}}
+        if kind == "quiz":
+            return kind, {"json": {"object_name": obj, "force_regenerate": rng.random() < self.force_quiz_rate}}
+        return kind, {"json": {"text": rng.choice(TTS_SENTENCES).format(obj=obj), **extra}}
+
+
+def parse_server_timing(header):
+    stages = {}
+    for part in (header or "").split(","):
+        fields = part.strip().split(";")
+        name = fields[0].strip()
+        for field in fields[1:]:
+            if field.strip().startswith("dur="):
+                try:
+                    stages[name] = float(field.strip()[4:])
+                except ValueError:
+                    pass
+    return stages
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = []
+        self.timings = {}
+
+    def add(self, kind, stage_index, latency_ms, ok, server_timing):
+        with self._lock:
+            self.samples.append((kind, stage_index, latency_ms, ok))
+            per_kind = self.timings.setdefault(kind, {})
+            for stage, ms in server_timing.items():
+                total, count = per_kind.get(stage, (0.0, 0))
+                per_kind[stage] = (total + ms, count + 1)
+
+
+def summarize(samples, duration):
+    by_kind = {}
+    for kind, _stage, latency_ms, ok in samples:
+        by_kind.setdefault(kind, []).append((latency_ms, ok))
+
+    def block(entries):
+        latencies = [latency for latency, _ in entries]
+        errors = sum(1 for _, ok in entries if not ok)
+        return {
+            "requests": len(entries),
+            "errors": errors,
+            "error_rate": round(errors / len(entries), 4) if entries else 0.0,
+            "throughput_rps": round(len(entries) / duration, 3) if duration else 0.0,
+            "mean_ms": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p95_ms": round(percentile(latencies, 95), 3),
+            "p99_ms": round(percentile(latencies, 99), 3),
+            "max_ms": round(max(latencies), 3) if latencies else 0.0,
+        }
+
+    every = [(latency, ok) for entries in by_kind.values() for latency, ok in entries]
+    return {
+        **block(every),
+        "endpoints": {kind: dict(block(entries), path=WORKLOADS[kind]) for kind, entries in sorted(by_kind.items())},
+    }
+
+
+def run_stage(stage_index, concurrency, duration, workload, recorder, seed):
+    deadline = time.monotonic() + duration
+
+    def worker(worker_index):
+        rng = random.Random(f"{seed}-{stage_index}-{worker_index}")
+        client = app.app.test_client()
+        while time.monotonic() < deadline:
+            kind, kwargs = workload.next_request(rng)
+            start = time.perf_counter()
+            try:
+                response = client.post(WORKLOADS[kind], **kwargs)
+                latency_ms = (time.perf_counter() - start) * 1000
+                body = response.get_json(silent=True) or {}
+                ok = response.status_code < 400 and body.get("status") != "gagal"
+                timing = parse_server_timing(response.headers.get("Server-Timing"))
+            except Exception:
+                latency_ms = (time.perf_counter() - start) * 1000
+                ok, timing = False, {}
+            recorder.add(kind, stage_index, latency_ms, ok, timing)
+
+    threads = [threading.Thread(target=worker, args=(index,), daemon=True) for index in range(concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.monotonic() - started
+
+
+def ratio(hits, total):
+    return round(hits / total, 4) if total else 0.0
+
+
+def cache_hit_ratios(stats):
+    tts = stats["tts_cache"]
+    objects = stats["object_cache"]
+    scans = stats["image_hash_cache"]
+    gateway = stats["gemini_gateway"]
+    relatedness = stats["relatedness"]
+    quiz = stats["quiz"]
+    quiz_cache = stats["quiz_cache"]
+    tts_hits = tts["memory_hits"] + tts["disk_hits"]
+    object_hits = objects["hits"] + objects["negative_hits"]
+    relatedness_total = relatedness["heuristic"] + relatedness["local"] + relatedness["gemini"] + relatedness["gemini_failed"]
+    return {
+        "tts_cache": ratio(tts_hits, tts_hits + tts["misses"]),
+        "object_cache": ratio(object_hits, object_hits + objects["misses"]),
+        "image_hash_cache": ratio(scans["hits"], scans["lookups"]),
+        "gemini_gateway_deduped": ratio(gateway["coalesced"] + gateway["idempotent_hits"], gateway["calls"]),
+        "relatedness_without_gemini": ratio(
+            relatedness["heuristic"] + relatedness["local"] + relatedness["memo_hits"],
+            relatedness_total + relatedness["memo_hits"],
+        ),
+        "quiz_stamped_cache": ratio(
+            quiz_cache["stamped_hits"],
+            quiz_cache["stamped_hits"] + quiz_cache["revalidated"] + quiz["quizzes"] + quiz["failed"],
+        ),
+        "quiz_from_bank": ratio(quiz["from_bank"], quiz["quizzes"]),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare_reports(previous, current):
+    log(f"📊 Dibanding {previous.get('meta', {}).get('git_commit') or 'laporan lama'}:")
+    old_endpoints = previous.get("overall", {}).get("endpoints", {})
+    for kind, now in current["overall"]["endpoints"].items():
+        before = old_endpoints.get(kind)
+        if not before:
+            log(f"   {kind:<9} (baru)")
+            continue
+        parts = []
+        for metric in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "error_rate"):
+            old, new = before.get(metric, 0.0), now[metric]
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            parts.append(f"{metric} {old} -> {new} ({change})")
+        log(f"   {kind:<9} " + " | ".join(parts))
+    for name, now in current["cache_hit_ratios"].items():
+        before = previous.get("cache_hit_ratios", {}).get(name)
+        if before is not None and before != now:
+            log(f"   cache {name}: {before} -> {now}")
+
+
+def parse_stages(spec):
+    stages = []
+    for part in spec.split(","):
+        concurrency, _, seconds = part.strip().partition(":")
+        stages.append((int(concurrency), float(seconds or 10)))
+    return stages
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.strip().partition("=")
+        if kind not in WORKLOADS:
+            raise SystemExit(f"❌ Workload '{kind}' gak dikenal (pilihan: {', '.join(WORKLOADS)}).")
+        mix[kind] = float(weight or 1)
+    return {kind: weight for kind, weight in mix.items() if weight > 0}
+
+
+def configure_environment(args, workdir):
+    # Harus sebelum import app: konfigurasinya dibaca pas import.
+    os.environ.pop("DATABASE_URL", None)
+    os.environ["GEMINI_API_KEY"] = "benchmark-fake-key"
+    os.environ.pop("FREE_TIER_GEMINI_API_KEY", None)
+    os.environ["TTS_CACHE_DIR"] = os.path.join(workdir, "tts_cache")
+    os.environ["RELATEDNESS_LOG_FILE"] = os.path.join(workdir, "relatedness_log.jsonl")
+    os.environ["MODEL_RATE_LIMIT_GEMINI"] = str(args.upstream_rpm)
+    os.environ["MODEL_RATE_LIMIT_FREE_TIER"] = str(args.upstream_rpm)
+    os.environ["GEMINI_RETRY_INITIAL_WAIT"] = str(args.retry_wait)
+    os.environ["SCAN_PREFETCH_ENABLED"] = "1" if args.prefetch else "0"
+
+
+def install_fakes(args, unrelated):
+    gemini = Injector("gemini", args.gemini_latency, args.gemini_error_rate, args.seed)
+    tts = Injector("tts", args.tts_latency, args.tts_error_rate, args.seed + 1)
+    db_query = Injector("db_query", args.db_latency, args.db_error_rate, args.seed + 2)
+    db_acquire = Injector("db_acquire", args.db_acquire_latency, 0.0, args.seed + 3)
+
+    fake_gemini = FakeGemini(gemini, args.bad_quiz_rate, args.seed, unrelated)
+    app.client = fake_gemini
+    app.model_router._clients = {provider: fake_gemini for provider in app.MODEL_PROVIDER_KEYS}
+    app.tts_worker._stream_audio = make_fake_stream_audio(tts)
+    db = FakeDatabase(db_query, db_acquire)
+    app._db_pool = FakePool(db)
+    # RealDictCursor cuma dipakai sebagai penanda cursor_factory di FakeConnection.cursor().
+    app.pg_extras = types.SimpleNamespace(execute_values=fake_execute_values(db), RealDictCursor=dict)
+    return db, [gemini, tts, db_query, db_acquire]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test & benchmark offline (Gemini, edge-tts, Postgres palsu).")
+    parser.add_argument("--stages", default="1:10,4:10,16:10,32:10", help="concurrency:detik, dipisah koma.")
+    parser.add_argument("--mix", default="scan=2,template=4,custom=2,quiz=1,tts=1", help="Bobot tiap workload.")
+    parser.add_argument("--objects", type=int, default=20, help="Jumlah objek (dari dataset) yang diputar.")
+    parser.add_argument("--warm-db", type=float, default=0.5, help="Porsi objek yang jawabannya udah ada di DB.")
+    parser.add_argument("--scan-variants", type=int, default=4, help="Variasi frame per objek buat scan.")
+    parser.add_argument("--force-quiz-rate", type=float, default=0.05, help="Porsi request quiz yang force_regenerate.")
+    parser.add_argument("--audio-mode", default="", help="Kosong = base64, 'url' = audio_id/audio_url.")
+    parser.add_argument("--prefetch", action="store_true", help="Nyalain prefetch spekulatif setelah scan.")
+    parser.add_argument("--gemini-latency", type=float, default=0.6)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.02)
+    parser.add_argument("--bad-quiz-rate", type=float, default=0.2, help="Porsi respon quiz yang satu soalnya gak valid.")
+    parser.add_argument("--tts-latency", type=float, default=0.3)
+    parser.add_argument("--tts-error-rate", type=float, default=0.01)
+    parser.add_argument("--db-latency", type=float, default=0.02)
+    parser.add_argument("--db-acquire-latency", type=float, default=0.001)
+    parser.add_argument("--db-error-rate", type=float, default=0.0)
+    parser.add_argument("--upstream-rpm", type=float, default=100000, help="Batas token bucket ke model (per menit).")
+    parser.add_argument("--retry-wait", type=float, default=0.05, help="Jeda awal retry Gemini (detik).")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument("--compare", help="Laporan JSON lama buat dibandingin.")
+    parser.add_argument("--verbose", action="store_true", help="Jangan buang print dari app.")
+    args = parser.parse_args()
+
+    stages = parse_stages(args.stages)
+    mix = parse_mix(args.mix)
+    workdir = tempfile.mkdtemp(prefix="ar-benchmark-")
+    configure_environment(args, workdir)
+
+    global app
+    quiet = open(os.devnull, "w") if not args.verbose else sys.stdout
+    with redirect_stdout(quiet):
+        app = importlib.import_module("app")
+        from train_relatedness import RELATED_TEMPLATES, UNRELATED_TEMPLATES
+
+    db, injectors = install_fakes(args, UNRELATED_TEMPLATES)
+    rng = random.Random(args.seed)
+    objects = rng.sample(sorted(app.KNOWLEDGE_BASE), min(args.objects, len(app.KNOWLEDGE_BASE)))
+    for name in objects[: int(len(objects) * args.warm_db)]:
+        db.seed_object(name, {column: f"A {name} is a useful thing at home." for column in app.OBJECT_ANSWER_COLUMNS})
+    workload = Workload(
+        objects, mix, scan_frames(objects, args.scan_variants, args.seed),
+        RELATED_TEMPLATES, UNRELATED_TEMPLATES, args.audio_mode, args.force_quiz_rate,
+    )
+
+    log(f"🚀 Benchmark {len(objects)} objek, workload {mix}, tahap {stages}")
+    recorder = Recorder()
+    stage_reports = []
+    total_duration = 0.0
+    with redirect_stdout(quiet):
+        for index, (concurrency, seconds) in enumerate(stages):
+            duration = run_stage(index, concurrency, seconds, workload, recorder, args.seed)
+            total_duration += duration
+            summary = summarize([sample for sample in recorder.samples if sample[1] == index], duration)
+            stage_reports.append({"concurrency": concurrency, "duration_s": round(duration, 3), **summary})
+            log(
+                f"   c={concurrency:<3} {summary['requests']} request, {summary['throughput_rps']} rps, "
+                f"p50 {summary['p50_ms']} ms, p95 {summary['p95_ms']} ms, p99 {summary['p99_ms']} ms, "
+                f"error {summary['error_rate']}"
+            )
+        app.scan_prefetcher.cancel()
+        app.write_behind.flush(timeout=30)
+        stats = app.collect_stats()
+
+    report = {
+        "meta": {
+            "git_commit": git_commit(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": sys.version.split()[0],
+            "config": vars(args),
+            "objects": objects,
+        },
+        "stages": stage_reports,
+        "overall": {"duration_s": round(total_duration, 3), **summarize(recorder.samples, total_duration)},
+        "cache_hit_ratios": cache_hit_ratios(stats),
+        # Rata-rata tiap tahap di server (ms) per workload, dari header Server-Timing.
+        "server_timing_ms": {
+            kind: {stage: round(total / count, 3) for stage, (total, count) in sorted(per_stage.items())}
+            for kind, per_stage in sorted(recorder.timings.items())
+        },
+        "upstream": {injector.name: injector.stats() for injector in injectors},
+        "app_stats": stats,
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2, default=str)
+    log(f"💾 Laporan ditulis ke {args.output}")
+    log(f"   cache hit: {report['cache_hit_ratios']}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            compare_reports(json.load(file), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import os
+
+# Launcher prefork (WSGI) dengan preload:
+#   gunicorn -c gunicorn.conf.py app:app
+# Master import app.py sekali (modul berat, snapshot KNOWLEDGE_BASE, index RAG), lalu fork worker.
+# Worker pakai memori itu bareng lewat copy-on-write, jadi nambah worker / autoscale gak bayar
+# waktu import lagi. Koneksi DB, client Gemini & thread background dibuka per worker di post_fork.
+os.environ.setdefault("APP_PRELOAD", "1")
+
+bind = [os.getenv("GUNICORN_BIND", "0.0.0.0:5001")]
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+preload_app = True
+timeout = 120
+keepalive = 75
+graceful_timeout = 15
+accesslog = "-"
+errorlog = "-"
+
+
+def post_fork(server, worker):
+    import app
+
+    app.after_fork()
@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Benchmark waktu start worker: tiap skenario jalan di proses Python baru (biar cache import gak kebawa).
+#   lazy_cold     : import lazy, snapshot KNOWLEDGE_BASE belum ada (parse CSV + bikin index + simpan)
+#   lazy_snapshot : import lazy, snapshot udah ada (mode normal setelah boot pertama / build)
+#   preload       : APP_PRELOAD=1, semua modul berat di-import di depan (yang dibayar master gunicorn sekali)
+#   forked_worker : master preload lalu fork; diukur dari fork sampai worker selesai request pertama
+#
+# Contoh:
+#   python startup_benchmark.py
+#   python startup_benchmark.py --runs 10 --output startup_report.json
+
+SCENARIOS = ("lazy_cold", "lazy_snapshot", "preload", "forked_worker")
+
+CHILD = r"""
+import json, os, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+
+
+def max_rss_kb():
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        return None
+
+
+def first_request():
+    begin = time.perf_counter()
+    app.app.test_client().get("/")
+    return (time.perf_counter() - begin) * 1000
+
+
+result = {"import_ms": (imported - start) * 1000}
+if os.environ.get("STARTUP_BENCH_FORK") == "1":
+    read_fd, write_fd = os.pipe()
+    forked = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        app.after_fork()
+        ready_ms = first_request()
+        child = {"worker_ready_ms": (time.perf_counter() - forked) * 1000, "first_request_ms": ready_ms}
+        os.write(write_fd, json.dumps(child).encode())
+        os._exit(0)
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    with os.fdopen(read_fd) as pipe:
+        result.update(json.loads(pipe.read()))
+else:
+    result["first_request_ms"] = first_request()
+    begin = time.perf_counter()
+    app.get_gemini_client()
+    result["gemini_client_ms"] = (time.perf_counter() - begin) * 1000
+result["max_rss_kb"] = max_rss_kb()
+sys.__stdout__.write("STARTUP_RESULT " + json.dumps(result) + "\n")
+"""
+
+
+def run_child(env):
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-c", CHILD], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, timeout=120,
+    )
+    process_ms = (time.perf_counter() - start) * 1000
+    for line in completed.stdout.splitlines():
+        if line.startswith("STARTUP_RESULT "):
+            return {"process_ms": process_ms, **json.loads(line[len("STARTUP_RESULT "):])}
+    raise RuntimeError(f"Proses benchmark gagal:\n{completed.stderr[-2000:]}")
+
+
+def scenario_env(name, snapshot_path):
+    env = dict(os.environ)
+    # Tanpa DB asli: yang diukur cuma biaya start, bukan handshake ke Neon.
+    env.pop("DATABASE_URL", None)
+    env.setdefault("GEMINI_API_KEY", "startup-benchmark-key")
+    env["RAG_INDEX_FILE"] = snapshot_path
+    env["APP_PRELOAD"] = "1" if name in ("preload", "forked_worker") else "0"
+    env["STARTUP_BENCH_FORK"] = "1" if name == "forked_worker" else "0"
+    if name == "lazy_cold" and os.path.exists(snapshot_path):
+        os.remove(snapshot_path)
+    return env
+
+
+def summarize(samples):
+    summary = {}
+    for key in samples[0]:
+        values = [sample[key] for sample in samples if sample.get(key) is not None]
+        if values:
+            summary[key] = {
+                "median": round(statistics.median(values), 2),
+                "min": round(min(values), 2),
+                "max": round(max(values), 2),
+            }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark waktu start worker app.py.")
+    parser.add_argument("--runs", type=int, default=5, help="Jumlah proses per skenario.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Skenario yang dijalankan, dipisah koma.")
+    parser.add_argument("--output", help="Simpan hasil ke file JSON.")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    if "forked_worker" in scenarios and not hasattr(os, "fork"):
+        print("⚠️ os.fork gak ada di OS ini, skenario forked_worker dilewati.")
+        scenarios.remove("forked_worker")
+
+    snapshot_path = os.path.join(tempfile.mkdtemp(prefix="ar-startup-"), "rag_index.json")
+    report = {"python": sys.version.split()[0], "runs": args.runs, "scenarios": {}}
+    for name in scenarios:
+        samples = [run_child(scenario_env(name, snapshot_path)) for _ in range(args.runs)]
+        report["scenarios"][name] = summarize(samples)
+        medians = ", ".join(f"{key} {value['median']}" for key, value in report["scenarios"][name].items())
+        print(f"⏱️ {name:<14} {medians}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"💾 Hasil disimpan ke {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+# Jalanin: python -m pytest -q
+# Harus sebelum import app: tanpa DB (gak ada thread background), tanpa nulis snapshot RAG ke disk.
+os.environ["DATABASE_URL"] = ""
+os.environ["RAG_INDEX_FILE"] = ""
+os.environ["APP_PRELOAD"] = "0"
+
+import pytest
+
+import app
+
+
+# --- JAWABAN LOKAL ---
+
+@pytest.mark.parametrize("object_name, question, expected", [
+    # Nama Indonesia yang ngandung "eja" (meja) bukan pertanyaan ejaan.
+    ("table", "apa bahasa inggrisnya meja ini?", "Meja in English is table."),
+    ("table lamp", "apa bahasa inggrisnya lampu meja ini?", "Lampu meja in English is table lamp."),
+    ("table", "apakah meja ini berat?", None),
+    ("table lamp", "lampu meja ini pakai listrik?", None),
+    ("table", "how do you spell it?", "Table is spelled T. A. B. L. E."),
+    ("table", "bagaimana cara mengeja meja ini?", "Table is spelled T. A. B. L. E."),
+    ("bed", "what is bed in indonesian?", "Bed in Indonesian is kasur."),
+    ("bed", "spell president", None),
+])
+def test_local_custom_answer(object_name, question, expected):
+    assert app.local_answer(object_name, "custom", question) == expected
+
+
+def test_location_answer_lists_every_room():
+    assert app.local_answer("table", "custom", "where is this table?") == (
+        "The table is usually in the living room or the bedroom."
+    )
+    assert app.local_answer("bed", "custom", "which room is it in?") == "The bed is usually in the bedroom."
+
+
+def test_template_local_answers():
+    assert app.local_answer("bed", "ejaan") == "B. E. D."
+    assert app.local_answer("bed", "kalimat") == "I sleep on the bed at night."
+    assert app.local_answer("bed", "definisi") is None
+    assert app.local_answer("bed", "definisi", degraded=True)
+
+
+# --- SNAPSHOT RAG ---
+
+def test_rag_snapshot_round_trips_through_json(tmp_path, monkeypatch):
+    snapshot = tmp_path / "rag_index.json"
+    monkeypatch.setattr(app, "RAG_INDEX_FILE", str(snapshot))
+    knowledge_base, index = app.load_knowledge_snapshot()
+    assert snapshot.read_text(encoding="utf-8").startswith("{")
+
+    loaded_base, loaded_index = app.load_knowledge_snapshot()
+    assert loaded_base == knowledge_base
+    for query in ("where do i sleep", "table lamp light", "kasur"):
+        assert loaded_index.search(query) == index.search(query)
+
+
+# --- RESOLVER NAMA BENDA ---
+
+@pytest.mark.parametrize("a, b, distance", [
+    ("television", "television", 0),
+    ("televison", "television", 1),
+    ("tabel lamp", "table lamp", 1),  # tukar dua huruf = 1
+    ("chair", "hair", 1),
+    ("paints", "pants", 1),
+    ("sofa", "carpet", 2),  # dipotong di limit + 1
+])
+def test_edit_distance(a, b, distance):
+    assert app.edit_distance(a, b, 1) == distance
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("televison", "television"),
+    ("tabel lamp", "table lamp"),
+    ("hair", None),
+    ("paints", None),
+    ("socket", None),
+])
+def test_fuzzy_match(name, expected):
+    assert app._fuzzy_match(name) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Books", "book"),
+    ("a book", "book"),
+    ("buku", "book"),
+    ("toy cars", "toy car"),
+    ("bookshelf", "bookcase"),
+    ("hair", "hair"),
+    ("paints", "paints"),
+    ("socket", "socket"),
+    ("!!!", ""),
+])
+def test_resolve_object_name(text, expected):
+    assert app.resolve_object_name(text) == expected
+
+
+# --- TtlLruCache ---
+
+def test_ttl_lru_cache_hits_and_negative_entries():
+    cache = app.TtlLruCache(10, ttl=60)
+    assert cache.get("a") == (False, None)
+    cache.set("a", 1)
+    cache.set("b", None)
+    assert cache.get("a") == (True, 1)
+    assert cache.get("b") == (True, None)
+    stats = cache.stats()
+    assert (stats["hits"], stats["negative_hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_ttl_lru_cache_expiry_and_eviction(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: now[0])
+    cache = app.TtlLruCache(2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")  # "a" jadi yang paling baru dipakai
+    cache.set("c", 3)
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1)
+    now[0] += 11
+    assert cache.get("a") == (False, None)
+    assert cache.stats()["expired"] == 1
+
+
+def test_ttl_lru_cache_update_only_touches_live_entries():
+    cache = app.TtlLruCache(10, ttl=60)
+    cache.update("missing", lambda value: value + 1)
+    assert cache.get("missing") == (False, None)
+    cache.set("a", 1)
+    cache.update("a", lambda value: value + 1)
+    assert cache.get("a") == (True, 2)
+
+
+# --- VALIDASI QUIZ ---
+
+def _options(correct, others=("lamp", "chair", "door")):
+    choices = [correct, *others]
+    return [f"{prefix}{choice}" for prefix, choice in zip(("A) ", "B) ", "C) ", "D) "), choices)]
+
+
+def _valid_quiz(obj="bed"):
+    blanks = ["I sleep on the .... at night.", "There is a .... in my room.", "I clean the .... every day."]
+    items = [{"question": q, "options": _options(obj), "correct_index": 0} for q in blanks]
+    items += [
+        {"question": 'What is "kasur" in English?', "options": _options(obj), "correct_index": 0},
+        {"question": 'What is "tempat tidur" in English?', "options": _options(obj), "correct_index": 0},
+        {"question": f"Where is the {obj}?", "options": _options("bedroom", ("kitchen", "garage", "garden")),
+         "correct_index": 0},
+        {"question": f"What is the {obj} made of?", "options": _options("wood", ("glass", "paper", "water")),
+         "correct_index": 0},
+        {"question": f"What color is the {obj}?", "options": _options("brown", ("blue", "green", "red")),
+         "correct_index": 0},
+        {"question": f"What is a {obj} for?", "options": _options("sleeping", ("cooking", "reading", "eating")),
+         "correct_index": 0},
+        {"question": f"What part of the {obj} is soft?", "options": _options("mattress", ("leg", "frame", "board")),
+         "correct_index": 0},
+    ]
+    return items
+
+
+def test_valid_quiz_passes():
+    quiz = _valid_quiz()
+    assert len(quiz) == app.QUIZ_SIZE
+    assert app._validate_quiz_payload("bed", quiz)
+
+
+@pytest.mark.parametrize("change", [
+    {"question": "Is the bed in the kitchen?"},  # yes/no
+    {"options": ["A) bed", "B) bed", "C) lamp", "D) door"]},  # opsi dobel
+    {"options": ["bed", "lamp", "chair", "door"]},  # tanpa prefix A)
+    {"correct_index": 4},
+])
+def test_invalid_quiz_item_is_rejected(change):
+    item = dict(_valid_quiz()[0], **change)
+    assert app._validate_quiz_item("bed", item) is None
+
+
+def test_translation_item_must_point_to_the_object():
+    item = {"question": 'What is "kasur" in English?', "options": _options("bed"), "correct_index": 1}
+    assert app._validate_quiz_item("bed", item) is None
+
+
+def test_salvage_keeps_only_valid_items():
+    quiz = _valid_quiz()
+    quiz[0] = dict(quiz[0], question="Is the bed big?")
+    salvaged = app._salvage_quiz_items("bed", quiz)
+    assert len(salvaged) == app.QUIZ_SIZE - 1
+    assert not app._validate_quiz_payload("bed", quiz)
+
+
+def test_assemble_quiz_reports_what_is_missing():
+    bank = app._salvage_quiz_items("bed", _valid_quiz())
+    quiz, needs = app.assemble_quiz(bank)
+    assert needs is None and app._validate_quiz_payload("bed", quiz)
+
+    without_translations = [entry for entry in bank if entry[0] != "translation"]
+    quiz, needs = app.assemble_quiz(without_translations)
+    assert quiz is None
+    assert needs == {"count": 2, "min_blank": 0, "min_translation": 1}
+
+
+def _fake_quiz_generation(monkeypatch, late_delay):
+    banked = []
+    variants = []
+
+    def attempt(object_name, excluded_questions, variant, needs):
+        variants.append(variant)
+        if variant:
+            app.time.sleep(late_delay)
+        return _valid_quiz(object_name)
+
+    monkeypatch.setattr(app, "_quiz_attempt", attempt)
+    monkeypatch.setattr(app, "load_question_bank", lambda object_name: [])
+    monkeypatch.setattr(app, "add_to_question_bank", lambda object_name, items: banked.append(len(items)))
+    return banked, variants
+
+
+def test_create_quiz_banks_candidates_that_lose_the_race(monkeypatch):
+    monkeypatch.setattr(app, "QUIZ_SPECULATIVE_CANDIDATES", 3)
+    banked, variants = _fake_quiz_generation(monkeypatch, late_delay=0.1)
+    assert app._validate_quiz_payload("bed", app.create_quiz("bed"))
+    deadline = app.time.monotonic() + 2
+    while len(banked) < 3 and app.time.monotonic() < deadline:
+        app.time.sleep(0.01)
+    assert sorted(variants) == [0, 1, 2]
+    assert banked == [app.QUIZ_SIZE] * 3
+
+
+def test_create_quiz_respects_max_candidates(monkeypatch):
+    banked, variants = _fake_quiz_generation(monkeypatch, late_delay=0)
+    assert app.create_quiz("bed", max_candidates=1)
+    assert variants == [0]
+
+
+
+def test_saved_and_loaded_quiz_share_bytes_and_etag(monkeypatch):
+    stored = {}
+    monkeypatch.setattr(app.write_behind, "enqueue", lambda op, name, text, version, digest: stored.update(
+        row=(text, version, digest)))
+    saved = app.save_quiz("bed", _valid_quiz(), log=False)
+
+    cursor = SimpleNamespace(fetchone=lambda: stored["row"])
+    conn = SimpleNamespace(cursor=lambda: nullcontext(cursor))
+    monkeypatch.setattr(app, "get_db_connection", lambda: nullcontext(conn))
+    monkeypatch.setattr(app, "ensure_schema", lambda conn: None)
+    monkeypatch.setattr(app, "execute_prepared", lambda cur, name, params: None)
+    app.quiz_entry_cache.delete("bed")
+    loaded = app.load_quiz_entry("bed")
+    app.quiz_entry_cache.delete("bed")
+
+    assert loaded == saved
+    assert loaded["hash"] == app.quiz_content_hash(loaded["raw"].decode("utf-8"))
+
+# --- ENDPOINT ---
+
+def test_tanya_ai_rejects_unreadable_object_name():
+    client = app.app.test_client()
+    for path in ("/tanya-ai", "/tanya-ai/stream"):
+        response = client.post(path, json={"object_name": "!!!", "question_key": "definisi"})
+        assert response.status_code == 400
+        assert response.get_json()["pesan"] == "Nama objek tidak valid"
+
+
+
+def test_request_metrics_and_server_timing():
+    client = app.app.test_client()
+    response = client.post("/tanya-ai", json={"object_name": "!!!", "question_key": "definisi"})
+    assert response.headers["Server-Timing"].startswith("total;dur=")
+    assert 'ar_requests_total{endpoint="tanya_ai",status="400"}' in app.metrics.render()
+    assert app._request_timing.get() is None
+
+
+def test_stage_timings_follow_the_request_into_worker_threads():
+    token = app.start_request_timing("demo")
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            app.submit_with_stage_timings(executor, app.record_stage, "worker", 0.03).result()
+        server_timing = app.finish_request_timing(200)
+        assert app.finish_request_timing(200) is None  # total cuma dicatat sekali
+    finally:
+        app.end_request_timing(token)
+    assert server_timing.startswith("worker;dur=30.0, total;dur=")
+    assert 'ar_stage_duration_seconds_count{endpoint="demo",stage="worker"} 1' in app.metrics.render()
+
+# --- RATE LIMIT ---
+
+def test_sync_rate_limit_fails_fast():
+    limiter = app.UpstreamRateLimiter({"gemini": 60}, 1, max_wait=5, sync_max_wait=0)
+    limiter.acquire("gemini")
+    start = app.time.monotonic()
+    with pytest.raises(app.UpstreamRateLimited):
+        limiter.acquire("gemini")
+    assert app.time.monotonic() - start < 0.1
+    limiter.acquire("free_tier")  # provider tanpa limit gak pernah ditolak
+    assert limiter.stats()["rejected"] == 1
+
+
+def test_router_falls_back_when_bucket_is_empty(monkeypatch):
+    limiter = app.UpstreamRateLimiter({"gemini": 60}, 1, max_wait=5, sync_max_wait=0)
+    limiter.acquire("gemini")
+    monkeypatch.setattr(app, "gemini_rate_limiter", limiter)
+    fake = SimpleNamespace(models=SimpleNamespace(
+        generate_content=lambda model, contents, config: SimpleNamespace(text=model),
+    ))
+    router = app.ModelRouter({"answer": app.parse_model_routes("gemini:utama@LOW,free_tier:cadangan@LOW")}, 30, 10)
+    router._clients = {"gemini": fake, "free_tier": fake}
+    assert router.generate("halo", "answer").text == "cadangan"
@@ -0,0 +1,178 @@
+import argparse
+import json
+import random
+import time
+
+import app
+
+# Latih model relevansi lokal yang dipakai is_related_custom_question() sebelum nanya Gemini.
+# Data latih: vonis Gemini yang tercatat di RELATEDNESS_LOG_FILE, ditambah contoh sintetis
+# dari dataset RAG biar model tetap bisa dipakai walaupun log masih kosong.
+# Server otomatis load ulang model baru (maks 60 detik setelah file diganti), gak perlu restart.
+#
+# Contoh:
+#   python train_relatedness.py
+#   python train_relatedness.py --no-synthetic --epochs 50
+#   python train_relatedness.py --bench          # cuma benchmark model yang sekarang
+
+
+RELATED_TEMPLATES = [
+    "can i wash it with water",
+    "how do i take care of this",
+    "how long does it usually last",
+    "is it dangerous for children",
+    "what is it made of",
+    "how heavy is it",
+    "who invented it",
+    "can you give me another example sentence",
+    "why do people need it at home",
+    "apakah benda ini bisa rusak",
+    "bagaimana cara membersihkannya",
+    "berapa lama bisa dipakai",
+    "siapa yang menemukannya",
+    "kenapa orang butuh benda itu",
+]
+
+UNRELATED_TEMPLATES = [
+    "who won the world cup",
+    "what is the weather today",
+    "how do i cook fried rice",
+    "tell me a joke about cats",
+    "what time is it now",
+    "how old are you",
+    "can you help me with my homework",
+    "what is your favorite song",
+    "how far is the moon",
+    "siapa nama kamu",
+    "hari ini hari apa",
+    "resep nasi goreng dong",
+    "lagu apa yang lagi viral",
+    "berapa jarak ke bulan",
+]
+
+
+def synthetic_examples(rng):
+    examples = []
+    names = list(app.KNOWLEDGE_BASE.keys())
+    for name in names:
+        for template in rng.sample(RELATED_TEMPLATES, 4):
+            examples.append((name, template, True))
+        for template in rng.sample(UNRELATED_TEMPLATES, 4):
+            examples.append((name, template, False))
+        # Nanya benda lain jelas-jelas: gak relevan buat benda yang lagi di-scan.
+        other = rng.choice([n for n in names if n != name and n not in name and name not in n] or [name])
+        if other != name:
+            examples.append((name, f"what is the function of {other}", False))
+    return examples
+
+
+def load_logged_examples(path):
+    # Kalau satu pasangan dicatat berkali-kali, vonis terakhir yang dipakai.
+    latest = {}
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                obj = str(row.get("object") or "").strip().lower()
+                question = " ".join(str(row.get("question") or "").lower().split())
+                if obj and question:
+                    latest[(obj, question)] = bool(row.get("related"))
+    except FileNotFoundError:
+        pass
+    return [(obj, question, label) for (obj, question), label in latest.items()]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def benchmark(model, examples):
+    # Simulasi jalur is_related_custom_question tanpa Gemini: berapa yang selesai di heuristik/model lokal,
+    # seberapa sering setuju sama label (vonis Gemini), dan berapa lama model lokal jalan.
+    resolved_heuristic = resolved_local = agree = 0
+    latencies_ms = []
+    for obj, question, label in examples:
+        verdict = app.relatedness_by_heuristics(obj, question)
+        if verdict is not None:
+            resolved_heuristic += 1
+        else:
+            start = time.perf_counter()
+            proba = model.predict_proba(obj, question)
+            latencies_ms.append((time.perf_counter() - start) * 1000)
+            if proba >= app.RELATEDNESS_CONFIDENCE:
+                verdict = True
+            elif proba <= 1 - app.RELATEDNESS_CONFIDENCE:
+                verdict = False
+            else:
+                continue
+            resolved_local += 1
+        if verdict == label:
+            agree += 1
+
+    total = len(examples) or 1
+    resolved = resolved_heuristic + resolved_local
+    return {
+        "examples": len(examples),
+        "resolved_heuristic": round(resolved_heuristic / total, 4),
+        "resolved_local_model": round(resolved_local / total, 4),
+        "escalated_to_gemini": round(1 - resolved / total, 4),
+        "agreement_when_resolved": round(agree / resolved, 4) if resolved else 0.0,
+        "local_ms_p50": round(percentile(latencies_ms, 50), 4),
+        "local_ms_p95": round(percentile(latencies_ms, 95), 4),
+        "local_ms_p99": round(percentile(latencies_ms, 99), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latih & benchmark model relevansi pertanyaan custom.")
+    parser.add_argument("--log", default=app.RELATEDNESS_LOG_FILE, help="File JSONL vonis Gemini.")
+    parser.add_argument("--output", default=app.RELATEDNESS_MODEL_FILE, help="Tujuan file model.")
+    parser.add_argument("--no-synthetic", action="store_true", help="Latih cuma dari log Gemini.")
+    parser.add_argument("--epochs", type=int, default=30)
+    parser.add_argument("--holdout", type=float, default=0.2, help="Porsi data buat evaluasi.")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--bench", action="store_true", help="Jangan latih, cuma benchmark model yang ada.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    logged = load_logged_examples(args.log)
+    examples = list(logged)
+    if not args.no_synthetic:
+        examples += synthetic_examples(rng)
+    if not examples:
+        print("❌ Gak ada data latih (log kosong dan --no-synthetic).")
+        return
+    print(f"📚 {len(logged)} vonis Gemini dari log, total {len(examples)} contoh.")
+
+    if args.bench:
+        model = app.RelatednessModel.load(args.output)
+        # Yang paling jujur dibenchmark itu vonis Gemini asli; contoh sintetis cuma kalau log kosong.
+        report = benchmark(model, logged or examples)
+        print(json.dumps(report, indent=2))
+        return
+
+    rng.shuffle(examples)
+    split = int(len(examples) * (1 - args.holdout))
+    train_set, test_set = examples[:split], examples[split:]
+    start = time.monotonic()
+    model = app.RelatednessModel.train(train_set, epochs=args.epochs, seed=args.seed)
+    print(f"✅ Model dilatih dari {len(train_set)} contoh dalam {round(time.monotonic() - start, 2)} detik.")
+    if test_set:
+        print("📊 Evaluasi holdout:")
+        print(json.dumps(benchmark(model, test_set), indent=2))
+
+    # Model final dilatih ulang pakai semua data.
+    model = app.RelatednessModel.train(examples, epochs=args.epochs, seed=args.seed)
+    model.save(args.output)
+    print(f"💾 Model disimpan ke {args.output} ({len(model.weights)} fitur).")
+
+
+if __name__ == "__main__":
+    main()
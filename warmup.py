@@ -0,0 +1,153 @@
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import app
+
+# Isi cache buat semua benda di dataset RAG sebelum kelas mulai:
+# jawaban template di tabel objects, quiz di tabel quizzes, audio jawaban, dan audio "I see a ...".
+# Aman dijalanin ulang: yang udah ada & valid dilewati, jadi kalau berhenti di tengah tinggal jalanin lagi.
+#
+# Contoh:
+#   python warmup.py
+#   python warmup.py --objects book lamp --workers 2 --gemini-concurrency 2
+#   python warmup.py --skip-quiz --skip-audio
+
+
+class Warmup:
+    def __init__(self, gemini_concurrency, skip_answers, skip_quiz, skip_audio):
+        self.gemini_slots = threading.BoundedSemaphore(max(1, gemini_concurrency))
+        self.skip_answers = skip_answers
+        self.skip_quiz = skip_quiz
+        self.skip_audio = skip_audio
+        self._lock = threading.Lock()
+        self.totals = {
+            "answers_generated": 0,
+            "answers_skipped": 0,
+            "quizzes_generated": 0,
+            "quizzes_skipped": 0,
+            "quizzes_failed": 0,
+            "audio_generated": 0,
+            "audio_skipped": 0,
+            "errors": 0,
+        }
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.totals[key] += amount
+
+    def _with_gemini(self, fn, *args, **kwargs):
+        # Batasi berapa panggilan Gemini yang jalan barengan biar gak kena rate limit.
+        with self.gemini_slots:
+            return fn(*args, **kwargs)
+
+    def _warm_answers(self, object_name):
+        app.write_behind.enqueue("insert_object", object_name)
+        row = app.read_object_row(object_name) or {}
+        answers = {}
+        for question_key in app.OBJECT_ANSWER_COLUMNS:
+            if row.get(question_key):
+                answers[question_key] = row[question_key]
+                self._count("answers_skipped")
+                continue
+            if self.skip_answers:
+                continue
+            jawaban = self._with_gemini(app.generate_template_answer, object_name, question_key)
+            if jawaban:
+                app.write_behind.enqueue("update_object", object_name, question_key, jawaban)
+                answers[question_key] = jawaban
+                self._count("answers_generated")
+        return answers
+
+    def _warm_quiz(self, object_name):
+        # Quiz lama yang masih lolos sekalian dicap versi validator terbaru.
+        if app.load_valid_quiz_entry(object_name):
+            self._count("quizzes_skipped")
+            return "ada"
+        # Satu slot = satu panggilan Gemini, jadi kandidat quiz-nya satu-satu (bukan fan-out
+        # QUIZ_SPECULATIVE_CANDIDATES) biar --gemini-concurrency beneran jadi batas atas.
+        quiz_data = self._with_gemini(app.create_quiz, object_name, max_candidates=1)
+        if not quiz_data:
+            self._count("quizzes_failed")
+            return "gagal"
+        app.save_quiz(object_name, quiz_data)
+        self._count("quizzes_generated")
+        return "baru"
+
+    def _warm_audio(self, texts):
+        generated = 0
+        for text in texts:
+            key = app.AudioCache.make_key(app.TTS_VOICE, text)
+            if app.audio_cache.get(key, record_stats=False):
+                self._count("audio_skipped")
+                continue
+            app.generate_audio_bytes(text)
+            generated += 1
+            self._count("audio_generated")
+        return generated
+
+    def warm_object(self, object_name):
+        start = time.monotonic()
+        answers = self._warm_answers(object_name)
+        quiz_status = "-" if self.skip_quiz else self._warm_quiz(object_name)
+        audio_new = 0
+        if not self.skip_audio:
+            audio_new = self._warm_audio([f"I see a {object_name}", *answers.values()])
+        return {
+            "object_name": object_name,
+            "answers": len(answers),
+            "quiz": quiz_status,
+            "audio_new": audio_new,
+            "seconds": round(time.monotonic() - start, 2),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Warmup cache jawaban, quiz, dan audio untuk semua benda di dataset RAG.")
+    parser.add_argument("--objects", nargs="*", help="Cuma warmup benda ini (default: semua benda di dataset).")
+    parser.add_argument("--workers", type=int, default=4, help="Berapa benda diproses barengan.")
+    parser.add_argument("--gemini-concurrency", type=int, default=2, help="Maks panggilan Gemini barengan.")
+    parser.add_argument("--skip-answers", action="store_true", help="Jangan generate jawaban template yang kosong.")
+    parser.add_argument("--skip-quiz", action="store_true", help="Jangan cek/generate quiz.")
+    parser.add_argument("--skip-audio", action="store_true", help="Jangan generate audio.")
+    args = parser.parse_args()
+
+    # Nama dari --objects lewat resolver yang sama dengan endpoint (jamak/alias/typo), biar
+    # yang di-warmup persis baris yang nanti dibaca Unity. Yang gak kebaca dibuang.
+    object_names = [name.strip().lower() for name in app.KNOWLEDGE_BASE.keys()]
+    if args.objects:
+        object_names = [name for name in dict.fromkeys(app.resolve_object_name(raw) for raw in args.objects) if name]
+        if not object_names:
+            parser.error("--objects gak ada yang valid")
+    warmup = Warmup(args.gemini_concurrency, args.skip_answers, args.skip_quiz, args.skip_audio)
+
+    print(f"🚀 Warmup {len(object_names)} benda ({args.workers} worker, Gemini maks {args.gemini_concurrency} barengan)...")
+    start_total = time.monotonic()
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {executor.submit(warmup.warm_object, name): name for name in object_names}
+        for future in as_completed(futures):
+            done += 1
+            name = futures[future]
+            try:
+                result = future.result()
+                print(
+                    f"✅ [{done}/{len(object_names)}] {name}: jawaban {result['answers']}/4, "
+                    f"quiz {result['quiz']}, audio baru {result['audio_new']} ({result['seconds']} detik)"
+                )
+            except Exception as e:
+                warmup._count("errors")
+                print(f"❌ [{done}/{len(object_names)}] {name}: {e}")
+
+    print("⏳ Nunggu antrean tulis ke database kosong...")
+    app.write_behind.flush(app.WRITE_BEHIND_SHUTDOWN_TIMEOUT * 6)
+
+    print("-" * 50)
+    print(f"🏁 Warmup selesai dalam {round(time.monotonic() - start_total, 2)} detik")
+    for key, value in warmup.totals.items():
+        print(f"   {key}: {value}")
+
+
+if __name__ == "__main__":
+    main()